@@ -0,0 +1,156 @@
+"""
+Admin dashboard queries
+Counters are cached for a few seconds, user lists are keyset-paginated and
+searched in SQL with only the columns the dashboard shows, and bulk actions
+update many users in a single transaction.
+"""
+import threading
+import time
+from auth import user_cache
+from bill_history import encode_cursor, decode_cursor
+from migrations import query_sample
+
+DEFAULT_PAGE_SIZE = 25
+
+USER_LIST_COLUMNS = '''
+    id, email, business_name, owner_name, gst_verified,
+    is_admin, is_approved, is_active, created_at
+'''
+
+BULK_ACTIONS = {
+    'approve': ('is_approved = 1, approved_at = ?, approved_by = ?', 'is_approved = 0'),
+    'deactivate': ('is_active = 0', 'is_approved = 1 AND is_active = 1'),
+    'activate': ('is_active = 1', 'is_approved = 1 AND is_active = 0'),
+}
+
+
+class StatsCache:
+    """Dashboard counters, recomputed at most once per ttl seconds"""
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._value = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def get(self, db):
+        with self._lock:
+            if self._value is None or self._expires < time.monotonic():
+                self.misses += 1
+                self._value = dashboard_stats(db)
+                self._expires = time.monotonic() + self.ttl
+            else:
+                self.hits += 1
+            return self._value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+
+
+stats_cache = StatsCache()
+
+
+def dashboard_stats(db):
+    """User counts from the users indexes; bill count from sales_rollups"""
+    users = db.execute('''
+        SELECT COUNT(*) AS total, COALESCE(SUM(is_approved = 0), 0) AS pending
+        FROM users WHERE is_admin = 0
+    ''').fetchone()
+    # sales_rollups holds one row per user, month and GST rate, so summing it
+    # is far cheaper than COUNT(*) over every tenant's bills. Deleted users'
+    # rows linger until the purge_user job runs, so only live users count.
+    bills = db.execute('''
+        SELECT COALESCE(SUM(r.bill_count), 0) AS count
+        FROM sales_rollups r JOIN users u ON u.id = r.user_id
+    ''').fetchone()
+    return {
+        'total_users': users['total'],
+        'pending_users': users['pending'],
+        'total_bills': bills['count'],
+    }
+
+
+def _search_clause(query):
+    if not query:
+        return '', []
+    pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return (" AND (business_name LIKE ? ESCAPE '\\' OR owner_name LIKE ? ESCAPE '\\'"
+            " OR email LIKE ? ESCAPE '\\')"), [pattern] * 3
+
+
+def users_query(pending, query, position, page_size):
+    """SQL and parameters for a page of the user list"""
+    where = ' AND is_approved = 0' if pending else ''
+    search, params = _search_clause(query)
+    where += search
+    if position:
+        where += ' AND (created_at, id) < (?, ?)'
+        params.extend(position)
+    return f'''
+        SELECT {USER_LIST_COLUMNS}
+        FROM users
+        WHERE is_admin = 0{where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', (*params, page_size + 1)
+
+
+@query_sample('admin_users.fetch_users')
+def _users_samples(db):
+    yield 'all users', *users_query(False, None, None, DEFAULT_PAGE_SIZE)
+    yield 'pending, later page', *users_query(True, None, ('2026-01-15 09:30:00', 310), DEFAULT_PAGE_SIZE)
+    yield 'search', *users_query(False, 'traders', None, DEFAULT_PAGE_SIZE)
+
+
+def fetch_users(db, pending=False, query=None, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    One page of non-admin users, newest first
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    rows = db.execute(*users_query(pending, query, decode_cursor(cursor), page_size)).fetchall()
+
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, encode_cursor(rows[-1])
+    return rows, None
+
+
+def bulk_update(db, action, user_ids, admin_id, now):
+    """
+    Apply a bulk action to many users in one transaction
+    Admin accounts and users already in the target state are skipped.
+    Returns the ids that were changed.
+    """
+    assignments, eligible = BULK_ACTIONS[action]
+    ids = sorted({int(user_id) for user_id in user_ids})
+    if not ids:
+        return []
+    params = (now, admin_id) if action == 'approve' else ()
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        changed = []
+        # Stay well under SQLite's bound-parameter limit
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = db.execute(f'''
+                UPDATE users
+                SET {assignments},
+                    version = version + 1
+                WHERE id IN ({placeholders}) AND is_admin = 0 AND {eligible}
+                RETURNING id, version
+            ''', (*params, *chunk)).fetchall()
+            changed.extend(rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    for row in changed:
+        user_cache.invalidate(row['id'], row['version'])
+    stats_cache.invalidate()
+    return sorted(row['id'] for row in changed)
@@ -0,0 +1,138 @@
+"""
+Versioned JSON API (/api/v1) for integrations
+Request parsing and the JSON shapes of templates and bills. Routes live in
+app.py and authenticate with per-user API tokens (auth.token_required);
+bills go through the same billing.create_bill() as the bill form.
+"""
+import json
+from bill_history import row_to_dict
+from migrations import query_sample
+
+MAX_BATCH_IDS = 100
+
+TEMPLATE_FIELDS = ('business_name', 'business_address', 'owner_name', 'mobile', 'gst_number',
+                   'default_date', 'stamp_type', 'stamp_business_name', 'stamp_place')
+REQUIRED_TEMPLATE_FIELDS = ('business_name', 'business_address', 'owner_name', 'mobile')
+
+BILL_FIELDS = ('id', 'template_id', 'bill_number', 'customer_name', 'customer_mobile',
+               'customer_address', 'subtotal', 'gst_enabled', 'gst_percentage', 'gst_amount',
+               'total', 'bill_date', 'created_at')
+
+
+class ApiError(ValueError):
+    """Raised for a request the API cannot accept; status is the HTTP status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_ids(value):
+    """Parse a comma separated list of ids (at most MAX_BATCH_IDS), keeping order"""
+    ids = []
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            bill_id = int(part)
+        except ValueError:
+            raise ApiError(f'Invalid id {part!r}')
+        if bill_id not in ids:
+            ids.append(bill_id)
+    if not ids:
+        raise ApiError('ids is required')
+    if len(ids) > MAX_BATCH_IDS:
+        raise ApiError(f'At most {MAX_BATCH_IDS} ids per request')
+    return ids
+
+
+def parse_id_cursor(cursor):
+    """Template list cursor: the id of the last template on the previous page"""
+    if not cursor:
+        return None
+    try:
+        return int(cursor)
+    except ValueError:
+        raise ApiError('Invalid cursor')
+
+
+def prepare_template(data):
+    """Validate a template body; returns a dict of TEMPLATE_FIELDS"""
+    template = {field: str(data.get(field) or '').strip() for field in TEMPLATE_FIELDS}
+    missing = [field for field in REQUIRED_TEMPLATE_FIELDS if not template[field]]
+    if missing:
+        raise ApiError(f"Missing required fields: {', '.join(missing)}")
+    template['stamp_type'] = template['stamp_type'] or 'rectangle'
+    return template
+
+
+def template_to_dict(row, upload_url):
+    """JSON shape of a template; upload_url(filename) links its images"""
+    template = {'id': row['id'], 'version': row['version'], 'created_at': row['created_at']}
+    template.update((field, row[field]) for field in TEMPLATE_FIELDS)
+    for name, column in (('logo_url', 'logo_path'), ('signature_url', 'signature_path'),
+                         ('stamp_url', 'stamp_upload_path' if row['stamp_upload_path'] else 'stamp_path')):
+        template[name] = upload_url(row[column]) if row[column] else None
+    return template
+
+
+def bill_to_dict(row):
+    """JSON shape of a full bill row, with its items and business name"""
+    bill = {field: row[field] for field in BILL_FIELDS}
+    bill['gst_enabled'] = bool(bill['gst_enabled'])
+    bill['business_name'] = row['business_name']
+    try:
+        items = json.loads(row['items_json']) if row['items_json'] else []
+    except ValueError:
+        items = []
+    bill['items'] = items if isinstance(items, list) else []
+    return bill
+
+
+def summary_to_dict(row):
+    """JSON shape of a bill in list responses (HISTORY_COLUMNS, no items)"""
+    bill = row_to_dict(row)
+    bill['gst_enabled'] = bool(bill['gst_enabled'])
+    return bill
+
+
+def fetch_bills(db, user_id, bill_ids):
+    """A user's bills by id as {id: row}; ids that are not theirs are absent"""
+    rows = db.execute('''
+        SELECT b.*, t.business_name
+        FROM bills b
+        LEFT JOIN templates t ON b.template_id = t.id
+        WHERE b.user_id = ? AND b.id IN (SELECT value FROM json_each(?))
+    ''', (user_id, json.dumps(bill_ids))).fetchall()
+    return {row['id']: row for row in rows}
+
+
+def templates_query(user_id, after_id, page_size):
+    """SQL and parameters for a page of a user's templates before after_id"""
+    where, params = ('AND id < ?', [after_id]) if after_id else ('', [])
+    return f'''
+        SELECT * FROM templates
+        WHERE user_id = ? {where}
+        ORDER BY id DESC
+        LIMIT ?
+    ''', (user_id, *params, page_size + 1)
+
+
+@query_sample('api_v1.fetch_templates')
+def _templates_samples(db):
+    yield 'first page', *templates_query(1, None, 20)
+    yield 'later page', *templates_query(1, 57, 20)
+
+
+def fetch_templates(db, user_id, after_id=None, page_size=20):
+    """
+    One page of a user's templates, newest first
+    Returns (rows, next_cursor); the newest template is the one new bills use.
+    """
+    rows = db.execute(*templates_query(user_id, after_id, page_size)).fetchall()
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, str(rows[-1]['id'])
+    return rows, None
+
@@ -1,101 +1,136 @@
 import os
 import json
-import sqlite3
+import time
+import click
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_file, session, flash
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash, stream_with_context, send_file, send_from_directory, g, current_app
+from flask.cli import AppGroup
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 import base64
+import database
+import migrations
+import auth
+import bill_history
+import bill_search
+import bill_export
+import bill_archive
+import billing
+import api_v1
+import reports
+import admin_users
+import uploads
+import preview_cache
+import metrics
+import profiling
+import jobs
+from database import get_db
 
-app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY', 'invoice-generator-secret-key-2024-change-in-production')
-app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Views and CLI commands are collected at import and registered on each app
+# by create_app(), under the same endpoint and command names as before
+_views = []
+commands = AppGroup('invoice')
+
+def route(rule, **options):
+    """Like app.route(), for the apps create_app() builds"""
+    def decorator(view):
+        _views.append((rule, view, options))
+        return view
+    return decorator
+
+def create_app(config=None):
+    """
+    Build a configured app. config (a dict) overrides the defaults and the
+    environment, e.g. {'DATABASE': path} for a test database.
+
+    Nothing touches the database here: run `flask --app app init-db` once
+    to create or upgrade the schema, or set AUTO_MIGRATE for development.
+    """
+    app = Flask(__name__)
+    app.secret_key = os.environ.get('SECRET_KEY', 'invoice-generator-secret-key-2024-change-in-production')
+    app.config['DATABASE'] = os.environ.get('DATABASE') or os.path.join(APP_DIR, 'invoice.db')
+    app.config['AUTO_MIGRATE'] = os.environ.get('AUTO_MIGRATE', '0') == '1'
+    app.config['UPLOAD_FOLDER'] = os.path.join(APP_DIR, 'uploads')
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
+    app.config['UPLOAD_SCALE'] = uploads.DEFAULT_SCALE
+    # None, 'x-sendfile' (Apache/lighttpd) or 'x-accel-redirect' (nginx)
+    app.config['UPLOADS_OFFLOAD'] = os.environ.get('UPLOADS_OFFLOAD') or None
+    app.config['UPLOADS_ACCEL_PREFIX'] = os.environ.get('UPLOADS_ACCEL_PREFIX', '/_uploads/')
+    app.config['HISTORY_PAGE_SIZE'] = 50
+    app.config['EXPORT_CHUNK_SIZE'] = bill_export.DEFAULT_CHUNK_SIZE
+    app.config['ARCHIVE_FOLDER'] = os.environ.get('ARCHIVE_FOLDER') or os.path.join(APP_DIR, 'exports')
+    app.config['ARCHIVE_WORKERS'] = int(os.environ.get('ARCHIVE_WORKERS', bill_archive.DEFAULT_WORKERS))
+    app.config['ARCHIVE_MAX_AGE'] = 24 * 3600
+    # TrueType files for PDF text Helvetica cannot show, e.g. Tamil or
+    # Devanagari (None: the Noto and DejaVu fonts pdf_renderer.find_fonts() finds)
+    app.config['PDF_FONTS'] = [path for path in os.environ.get('PDF_FONTS', '').split(os.pathsep) if path] or None
+    app.config['ADMIN_PAGE_SIZE'] = 25
+    app.config['ADMIN_STATS_TTL'] = 30
+    app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 10))
+    app.config['GST_CACHE_TTL'] = 24 * 3600
+    app.config['GST_CACHE_PERSIST'] = os.environ.get('GST_CACHE_PERSIST', '0') == '1'
+    app.config['GST_API_URL'] = os.environ.get('GST_API_URL') or None
+    app.config['GST_API_KEY'] = os.environ.get('GST_API_KEY') or None
+    app.config['GST_API_TIMEOUT'] = (3.05, 10)
+    app.config['BILL_NUMBER_PREFIX'] = os.environ.get('BILL_NUMBER_PREFIX', 'INV')
+    app.config['BILL_NUMBER_FY_RESET'] = os.environ.get('BILL_NUMBER_FY_RESET', '0') == '1'
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+    app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', metrics.DEFAULT_SLOW_QUERY_MS))
+    app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER') or os.path.join(APP_DIR, 'profiles')
+    app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', profiling.DEFAULT_KEEP))
+    app.config['PROFILE_SAMPLE_RATE'] = int(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_SAMPLE_STACKS'] = os.environ.get('PROFILE_SAMPLE_STACKS', '0') == '1'
+    # Job worker threads per process (0: only `flask run-jobs` runs jobs)
+    app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', jobs.DEFAULT_WORKERS))
+    app.config['JOB_SHUTDOWN_TIMEOUT'] = float(os.environ.get('JOB_SHUTDOWN_TIMEOUT', jobs.DEFAULT_SHUTDOWN_TIMEOUT))
+    app.config.update(config or {})
+
+    database.init_app(app)
+    auth.init_app(app)
+    metrics.init_app(app)
+    profiling.init_app(app)
+    jobs.init_app(app)
+    preview_cache.init_app(app)
+
+    for rule, view, options in _views:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.register_error_handler(api_v1.ApiError, handle_api_error)
+    for command in commands.commands.values():
+        app.cli.add_command(command)
+
+    # Ensure upload directory exists
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    if app.config['AUTO_MIGRATE']:
+        with app.app_context():
+            init_db()
+    return app
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_db():
-    db = sqlite3.connect('invoice.db')
-    db.row_factory = sqlite3.Row
-    return db
+def save_upload(field):
+    """Store an uploaded image as received for the process_uploads job; returns its filename or None"""
+    upload = request.files.get(field)
+    if not upload or not upload.filename or not allowed_file(upload.filename):
+        return None
+    try:
+        return uploads.store_incoming(current_app.config['UPLOAD_FOLDER'], upload.stream.read())
+    except ValueError:
+        flash(f'{upload.filename} is not a valid image and was ignored', 'warning')
+        return None
 
 def init_db():
+    """Bring the schema up to date and create the default admin (the init-db command)"""
     db = get_db()
     
-    # Create users table
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            business_name TEXT NOT NULL,
-            business_address TEXT NOT NULL,
-            owner_name TEXT NOT NULL,
-            mobile TEXT NOT NULL,
-            gst_number TEXT,
-            gst_verified INTEGER DEFAULT 0,
-            is_admin INTEGER DEFAULT 0,
-            is_approved INTEGER DEFAULT 0,
-            is_active INTEGER DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            approved_at TIMESTAMP,
-            approved_by INTEGER,
-            FOREIGN KEY (approved_by) REFERENCES users (id)
-        )
-    ''')
-    
-    # Create templates table with user_id
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS templates (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            business_name TEXT NOT NULL,
-            business_address TEXT NOT NULL,
-            owner_name TEXT NOT NULL,
-            mobile TEXT NOT NULL,
-            gst_number TEXT,
-            default_date TEXT,
-            logo_path TEXT,
-            signature_path TEXT,
-            stamp_upload_path TEXT,
-            stamp_data TEXT,
-            stamp_type TEXT,
-            stamp_business_name TEXT,
-            stamp_place TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Create bills table with user_id
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS bills (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            template_id INTEGER,
-            bill_number TEXT,
-            customer_name TEXT NOT NULL,
-            customer_mobile TEXT,
-            customer_address TEXT,
-            items_json TEXT,
-            subtotal REAL,
-            gst_enabled INTEGER DEFAULT 0,
-            gst_percentage REAL,
-            gst_amount REAL,
-            total REAL,
-            bill_date TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (template_id) REFERENCES templates (id)
-        )
-    ''')
+    # Bring the schema up to date
+    migrations.migrate(db)
     
     # Create default admin user if not exists
     admin = db.execute('SELECT * FROM users WHERE email = ?', ('admin@invoice.com',)).fetchone()
@@ -109,16 +144,91 @@ def init_db():
               'Admin User', '0000000000'))
     
     db.commit()
-    db.close()
-
-# Initialize database on startup
-init_db()
 
 # Import auth decorators
-from auth import login_required, admin_required, get_current_user
-from gst_verification import verify_gst
+from auth import (login_required, admin_required, get_current_user, bump_user_version, user_cache,
+                  token_required, authenticate_token, api_error, create_api_token, revoke_api_token)
+from gst_verification import verify_gst, verification_cache, GSTClient, GSTServiceError, gst_format_error
+import gst_reverify
+
+metrics.register_cache('user_cache', user_cache)
+metrics.register_cache('preview_cache', preview_cache.preview_cache)
+metrics.register_cache('verification_cache', verification_cache)
+metrics.register_cache('stats_cache', admin_users.stats_cache)
+
+_gst_clients = {}
 
-@app.route('/')
+def gst_client():
+    """Shared pooled client for the configured GST API, or None when not configured"""
+    url = current_app.config['GST_API_URL']
+    if not url:
+        return None
+    if url not in _gst_clients:
+        _gst_clients[url] = GSTClient(url, current_app.config['GST_API_KEY'],
+                                      timeout=current_app.config['GST_API_TIMEOUT'])
+    return _gst_clients[url]
+
+def check_gst(gst_number):
+    """verify_gst() through the shared result cache (and its SQLite tier if enabled)"""
+    verification_cache.ttl = current_app.config['GST_CACHE_TTL']
+    verification_cache.persist = current_app.config['GST_CACHE_PERSIST']
+    return verify_gst(gst_number, db=get_db() if verification_cache.persist else None,
+                      client=gst_client())
+
+# ============================================
+# Background jobs
+# ============================================
+
+@jobs.handler('verify_gst')
+def verify_gst_job(payload, job):
+    """Verify a new user's GST number and record the outcome on the user"""
+    db = get_db()
+    user_id = payload['user_id']
+    user = db.execute('SELECT gst_number FROM users WHERE id = ?', (user_id,)).fetchone()
+    if not user or not user['gst_number']:
+        return None
+    result = check_gst(user['gst_number'])
+    if result.get('details', {}).get('retryable'):
+        # Retried with backoff; if the service stays down reverify-gst settles it later
+        raise GSTServiceError(result.get('error') or 'Verification service unavailable')
+    db.execute('UPDATE users SET gst_verified = ? WHERE id = ? AND gst_number = ?',
+               (int(result['valid']), user_id, user['gst_number']))
+    bump_user_version(db, user_id)
+    db.commit()
+    return {'valid': result['valid'], 'verified_online': result.get('verified_online', False)}
+
+@jobs.handler('purge_user')
+def purge_user_job(payload, job):
+    """Delete the bills, search entries, rollups and templates of a deleted user"""
+    db = get_db()
+    user_id = payload['user_id']
+    bill_search.remove_user(db, user_id)
+    db.execute('DELETE FROM bill_items WHERE user_id = ?', (user_id,))
+    db.execute('DELETE FROM sales_rollups WHERE user_id = ?', (user_id,))
+    bills = db.execute('DELETE FROM bills WHERE user_id = ?', (user_id,)).rowcount
+    db.execute('DELETE FROM templates WHERE user_id = ?', (user_id,))
+    db.commit()
+    return {'bills': bills}
+
+@jobs.handler('process_uploads')
+def process_uploads_job(payload, job):
+    """Normalize a template's new uploads and swap them in for the files as received"""
+    db = get_db()
+    config = current_app.config
+    template_id = payload['template_id']
+    versions, rejected = [], []
+    for column, incoming, previous in payload['files']:
+        version, error = uploads.finish_incoming(db, config['UPLOAD_FOLDER'], template_id, column,
+                                                 incoming, previous, config['UPLOAD_SCALE'])
+        if version:
+            versions.append(version)
+        if error:
+            rejected.append({'column': column, 'error': error})
+    if versions:
+        preview_cache.preview_cache.invalidate_template(template_id, max(versions))
+    return {'rejected': rejected}
+
+@route('/')
 @login_required
 def index():
     user = get_current_user()
@@ -127,10 +237,9 @@ def index():
                          (user['id'],)).fetchone()
     recent_bills = db.execute('SELECT * FROM bills WHERE user_id = ? ORDER BY created_at DESC LIMIT 5',
                               (user['id'],)).fetchall()
-    db.close()
     return render_template('index.html', template=template, recent_bills=recent_bills, user=user)
 
-@app.route('/template', methods=['GET', 'POST'])
+@route('/template', methods=['GET', 'POST'])
 @login_required
 def template():
     user = get_current_user()
@@ -145,41 +254,25 @@ def template():
         gst_number = request.form.get('gst_number', '').strip()
 
         
-        # Stamp data
+        # Stamp data: the generated stamp arrives as a PNG data URL and is
+        # stored as a file so pages reference it by URL instead of inlining it
+        stamp_path = None
         stamp_data = request.form.get('stamp_data', '')
+        if stamp_data:
+            try:
+                stamp_path = uploads.store_incoming(current_app.config['UPLOAD_FOLDER'],
+                                                    uploads.decode_data_url(stamp_data))
+            except ValueError:
+                flash('Generated stamp could not be read and was ignored', 'warning')
         stamp_type = request.form.get('stamp_type', 'rectangle')
         stamp_business_name = request.form.get('stamp_business_name', '')
         stamp_place = request.form.get('stamp_place', '')
         
-        # Handle logo upload
-        logo_path = None
-        if 'logo' in request.files:
-            logo = request.files['logo']
-            if logo and logo.filename and allowed_file(logo.filename):
-                filename = secure_filename(f"logo_{datetime.now().strftime('%Y%m%d%H%M%S')}_{logo.filename}")
-                logo_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                logo.save(logo_path)
-                logo_path = filename
-        
-        # Handle signature upload
-        signature_path = None
-        if 'signature' in request.files:
-            sig = request.files['signature']
-            if sig and sig.filename and allowed_file(sig.filename):
-                filename = secure_filename(f"sig_{datetime.now().strftime('%Y%m%d%H%M%S')}_{sig.filename}")
-                signature_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                sig.save(signature_path)
-                signature_path = filename
-
-        # Handle stamp upload
-        stamp_upload_path = None
-        if 'stamp_upload' in request.files:
-            stamp_file = request.files['stamp_upload']
-            if stamp_file and stamp_file.filename and allowed_file(stamp_file.filename):
-                filename = secure_filename(f"stamp_{datetime.now().strftime('%Y%m%d%H%M%S')}_{stamp_file.filename}")
-                stamp_upload_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                stamp_file.save(stamp_upload_path)
-                stamp_upload_path = filename
+        # Kept as received for now; a job normalizes them to their print size
+        incoming = {'logo_path': save_upload('logo'), 'signature_path': save_upload('signature'),
+                    'stamp_upload_path': save_upload('stamp_upload'), 'stamp_path': stamp_path}
+        logo_path, signature_path, stamp_upload_path = (
+            incoming['logo_path'], incoming['signature_path'], incoming['stamp_upload_path'])
         
         # Check if template exists for this user
         existing = db.execute('SELECT * FROM templates WHERE user_id = ? ORDER BY id DESC LIMIT 1', 
@@ -194,37 +287,45 @@ def template():
             if not stamp_upload_path and existing['stamp_upload_path']:
                 stamp_upload_path = existing['stamp_upload_path']
             
-            db.execute('''
+            updated = db.execute('''
                 UPDATE templates SET 
                     business_name=?, business_address=?, owner_name=?, mobile=?,
                     gst_number=?, logo_path=?, signature_path=?, 
-                    stamp_upload_path=?, stamp_data=?, stamp_type=?, 
-                    stamp_business_name=?, stamp_place=?
+                    stamp_upload_path=?, stamp_path=?, stamp_data=NULL, stamp_type=?, 
+                    stamp_business_name=?, stamp_place=?, version=version + 1
                 WHERE id=? AND user_id=?
+                RETURNING version
             ''', (business_name, business_address, owner_name, mobile, gst_number,
-                  logo_path, signature_path, stamp_upload_path, stamp_data, stamp_type, 
-                  stamp_business_name, stamp_place, existing['id'], user['id']))
+                  logo_path, signature_path, stamp_upload_path, stamp_path, stamp_type,
+                  stamp_business_name, stamp_place, existing['id'], user['id'])).fetchone()
+            template_id = existing['id']
         else:
-            db.execute('''
+            template_id = db.execute('''
                 INSERT INTO templates (user_id, business_name, business_address, owner_name, mobile,
-                    gst_number, logo_path, signature_path, stamp_upload_path, 
-                    stamp_data, stamp_type, stamp_business_name, stamp_place)
+                    gst_number, logo_path, signature_path, stamp_upload_path,
+                    stamp_path, stamp_type, stamp_business_name, stamp_place)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                RETURNING id
             ''', (user['id'], business_name, business_address, owner_name, mobile, gst_number,
-                  logo_path, signature_path, stamp_upload_path, stamp_data, stamp_type, 
-                  stamp_business_name, stamp_place))
-        
+                  logo_path, signature_path, stamp_upload_path, stamp_path, stamp_type,
+                  stamp_business_name, stamp_place)).fetchone()['id']
+
+        files = [[column, filename, existing[column] if existing else None]
+                 for column, filename in incoming.items() if filename]
+        if files:
+            jobs.enqueue(db, 'process_uploads', {'template_id': template_id, 'files': files},
+                         user_id=user['id'])
         db.commit()
-        db.close()
+        if existing:
+            preview_cache.preview_cache.invalidate_template(existing['id'], updated['version'])
         return redirect(url_for('index'))
     
     # GET request - show form
     existing_template = db.execute('SELECT * FROM templates WHERE user_id = ? ORDER BY id DESC LIMIT 1', 
                                    (user['id'],)).fetchone()
-    db.close()
     return render_template('template.html', template=existing_template)
 
-@app.route('/bill/create', methods=['GET', 'POST'])
+@route('/bill/create', methods=['GET', 'POST'])
 @login_required
 def create_bill():
     user = get_current_user()
@@ -233,120 +334,230 @@ def create_bill():
                          (user['id'],)).fetchone()
     
     if not template:
-        db.close()
         return redirect(url_for('template'))
     
     if request.method == 'POST':
-        customer_name = request.form.get('customer_name', '').strip()
-        customer_mobile = request.form.get('customer_mobile', '').strip()
-        customer_address = request.form.get('customer_address', '').strip()
-        bill_date = request.form.get('bill_date')
-        
-        if not bill_date:
-            bill_date = datetime.now().strftime('%Y-%m-%d')
-
-        # Get items
-        item_names = request.form.getlist('item_name[]')
+        names = request.form.getlist('item_name[]')
         quantities = request.form.getlist('quantity[]')
         rates = request.form.getlist('rate[]')
+        data = {
+            'customer_name': request.form.get('customer_name'),
+            'customer_mobile': request.form.get('customer_mobile'),
+            'customer_address': request.form.get('customer_address'),
+            'bill_date': request.form.get('bill_date'),
+            'items': [{'name': name,
+                       'quantity': quantities[i] if i < len(quantities) else 0,
+                       'rate': rates[i] if i < len(rates) else 0}
+                      for i, name in enumerate(names)],
+            'gst_enabled': request.form.get('gst_enabled') == 'on',
+            'gst_percentage': request.form.get('gst_percentage', 0),
+        }
         
-        items = []
-        subtotal = 0
-        for i in range(len(item_names)):
-            if item_names[i].strip():
-                try:
-                    qty = float(quantities[i]) if quantities[i] else 0
-                    rate = float(rates[i]) if rates[i] else 0
-                    amount = qty * rate
-                    items.append({
-                        'name': item_names[i].strip(),
-                        'quantity': qty,
-                        'rate': rate,
-                        'amount': amount
-                    })
-                    subtotal += amount
-                except ValueError:
-                    continue
-        
-        gst_enabled = request.form.get('gst_enabled') == 'on'
-        gst_percentage = float(request.form.get('gst_percentage', 0)) if gst_enabled else 0
-        gst_amount = (subtotal * gst_percentage / 100) if gst_enabled else 0
-        total = subtotal + gst_amount
-        
-        # Generate bill number for this user
-        last_bill = db.execute('SELECT bill_number FROM bills WHERE user_id = ? ORDER BY id DESC LIMIT 1', 
-                              (user['id'],)).fetchone()
-        if last_bill and last_bill['bill_number']:
-            try:
-                last_num = int(last_bill['bill_number'].split('-')[-1])
-                bill_number = f"INV-{last_num + 1:04d}"
-            except:
-                bill_number = "INV-0001"
-        else:
-            bill_number = "INV-0001"
-        
-        db.execute('''
-            INSERT INTO bills (user_id, template_id, bill_number, customer_name, customer_mobile,
-                customer_address, items_json, subtotal, gst_enabled, gst_percentage,
-                gst_amount, total, bill_date)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (user['id'], template['id'], bill_number, customer_name, customer_mobile, customer_address,
-              json.dumps(items), subtotal, gst_enabled, gst_percentage, gst_amount, total, bill_date))
-        
-        db.commit()
-        bill_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
-        db.close()
+        # Same validation, totals and numbering as the JSON API
+        try:
+            bill_id, _bill_number = billing.create_bill(db, user['id'], template['id'], data,
+                                                        billing.BillNumbering.from_config(current_app.config))
+        except billing.BillError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('create_bill'))
         
         return redirect(url_for('preview_bill', bill_id=bill_id))
     
     # Set default date to today
     default_date = datetime.now().strftime('%Y-%m-%d')
     
-    db.close()
     return render_template('bill.html', template=template, default_date=default_date)
 
-@app.route('/bill/preview/<int:bill_id>')
+@route('/bill/preview/<int:bill_id>')
 @login_required
 def preview_bill(bill_id):
+    user = get_current_user()
+    cache = preview_cache.preview_cache
+    variant = 'admin' if session.get('is_admin') else 'user'
+    
+    # Repeat views are answered from the cache without touching the DB or Jinja
+    cached = cache.get(bill_id, user['id'], variant, preview_cache.load_template_version)
+    if cached is None:
+        db = get_db()
+        bill = db.execute('SELECT * FROM bills WHERE id = ? AND user_id = ?', 
+                         (bill_id, user['id'])).fetchone()
+        
+        if not bill:
+            return redirect(url_for('history'))
+        
+        template = db.execute('SELECT * FROM templates WHERE id = ?', (bill['template_id'],)).fetchone()
+        items = json.loads(bill['items_json']) if bill['items_json'] else []
+        
+        html = render_template('preview.html', bill=bill, template=template, items=items)
+        cached = cache.put(bill_id, user['id'], variant, bill['template_id'],
+                           template['version'] if template else None, html)
+    
+    response = current_app.response_class(cached.html, mimetype='text/html')
+    response.set_etag(cached.etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@route('/bill/<int:bill_id>/pdf')
+@login_required
+def bill_pdf(bill_id):
     user = get_current_user()
     db = get_db()
     bill = db.execute('SELECT * FROM bills WHERE id = ? AND user_id = ?', 
                      (bill_id, user['id'])).fetchone()
     
     if not bill:
-        db.close()
         return redirect(url_for('history'))
     
     template = db.execute('SELECT * FROM templates WHERE id = ?', (bill['template_id'],)).fetchone()
-    items = json.loads(bill['items_json']) if bill['items_json'] else []
-    db.close()
+    from pdf_renderer import UnsupportedText, render_bill_pdf
+    try:
+        pdf = render_bill_pdf(bill, template, upload_folder=current_app.config['UPLOAD_FOLDER'],
+                              fonts=current_app.config['PDF_FONTS'])
+    except UnsupportedText as e:
+        # Text the server cannot draw correctly (no font for it, or it needs
+        # shaping); the preview page builds the PDF with the browser instead
+        current_app.logger.warning('Bill %s: %s; sending the browser PDF export', bill_id, e)
+        return redirect(url_for('preview_bill', bill_id=bill_id, _anchor='browser-pdf'))
     
-    return render_template('preview.html', bill=bill, template=template, items=items)
+    response = current_app.response_class(pdf, mimetype='application/pdf')
+    disposition = 'attachment' if request.args.get('download') else 'inline'
+    response.headers['Content-Disposition'] = f'{disposition}; filename="{secure_filename(bill["bill_number"] or str(bill_id))}.pdf"'
+    return response
 
-@app.route('/history')
+@route('/history')
 @login_required
 def history():
     user = get_current_user()
     db = get_db()
-    bills = db.execute('''
-        SELECT b.*, t.business_name 
-        FROM bills b 
-        LEFT JOIN templates t ON b.template_id = t.id 
-        WHERE b.user_id = ?
-        ORDER BY b.created_at DESC
-    ''', (user['id'],)).fetchall()
-    db.close()
-    return render_template('history.html', bills=bills)
-
-@app.route('/uploads/<filename>')
+    filters = bill_history.parse_filters(request.args)
+    page_size = bill_history.parse_page_size(request.args.get('per_page'),
+                                             current_app.config['HISTORY_PAGE_SIZE'])
+    query = request.args.get('q', '').strip()
+    if query:
+        # Ranked search results are paged by number rather than by cursor
+        page = bill_search.parse_page(request.args.get('page'))
+        bills, next_page = bill_search.search(db, user['id'], query, filters, page, page_size,
+                                              noise=current_app.config['BILL_NUMBER_PREFIX'])
+        cursor, next_cursor = None, None
+    else:
+        page, next_page = None, None
+        cursor = request.args.get('cursor')
+        bills, next_cursor = bill_history.fetch_page(db, user['id'], filters, cursor, page_size)
+    return render_template('history.html', bills=bills, filters=filters, page_size=page_size,
+                           cursor=cursor, next_cursor=next_cursor, query=query,
+                           page=page, next_page=next_page,
+                           filtered=bool(query) or any(value is not None for value in filters.values()))
+
+@route('/history/export')
+@login_required
+def export_history():
+    user = get_current_user()
+    fmt = request.args.get('format', 'csv')
+    if fmt not in bill_export.FORMATS:
+        flash('Export format must be CSV or XLSX', 'error')
+        return redirect(url_for('history'))
+    filters = bill_history.parse_filters(request.args)
+    with_items = request.args.get('items') == '1'
+    # Each chunk is queried only when the client is ready for more bytes;
+    # stream_with_context keeps the request's connection open until then
+    chunks = bill_export.iter_chunks(get_db(), user['id'], filters, with_items,
+                                     current_app.config['EXPORT_CHUNK_SIZE'])
+    body = stream_with_context(bill_export.stream(fmt, chunks, with_items))
+    response = current_app.response_class(body, mimetype=bill_export.FORMATS[fmt])
+    filename = f"bills{'-items' if with_items else ''}-{datetime.now().strftime('%Y%m%d')}.{fmt}"
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    # Ask nginx-style proxies to pass chunks through instead of buffering
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@route('/history/archive', methods=['POST'])
+@login_required
+def create_archive():
+    user = get_current_user()
+    db = get_db()
+    bill_archive.cleanup(db, current_app.config['ARCHIVE_FOLDER'], current_app.config['ARCHIVE_MAX_AGE'])
+    job_id = bill_archive.active_job(db, user['id'])
+    if job_id:
+        flash('An invoice archive is already being prepared', 'info')
+        return redirect(url_for('archive_status', job_id=job_id))
+    
+    filters = bill_history.parse_filters(request.form)
+    job_id = bill_archive.create_job(db, user['id'], filters['date_from'], filters['date_to'])
+    if not job_id:
+        flash('No bills in this date range', 'warning')
+        return redirect(url_for('history', date_from=filters['date_from'], date_to=filters['date_to']))
+    return redirect(url_for('archive_status', job_id=job_id))
+
+@route('/history/archive/<job_id>')
+@login_required
+def archive_status(job_id):
+    user = get_current_user()
+    job = bill_archive.get_job(get_db(), job_id, user['id'])
+    if not job:
+        flash('Archive not found or expired', 'error')
+        return redirect(url_for('history'))
+    return render_template('archive.html', job=job)
+
+@route('/history/archive/<job_id>/download')
+@login_required
+def download_archive(job_id):
+    user = get_current_user()
+    job = bill_archive.get_job(get_db(), job_id, user['id'])
+    path = job and bill_archive.archive_path(current_app.config['ARCHIVE_FOLDER'], job)
+    if not job or job['status'] != bill_archive.DONE or not os.path.exists(path):
+        flash('Archive not found or expired', 'error')
+        return redirect(url_for('history'))
+    return send_file(path, mimetype='application/zip', as_attachment=True,
+                     download_name=job['filename'], conditional=True)
+
+@route('/reports')
+@login_required
+def reports_page():
+    user = get_current_user()
+    db = get_db()
+    month_from = reports.parse_month(request.args.get('month_from'))
+    month_to = reports.parse_month(request.args.get('month_to'))
+    months = reports.monthly_sales(db, user['id'], month_from, month_to)
+    totals = {key: sum(month[key] for month in months)
+              for key in ('bill_count', 'taxable_value', 'gst_amount', 'total')}
+    top_items = reports.top_items(db, user['id'], limit=10)
+    return render_template('reports.html', months=months, totals=totals, top_items=top_items,
+                           month_from=month_from, month_to=month_to)
+
+@route('/account/api-tokens', methods=['GET', 'POST'])
+@login_required
+def api_tokens():
+    user = get_current_user()
+    db = get_db()
+    new_token = None
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip() or 'API token'
+        _token_id, new_token = create_api_token(db, user['id'], name[:100])
+        db.commit()
+    tokens = db.execute('SELECT id, name, prefix, created_at, last_used_at FROM api_tokens '
+                        'WHERE user_id = ? ORDER BY id DESC', (user['id'],)).fetchall()
+    # The token itself is only ever shown in the response that created it
+    return render_template('api_tokens.html', tokens=tokens, new_token=new_token)
+
+@route('/account/api-tokens/<int:token_id>/revoke', methods=['POST'])
+@login_required
+def revoke_token(token_id):
+    user = get_current_user()
+    db = get_db()
+    revoke_api_token(db, user['id'], token_id)
+    db.commit()
+    return redirect(url_for('api_tokens'))
+
+@route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    return uploads.serve_upload(filename)
 
 # ============================================
 # Authentication Routes
 # ============================================
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     if 'user_id' in session:
         return redirect(url_for('index'))
@@ -374,46 +585,47 @@ def register():
             flash('Password must be at least 6 characters', 'error')
             return render_template('register.html')
         
-        # Verify GST if provided
-        gst_verified = 0
+        # Malformed GST numbers are refused here; the verify_gst job does
+        # the (possibly online) verification after sign-up
         if gst_number:
-            gst_result = verify_gst(gst_number)
-            if not gst_result['valid']:
-                flash(f"GST Verification Failed: {gst_result.get('error', 'Invalid GST')}", 'error')
+            gst_error = gst_format_error(gst_number)
+            if gst_error:
+                flash(f"GST Verification Failed: {gst_error}", 'error')
                 return render_template('register.html')
-            gst_verified = 1
-        
+
         db = get_db()
         
         # Check if email already exists
         existing = db.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
         if existing:
             flash('Email already registered', 'error')
-            db.close()
             return render_template('register.html')
         
         # Create user
         password_hash = generate_password_hash(password)
         try:
-            db.execute('''
+            user_id = db.execute('''
                 INSERT INTO users (email, password_hash, business_name, business_address,
                     owner_name, mobile, gst_number, gst_verified, is_approved)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
-            ''', (email, password_hash, business_name, business_address, owner_name, 
-                  mobile, gst_number, gst_verified))
+                VALUES (?, ?, ?, ?, ?, ?, ?, 0, 0)
+                RETURNING id
+            ''', (email, password_hash, business_name, business_address, owner_name,
+                  mobile, gst_number)).fetchone()['id']
+            if gst_number:
+                jobs.enqueue(db, 'verify_gst', {'user_id': user_id}, user_id=user_id,
+                             priority=jobs.PRIORITY_HIGH, max_attempts=5)
             db.commit()
-            db.close()
+            admin_users.stats_cache.invalidate()
             
             flash('Registration successful! Please wait for admin approval.', 'success')
             return redirect(url_for('login'))
         except Exception as e:
-            db.close()
             flash(f'Registration failed: {str(e)}', 'error')
             return render_template('register.html')
     
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     if 'user_id' in session:
         return redirect(url_for('index'))
@@ -428,7 +640,6 @@ def login():
         
         db = get_db()
         user = db.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
-        db.close()
         
         if not user or not check_password_hash(user['password_hash'], password):
             flash('Invalid email or password', 'error')
@@ -443,6 +654,7 @@ def login():
             return redirect(url_for('pending_approval'))
         
         # Login successful
+        user_cache.put(user)
         session['user_id'] = user['id']
         session['is_admin'] = user['is_admin']
         flash(f"Welcome back, {user['owner_name']}!", 'success')
@@ -450,13 +662,13 @@ def login():
     
     return render_template('login.html')
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     session.clear()
     flash('You have been logged out', 'info')
     return redirect(url_for('login'))
 
-@app.route('/pending-approval')
+@route('/pending-approval')
 def pending_approval():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -471,42 +683,70 @@ def pending_approval():
 # Admin Routes
 # ============================================
 
-@app.route('/admin/dashboard')
+@route('/admin/dashboard')
 @admin_required
 def admin_dashboard():
     user = get_current_user()
     db = get_db()
     
     # Get statistics
-    total_users = db.execute('SELECT COUNT(*) as count FROM users WHERE is_admin = 0').fetchone()['count']
-    pending_users = db.execute('SELECT COUNT(*) as count FROM users WHERE is_approved = 0 AND is_admin = 0').fetchone()['count']
-    total_bills = db.execute('SELECT COUNT(*) as count FROM bills').fetchone()['count']
+    admin_users.stats_cache.ttl = current_app.config['ADMIN_STATS_TTL']
+    stats = admin_users.stats_cache.get(db)
+    
+    page_size = bill_history.parse_page_size(request.args.get('per_page'), current_app.config['ADMIN_PAGE_SIZE'])
+    query = request.args.get('q', '').strip()
     
     # Get pending users
-    pending = db.execute('''
-        SELECT * FROM users 
-        WHERE is_approved = 0 AND is_admin = 0 
-        ORDER BY created_at DESC
-    ''').fetchall()
+    pending, pending_cursor = admin_users.fetch_users(
+        db, pending=True, cursor=request.args.get('pending_cursor'), page_size=page_size)
     
     # Get all users
-    all_users = db.execute('''
-        SELECT * FROM users 
-        WHERE is_admin = 0 
-        ORDER BY created_at DESC
-    ''').fetchall()
-    
-    db.close()
+    all_users, next_cursor = admin_users.fetch_users(
+        db, query=query, cursor=request.args.get('cursor'), page_size=page_size)
     
     return render_template('admin_dashboard.html', 
                          user=user,
-                         total_users=total_users,
-                         pending_users=pending_users,
-                         total_bills=total_bills,
+                         total_users=stats['total_users'],
+                         pending_users=stats['pending_users'],
+                         total_bills=stats['total_bills'],
                          pending=pending,
-                         all_users=all_users)
+                         pending_cursor=pending_cursor,
+                         all_users=all_users,
+                         next_cursor=next_cursor,
+                         query=query,
+                         is_first_page=not request.args.get('cursor'),
+                         is_first_pending_page=not request.args.get('pending_cursor'),
+                         per_page=page_size)
 
-@app.route('/admin/approve/<int:user_id>')
+@route('/admin/users/bulk', methods=['POST'])
+@admin_required
+def bulk_user_action():
+    admin = get_current_user()
+    action = request.form.get('action', '')
+    if action not in admin_users.BULK_ACTIONS:
+        flash('Unknown bulk action', 'error')
+        return redirect(url_for('admin_dashboard'))
+    
+    try:
+        user_ids = [int(user_id) for user_id in request.form.getlist('user_ids')]
+    except ValueError:
+        flash('Invalid user selection', 'error')
+        return redirect(url_for('admin_dashboard'))
+    
+    if not user_ids:
+        flash('No users selected', 'warning')
+        return redirect(url_for('admin_dashboard'))
+    
+    changed = admin_users.bulk_update(get_db(), action, user_ids, admin['id'], datetime.now())
+    past_tense = {'approve': 'approved', 'deactivate': 'deactivated', 'activate': 'activated'}[action]
+    skipped = len(set(user_ids)) - len(changed)
+    message = f"{len(changed)} user(s) {past_tense}"
+    if skipped:
+        message += f", {skipped} skipped"
+    flash(message, 'success')
+    return redirect(url_for('admin_dashboard'))
+
+@route('/admin/approve/<int:user_id>')
 @admin_required
 def approve_user(user_id):
     admin = get_current_user()
@@ -521,13 +761,14 @@ def approve_user(user_id):
             SET is_approved = 1, approved_at = ?, approved_by = ?
             WHERE id = ?
         ''', (datetime.now(), admin['id'], user_id))
+        bump_user_version(db, user_id)
         db.commit()
+        admin_users.stats_cache.invalidate()
         flash(f"User {user['email']} has been approved", 'success')
     
-    db.close()
     return redirect(url_for('admin_dashboard'))
 
-@app.route('/admin/reject/<int:user_id>')
+@route('/admin/reject/<int:user_id>')
 @admin_required
 def reject_user(user_id):
     db = get_db()
@@ -537,13 +778,14 @@ def reject_user(user_id):
         flash('User not found', 'error')
     else:
         db.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        bump_user_version(db, user_id, deleted=True)
         db.commit()
+        admin_users.stats_cache.invalidate()
         flash(f"User {user['email']} has been rejected and removed", 'info')
     
-    db.close()
     return redirect(url_for('admin_dashboard'))
 
-@app.route('/admin/toggle-active/<int:user_id>')
+@route('/admin/toggle-active/<int:user_id>')
 @admin_required
 def toggle_user_active(user_id):
     db = get_db()
@@ -554,14 +796,14 @@ def toggle_user_active(user_id):
     else:
         new_status = 0 if user['is_active'] else 1
         db.execute('UPDATE users SET is_active = ? WHERE id = ?', (new_status, user_id))
+        bump_user_version(db, user_id)
         db.commit()
         status_text = 'activated' if new_status else 'deactivated'
         flash(f"User {user['email']} has been {status_text}", 'success')
     
-    db.close()
     return redirect(url_for('admin_dashboard'))
 
-@app.route('/admin/delete-user/<int:user_id>')
+@route('/admin/delete-user/<int:user_id>')
 @admin_required
 def delete_user(user_id):
     db = get_db()
@@ -572,17 +814,85 @@ def delete_user(user_id):
     elif user['is_admin']:
         flash('Cannot delete admin account', 'error')
     else:
-        # Delete associated data
-        db.execute('DELETE FROM bills WHERE user_id = ?', (user_id,))
-        db.execute('DELETE FROM templates WHERE user_id = ?', (user_id,))
+        # The account and its tokens go at once; the purge_user job deletes
+        # the bills and templates (user ids are never reused)
+        db.execute('DELETE FROM api_tokens WHERE user_id = ?', (user_id,))
         db.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        bump_user_version(db, user_id, deleted=True)
+        jobs.enqueue(db, 'purge_user', {'user_id': user_id}, user_id=get_current_user()['id'],
+                     priority=jobs.PRIORITY_LOW)
         db.commit()
-        flash(f"User {user['email']} and all their data permanently deleted", 'success')
+        admin_users.stats_cache.invalidate()
+        flash(f"User {user['email']} permanently deleted; their data is being removed in the background",
+              'success')
     
-    db.close()
     return redirect(url_for('admin_dashboard'))
 
-@app.route('/admin/profile', methods=['GET', 'POST'])
+@route('/metrics')
+def metrics_endpoint():
+    # Scrapers send an admin's API token; browsers use the admin session
+    if 'Authorization' in request.headers:
+        user, error = authenticate_token()
+        if error:
+            return error
+    else:
+        user = get_current_user()
+    if not user or not user['is_admin']:
+        return api_error('Admin access required', 403)
+    return current_app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@route('/admin/profiles')
+@admin_required
+def admin_profiles():
+    profiles = profiling.list_profiles(current_app.config['PROFILE_FOLDER'])
+    return render_template('admin_profiles.html', profiles=profiles,
+                           sample_rate=current_app.config['PROFILE_SAMPLE_RATE'], keep=current_app.config['PROFILE_KEEP'])
+
+@route('/admin/profiles/<profile_id>')
+@admin_required
+def admin_profile_detail(profile_id):
+    folder = current_app.config['PROFILE_FOLDER']
+    profile = profiling.get_profile(folder, profile_id)
+    if not profile:
+        flash('Profile not found; it may have been rotated out', 'warning')
+        return redirect(url_for('admin_profiles'))
+    sort = request.args.get('sort')
+    if sort not in profiling.SORT_KEYS:
+        sort = profiling.SORT_KEYS[0]
+    report = profiling.top_functions(folder, profile_id, sort)
+    return render_template('admin_profile_detail.html', profile=profile, report=report, sort=sort,
+                           sort_keys=profiling.SORT_KEYS)
+
+@route('/admin/profiles/<profile_id>/download/<kind>')
+@admin_required
+def download_profile(profile_id, kind):
+    if kind not in ('pstats', 'collapsed') or not profiling.get_profile(current_app.config['PROFILE_FOLDER'], profile_id):
+        return redirect(url_for('admin_profiles'))
+    return send_from_directory(current_app.config['PROFILE_FOLDER'], f'{profile_id}.{kind}', as_attachment=True,
+                               mimetype='text/plain' if kind == 'collapsed' else 'application/octet-stream')
+
+@route('/admin/jobs')
+@admin_required
+def admin_jobs():
+    status = request.args.get('status')
+    if status not in jobs.STATUSES:
+        status = None
+    db = get_db()
+    return render_template('admin_jobs.html', counts=jobs.summary(db), recent=jobs.recent_jobs(db, status),
+                           status=status, statuses=jobs.STATUSES, workers=current_app.config['JOB_WORKERS'])
+
+@route('/admin/jobs/<int:job_id>/retry', methods=['POST'])
+@admin_required
+def retry_job(job_id):
+    db = get_db()
+    if jobs.retry(db, job_id):
+        db.commit()
+        flash(f'Job {job_id} queued again', 'success')
+    else:
+        flash('Only failed jobs can be retried', 'error')
+    return redirect(url_for('admin_jobs', status=request.args.get('status')))
+
+@route('/admin/profile', methods=['GET', 'POST'])
 @admin_required
 def admin_profile():
     user = get_current_user()
@@ -597,7 +907,6 @@ def admin_profile():
         # Verify current password
         if not check_password_hash(user['password_hash'], current_password):
             flash('Current password is incorrect', 'error')
-            db.close()
             return render_template('admin_profile.html', user=user)
         
         # Validate new email
@@ -606,7 +915,6 @@ def admin_profile():
                                  (new_email, user['id'])).fetchone()
             if existing:
                 flash('Email already in use by another user', 'error')
-                db.close()
                 return render_template('admin_profile.html', user=user)
         
         # Update email
@@ -618,12 +926,10 @@ def admin_profile():
         if new_password:
             if len(new_password) < 6:
                 flash('Password must be at least 6 characters', 'error')
-                db.close()
                 return render_template('admin_profile.html', user=user)
             
             if new_password != confirm_password:
                 flash('New passwords do not match', 'error')
-                db.close()
                 return render_template('admin_profile.html', user=user)
             
             password_hash = generate_password_hash(new_password)
@@ -631,8 +937,8 @@ def admin_profile():
                       (password_hash, user['id']))
             flash('Password updated successfully', 'success')
         
+        bump_user_version(db, user['id'])
         db.commit()
-        db.close()
         
         # If email changed, update session and redirect to login
         if new_email != user['email']:
@@ -642,21 +948,465 @@ def admin_profile():
         
         return redirect(url_for('admin_profile'))
     
-    db.close()
     return render_template('admin_profile.html', user=user)
 
 # ============================================
 # API Routes
 # ============================================
 
-@app.route('/api/verify-gst', methods=['POST'])
+@route('/api/history')
+@login_required
+def api_history():
+    user = get_current_user()
+    db = get_db()
+    filters = bill_history.parse_filters(request.args)
+    page_size = bill_history.parse_page_size(request.args.get('per_page'),
+                                             current_app.config['HISTORY_PAGE_SIZE'])
+    bills, next_cursor = bill_history.fetch_page(db, user['id'], filters,
+                                                 request.args.get('cursor'), page_size)
+    return jsonify({
+        'bills': [bill_history.row_to_dict(bill) for bill in bills],
+        'next_cursor': next_cursor,
+        'page_size': page_size,
+    })
+
+@route('/api/bills/search')
+@login_required
+def api_search_bills():
+    user = get_current_user()
+    db = get_db()
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+    filters = bill_history.parse_filters(request.args)
+    page = bill_search.parse_page(request.args.get('page'))
+    page_size = bill_history.parse_page_size(request.args.get('per_page'),
+                                             bill_search.DEFAULT_PAGE_SIZE)
+    bills, next_page = bill_search.search(db, user['id'], query, filters, page, page_size,
+                                          noise=current_app.config['BILL_NUMBER_PREFIX'])
+    return jsonify({
+        'query': query,
+        'bills': [bill_history.row_to_dict(bill) for bill in bills],
+        'page': page,
+        'next_page': next_page,
+        'page_size': page_size,
+    })
+
+@route('/api/archives/<job_id>')
+@login_required
+def api_archive_status(job_id):
+    user = get_current_user()
+    job = bill_archive.get_job(get_db(), job_id, user['id'])
+    if not job:
+        return jsonify({'error': 'Archive not found'}), 404
+    return jsonify({
+        'id': job['id'],
+        'status': job['status'],
+        'total': job['total'],
+        'done': job['done'],
+        'percent': job['percent'],
+        'error': job['error'],
+        'download_url': url_for('download_archive', job_id=job_id) if job['status'] == bill_archive.DONE else None,
+    })
+
+@route('/api/jobs/<int:job_id>')
+@login_required
+def api_job_status(job_id):
+    user = get_current_user()
+    # Admins may poll any job, e.g. the purge of a user they deleted
+    job = jobs.get_job(get_db(), job_id, None if user['is_admin'] else user['id'])
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@route('/api/bills/bulk', methods=['POST'])
+@login_required
+def api_bulk_import_bills():
+    user = get_current_user()
+    db = get_db()
+    template = db.execute('SELECT * FROM templates WHERE user_id = ? ORDER BY id DESC LIMIT 1', 
+                         (user['id'],)).fetchone()
+    if not template:
+        return jsonify({'error': 'Create a business template before importing bills'}), 400
+    
+    # Accept an uploaded file or a raw CSV / JSON lines body
+    upload = request.files.get('file')
+    if upload:
+        text = upload.read().decode('utf-8-sig', errors='replace')
+        filename = upload.filename or ''
+    else:
+        text = request.get_data(as_text=True)
+        filename = ''
+    
+    fmt = request.args.get('format')
+    if not fmt:
+        is_csv = request.mimetype == 'text/csv' or filename.lower().endswith('.csv')
+        fmt = 'csv' if is_csv else 'jsonl'
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'error': 'format must be csv or jsonl'}), 400
+    
+    records = billing.parse_csv(text) if fmt == 'csv' else billing.parse_jsonl(text)
+    result = billing.import_bills(db, user['id'], template['id'], records,
+                                  billing.BillNumbering.from_config(current_app.config))
+    status = 201 if result['created'] else 400
+    return jsonify(result), status
+
+@route('/api/reports/sales')
+@login_required
+def api_sales_report():
+    user = get_current_user()
+    db = get_db()
+    months = reports.monthly_sales(db, user['id'],
+                                   reports.parse_month(request.args.get('month_from')),
+                                   reports.parse_month(request.args.get('month_to')))
+    return jsonify({'months': months})
+
+@route('/api/reports/items')
+@login_required
+def api_item_report():
+    user = get_current_user()
+    db = get_db()
+    filters = bill_history.parse_filters(request.args)
+    limit = bill_history.parse_page_size(request.args.get('limit'), 20)
+    name = request.args.get('name', '').strip()
+    if name:
+        return jsonify(reports.item_sales(db, user['id'], name, filters['date_from'], filters['date_to']))
+    return jsonify({'items': reports.top_items(db, user['id'], filters['date_from'],
+                                               filters['date_to'], limit)})
+
+@route('/api/verify-gst', methods=['POST'])
 def api_verify_gst():
-    data = request.get_json()
-    gst_number = data.get('gst_number', '').strip().upper()
+    data = request.get_json(silent=True) or {}
+    gst_number = str(data.get('gst_number') or '').strip().upper()
     
-    result = verify_gst(gst_number)
+    result = check_gst(gst_number)
     return jsonify(result)
 
+# ============================================
+# API v1 (token authenticated)
+# ============================================
+
+def api_response(payload, status=200, headers=None):
+    """JSON response with an ETag, answered with 304 when the client's copy is current"""
+    response = jsonify(payload)
+    response.status_code = status
+    response.headers.extend(headers or {})
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    if status == 200:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+def next_link(cursor):
+    """Link header for the next page of the current request, or no headers"""
+    if not cursor:
+        return {}
+    args = request.args.to_dict()
+    args['cursor'] = cursor
+    return {'Link': f'<{url_for(request.endpoint, _external=True, **args)}>; rel="next"'}
+
+def api_json_body():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise api_v1.ApiError('Request body must be a JSON object')
+    return data
+
+def upload_url(filename):
+    return url_for('uploaded_file', filename=filename, _external=True)
+
+def handle_api_error(e):
+    return api_error(str(e), e.status)
+
+@route('/api/v1/templates')
+@token_required
+def api_v1_list_templates():
+    page_size = bill_history.parse_page_size(request.args.get('per_page'), 20)
+    rows, next_cursor = api_v1.fetch_templates(get_db(), g.api_user['id'],
+                                               api_v1.parse_id_cursor(request.args.get('cursor')), page_size)
+    return api_response({
+        'templates': [api_v1.template_to_dict(row, upload_url) for row in rows],
+        'next_cursor': next_cursor,
+        'page_size': page_size,
+    }, headers=next_link(next_cursor))
+
+@route('/api/v1/templates', methods=['POST'])
+@token_required
+def api_v1_create_template():
+    user = g.api_user
+    db = get_db()
+    fields = api_v1.prepare_template(api_json_body())
+    # A new template becomes the one new bills use; bills keep the template
+    # they were created with, and images carry over from the current one
+    current = db.execute('SELECT * FROM templates WHERE user_id = ? ORDER BY id DESC LIMIT 1',
+                         (user['id'],)).fetchone()
+    images = {column: current[column] if current else None
+              for column in ('logo_path', 'signature_path', 'stamp_upload_path', 'stamp_path')}
+    columns = {**fields, **images}
+    row = db.execute(f"""
+        INSERT INTO templates (user_id, {', '.join(columns)})
+        VALUES (?, {', '.join('?' * len(columns))})
+        RETURNING *
+    """, (user['id'], *columns.values())).fetchone()
+    db.commit()
+    return api_response(api_v1.template_to_dict(row, upload_url), 201,
+                        {'Location': url_for('api_v1_get_template', template_id=row['id'])})
+
+@route('/api/v1/templates/<int:template_id>')
+@token_required
+def api_v1_get_template(template_id):
+    row = get_db().execute('SELECT * FROM templates WHERE id = ? AND user_id = ?',
+                           (template_id, g.api_user['id'])).fetchone()
+    if not row:
+        raise api_v1.ApiError('Template not found', 404)
+    return api_response(api_v1.template_to_dict(row, upload_url))
+
+@route('/api/v1/bills')
+@token_required
+def api_v1_list_bills():
+    filters = bill_history.parse_filters(request.args)
+    page_size = bill_history.parse_page_size(request.args.get('per_page'),
+                                             current_app.config['HISTORY_PAGE_SIZE'])
+    rows, next_cursor = bill_history.fetch_page(get_db(), g.api_user['id'], filters,
+                                                request.args.get('cursor'), page_size)
+    return api_response({
+        'bills': [api_v1.summary_to_dict(row) for row in rows],
+        'next_cursor': next_cursor,
+        'page_size': page_size,
+    }, headers=next_link(next_cursor))
+
+@route('/api/v1/bills', methods=['POST'])
+@token_required
+def api_v1_create_bill():
+    user = g.api_user
+    db = get_db()
+    data = api_json_body()
+    if data.get('template_id') is not None:
+        template = db.execute('SELECT id FROM templates WHERE id = ? AND user_id = ?',
+                              (data['template_id'], user['id'])).fetchone()
+        if not template:
+            raise api_v1.ApiError('Template not found', 404)
+    else:
+        template = db.execute('SELECT id FROM templates WHERE user_id = ? ORDER BY id DESC LIMIT 1',
+                              (user['id'],)).fetchone()
+        if not template:
+            raise api_v1.ApiError('Create a business template before creating bills')
+    try:
+        bill_id, _bill_number = billing.create_bill(db, user['id'], template['id'], data,
+                                                    billing.BillNumbering.from_config(current_app.config))
+    except billing.BillError as e:
+        raise api_v1.ApiError(str(e))
+    bill = api_v1.fetch_bills(db, user['id'], [bill_id])[bill_id]
+    return api_response(api_v1.bill_to_dict(bill), 201,
+                        {'Location': url_for('api_v1_get_bill', bill_id=bill_id)})
+
+@route('/api/v1/bills/<int:bill_id>')
+@token_required
+def api_v1_get_bill(bill_id):
+    bill = api_v1.fetch_bills(get_db(), g.api_user['id'], [bill_id]).get(bill_id)
+    if not bill:
+        raise api_v1.ApiError('Bill not found', 404)
+    return api_response(api_v1.bill_to_dict(bill))
+
+@route('/api/v1/bills/batch')
+@token_required
+def api_v1_batch_bills():
+    bill_ids = api_v1.parse_ids(request.args.get('ids'))
+    found = api_v1.fetch_bills(get_db(), g.api_user['id'], bill_ids)
+    return api_response({
+        'bills': [api_v1.bill_to_dict(found[bill_id]) for bill_id in bill_ids if bill_id in found],
+        'missing': [bill_id for bill_id in bill_ids if bill_id not in found],
+    })
+
+@route('/api/v1/jobs/<int:job_id>')
+@token_required
+def api_v1_get_job(job_id):
+    job = jobs.get_job(get_db(), job_id, g.api_user['id'])
+    if not job:
+        raise api_v1.ApiError('Job not found', 404)
+    return api_response(job)
+
+# ============================================
+# CLI Commands
+# ============================================
+
+@commands.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations"""
+    db = get_db()
+    applied = migrations.migrate(db, log=print)
+    print(f"Schema at version {migrations.get_version(db)} ({len(applied)} applied)")
+
+@commands.command('init-db')
+def init_db_command():
+    """Apply pending migrations and create the default admin account"""
+    init_db()
+    print(f"Schema at version {migrations.get_version(get_db())}")
+
+@commands.command('explain-queries')
+def explain_queries_command():
+    """Print EXPLAIN QUERY PLAN for every query in the app and flag full scans"""
+    db = get_db()
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    # Registered samples first (dynamic and hot queries, with real values),
+    # then every other literal query with NULL parameters
+    queries = migrations.sample_queries(db)
+    for name in sorted(os.listdir(app_dir)):
+        if name.endswith('.py') and name != 'migrations.py':
+            queries += [(f"{name}:{lineno}", sql, None)
+                        for lineno, sql in migrations.collect_queries(os.path.join(app_dir, name))]
+    flagged = 0
+    for location, sql, plan, warnings in migrations.explain_queries(db, queries):
+        print(f"{location}: {sql}")
+        for line in plan:
+            marker = '  !! ' if line in warnings else '     '
+            print(f"{marker}{line}")
+        flagged += bool(warnings)
+    print(f"{len(queries)} queries, {flagged} with full scans or temp sorts")
+
+@commands.command('import-bills')
+@click.argument('email')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Input format (default: from the file extension)')
+def import_bills_command(email, path, fmt):
+    """Bulk import bills for a user from a CSV or JSON lines file"""
+    db = get_db()
+    user = db.execute('SELECT id FROM users WHERE email = ?', (email.strip().lower(),)).fetchone()
+    if not user:
+        raise click.ClickException(f'No user with email {email}')
+    template = db.execute('SELECT id FROM templates WHERE user_id = ? ORDER BY id DESC LIMIT 1', 
+                         (user['id'],)).fetchone()
+    if not template:
+        raise click.ClickException(f'{email} has no business template yet')
+    
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    with open(path, encoding='utf-8-sig') as f:
+        text = f.read()
+    
+    started = time.perf_counter()
+    records = billing.parse_csv(text) if fmt == 'csv' else billing.parse_jsonl(text)
+    result = billing.import_bills(db, user['id'], template['id'], records,
+                                  billing.BillNumbering.from_config(current_app.config))
+    elapsed = time.perf_counter() - started
+    
+    for error in result['errors']:
+        print(f"row {error['row']}: {error['error']}")
+    if result['created']:
+        numbers = ', '.join(f'{first} to {last}' for first, last in result['bill_number_ranges'])
+        print(f"Imported {result['created']} bills ({numbers}) in {elapsed:.2f}s "
+              f"({result['created'] / elapsed:.0f} bills/s)")
+    print(f"{len(result['errors'])} rows rejected")
+
+@commands.command('backfill-bill-items')
+@click.option('--batch-size', default=1000, show_default=True)
+def backfill_bill_items_command(batch_size):
+    """Populate bill_items from items_json for existing bills (resumable)"""
+    processed = billing.backfill_bill_items(get_db(), batch_size, log=print)
+    print(f"Processed {processed} bills")
+
+@commands.command('rebuild-rollups')
+@click.option('--check', is_flag=True, help='Only report differences, do not rebuild')
+def rebuild_rollups_command(check):
+    """Verify or recompute sales_rollups from the bills table"""
+    db = get_db()
+    discrepancies = reports.rollup_discrepancies(db)
+    for row in discrepancies:
+        print(f"user {row['user_id']} {row['month']} @ {row['gst_percentage']}%: "
+              f"rollup {row['rollup_bills']} bills / {row['rollup_total']}, "
+              f"bills table {row['expected_bills']} bills / {row['expected_total']}")
+    print(f"{len(discrepancies)} rollup rows out of date")
+    if not check:
+        reports.rebuild_rollups(db)
+        print("Rebuilt sales_rollups")
+
+@commands.command('create-api-token')
+@click.argument('email')
+@click.option('--name', default='API token', show_default=True, help='Label shown on the API tokens page')
+def create_api_token_command(email, name):
+    """Issue an API token for a user and print it (only its hash is stored)"""
+    db = get_db()
+    user = db.execute('SELECT id FROM users WHERE email = ?', (email.strip().lower(),)).fetchone()
+    if not user:
+        raise click.ClickException(f'No user with email {email}')
+    _token_id, token = create_api_token(db, user['id'], name)
+    db.commit()
+    print(token)
+
+@commands.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Recompute the bills_fts full-text index from the bills table"""
+    started = time.perf_counter()
+    bill_search.rebuild_index(get_db())
+    print(f"Rebuilt and optimized bills_fts in {time.perf_counter() - started:.2f}s")
+
+@commands.command('normalize-uploads')
+def normalize_uploads_command():
+    """Re-store legacy template uploads in the normalized, content-addressed form"""
+    rewritten = uploads.normalize_existing(get_db(), current_app.config['UPLOAD_FOLDER'],
+                                           current_app.config['UPLOAD_SCALE'], log=print)
+    print(f"Rewrote {rewritten} template references; run gc-uploads to remove the originals")
+
+@commands.command('gc-uploads')
+@click.option('--dry-run', is_flag=True, help='List unreferenced files without deleting them')
+@click.option('--min-age', default=3600, show_default=True,
+              help='Keep files modified within this many seconds')
+def gc_uploads_command(dry_run, min_age):
+    """Delete upload files that no template references"""
+    removed, freed = uploads.collect_garbage(get_db(), current_app.config['UPLOAD_FOLDER'], min_age, dry_run)
+    for name in removed:
+        print(name)
+    verb = 'Would remove' if dry_run else 'Removed'
+    print(f"{verb} {len(removed)} files ({freed / 1024:.0f} KB)")
+
+@commands.command('run-jobs')
+@click.option('--workers', type=int, help='Worker threads (default: JOB_WORKERS)')
+@click.option('--once', is_flag=True, help='Run the jobs that are due now, then exit')
+def run_jobs_command(workers, once):
+    """Run background jobs in this process until interrupted (Ctrl+C or SIGTERM)"""
+    if once:
+        outcomes = jobs.run_pending()
+        print(', '.join(f'{count} {outcome}' for outcome, count in outcomes.items()) or 'No jobs due')
+        return
+    workers = workers or current_app.config['JOB_WORKERS'] or jobs.DEFAULT_WORKERS
+    print(f'Running jobs with {workers} worker thread(s)')
+    unfinished = jobs.serve(current_app._get_current_object(), workers)
+    if unfinished:
+        print(f"Stopped; job(s) {', '.join(map(str, unfinished))} will be retried when their lease expires")
+
+@commands.command('reverify-gst')
+@click.option('--url', help='Verification API URL (default: GST_API_URL)')
+@click.option('--workers', default=8, show_default=True, help='Concurrent requests')
+@click.option('--batch-size', default=200, show_default=True, help='Users per write-back transaction')
+@click.option('--email', 'emails', multiple=True, help='Only re-verify these users (repeatable)')
+def reverify_gst_command(url, workers, batch_size, emails):
+    """Re-verify every stored GST number and update users.gst_verified"""
+    if url:
+        client = GSTClient(url, current_app.config['GST_API_KEY'], timeout=current_app.config['GST_API_TIMEOUT'],
+                           pool_size=workers)
+    else:
+        client = gst_client()
+    if client is None:
+        raise click.ClickException('Set GST_API_URL or pass --url')
+    
+    db = get_db()
+    user_ids = None
+    if emails:
+        rows = db.execute(f"SELECT id FROM users WHERE email IN ({', '.join('?' * len(emails))})",
+                          [email.strip().lower() for email in emails]).fetchall()
+        user_ids = [row['id'] for row in rows]
+    
+    stats = gst_reverify.reverify_users(db, client, workers, batch_size, user_ids, log=print)
+    print(f"{stats['checked']} checked ({stats['invalid_offline']} malformed, {stats['verified']} verified, "
+          f"{stats['rejected']} rejected, {stats['skipped']} skipped), {stats['updated']} updated")
+    print(f"{stats['throughput']:.0f} numbers/s; latency p50 {stats['p50_ms']:.1f} ms, "
+          f"p95 {stats['p95_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms")
+
+# For WSGI servers and `flask run`: app:app (or app:create_app())
+app = create_app()
+
 if __name__ == '__main__':
+    with app.app_context():
+        init_db()
     app.run(debug=True, host='0.0.0.0', port=5000)
 
@@ -1,15 +1,139 @@
 """
 Authentication and authorization utilities for the invoice generator
 """
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from functools import wraps
-from flask import session, redirect, url_for, flash
-import sqlite3
+from flask import session, redirect, url_for, flash, g, request, jsonify
+from database import get_db
+
+_MISSING = object()
+
+
+class UserCache:
+    """
+    Small TTL/LRU cache of user rows shared across requests
+    Entries carry the row's users.version; invalidate() raises the minimum
+    accepted version so a row read before an admin change can never be
+    cached after it. Changes made by other processes are picked up through
+    the shared users stamp (see sync()).
+    """
+
+    def __init__(self, max_size=1024, ttl=10):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._min_versions = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def sync(self, stamp):
+        """
+        Start over if the users stamp moved since the last call
+        Every version bump or delete commits a new stamp, so once it is seen
+        the cached rows and version floors before it are all obsolete.
+        """
+        with self._lock:
+            if stamp != self._stamp:
+                self._entries.clear()
+                self._min_versions.clear()
+                self._stamp = stamp
+
+    def get(self, user_id):
+        """Return a cached user row or None"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user, stamp=None):
+        """Cache a user row unless it predates the last invalidation or stamp change"""
+        with self._lock:
+            if stamp is not None and stamp != self._stamp:
+                return
+            if user['version'] < self._min_versions.get(user['id'], 0):
+                return
+            self._entries[user['id']] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user['id'])
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id, version=None):
+        """Drop a cached user; rows older than version are never re-cached"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+            if version is not None:
+                self._min_versions[user_id] = version
+                # Floors are dropped at the next stamp change; this only
+                # bounds them if that never comes (no requests in between)
+                while len(self._min_versions) > self.max_size:
+                    del self._min_versions[next(iter(self._min_versions))]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._min_versions.clear()
+            self._stamp = None
+
+
+user_cache = UserCache()
+
+
+def init_app(app):
+    user_cache.ttl = app.config['USER_CACHE_TTL']
+
+
+def users_stamp(db):
+    """The shared counter bumped by every users.version change or delete"""
+    return db.execute("SELECT value FROM cache_stamps WHERE name = 'users'").fetchone()[0]
+
+
+def load_user(user_id):
+    """Load a user row, memoized for the request and cached across requests"""
+    cached = g.get('current_user', _MISSING)
+    if cached is not _MISSING and g.get('current_user_id') == user_id:
+        return cached
+
+    # One primary-key read per request tells whether any process changed a
+    # user since this one last looked; read it before the row so a change
+    # committed in between is caught by the next request
+    db = get_db()
+    stamp = users_stamp(db)
+    user_cache.sync(stamp)
+    user = user_cache.get(user_id)
+    if user is None:
+        user = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+        if user:
+            user_cache.put(user, stamp)
+
+    g.current_user_id = user_id
+    g.current_user = user
+    return user
+
+
+def bump_user_version(db, user_id, deleted=False):
+    """
+    Increment a user's version so cached copies are discarded
+    Call inside the transaction that changes the user, before commit.
+    """
+    if deleted:
+        user_cache.invalidate(user_id, float('inf'))
+        return
+    row = db.execute('UPDATE users SET version = version + 1 WHERE id = ? RETURNING version',
+                     (user_id,)).fetchone()
+    user_cache.invalidate(user_id, row['version'] if row else None)
 
-def get_db():
-    """Get database connection"""
-    db = sqlite3.connect('invoice.db')
-    db.row_factory = sqlite3.Row
-    return db
 
 def login_required(f):
     """Decorator to require login for routes"""
@@ -18,25 +142,23 @@ def login_required(f):
         if 'user_id' not in session:
             flash('Please login to access this page', 'warning')
             return redirect(url_for('login'))
-        
+
         # Check if user is approved
-        db = get_db()
-        user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-        db.close()
-        
+        user = load_user(session['user_id'])
+
         if not user:
             session.clear()
             flash('User not found', 'error')
             return redirect(url_for('login'))
-        
+
         if not user['is_approved']:
             return redirect(url_for('pending_approval'))
-        
+
         if not user['is_active']:
             session.clear()
             flash('Your account has been deactivated', 'error')
             return redirect(url_for('login'))
-        
+
         return f(*args, **kwargs)
     return decorated_function
 
@@ -47,15 +169,13 @@ def admin_required(f):
         if 'user_id' not in session:
             flash('Please login to access this page', 'warning')
             return redirect(url_for('login'))
-        
-        db = get_db()
-        user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-        db.close()
-        
+
+        user = load_user(session['user_id'])
+
         if not user or not user['is_admin']:
             flash('Admin access required', 'error')
             return redirect(url_for('index'))
-        
+
         return f(*args, **kwargs)
     return decorated_function
 
@@ -63,8 +183,93 @@ def get_current_user():
     """Get current logged in user"""
     if 'user_id' not in session:
         return None
-    
+
+    return load_user(session['user_id'])
+
+
+# ============================================
+# API tokens
+# ============================================
+
+API_TOKEN_PREFIX = 'igt_'
+
+# last_used_at is only rewritten when it is older than this, so busy
+# integrations do not turn every read into a database write
+TOKEN_TOUCH_INTERVAL = timedelta(seconds=60)
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_api_token(db, user_id, name):
+    """
+    Issue a new API token for a user and return (token_id, token)
+    Only the token's hash is stored, so it cannot be shown again. The
+    caller commits.
+    """
+    token = API_TOKEN_PREFIX + secrets.token_urlsafe(32)
+    row = db.execute('''
+        INSERT INTO api_tokens (user_id, name, token_hash, prefix)
+        VALUES (?, ?, ?, ?)
+        RETURNING id
+    ''', (user_id, name, hash_token(token), token[:len(API_TOKEN_PREFIX) + 6])).fetchone()
+    return row['id'], token
+
+
+def revoke_api_token(db, user_id, token_id):
+    """Delete one of a user's tokens; returns False if it was not theirs. The caller commits."""
+    return db.execute('DELETE FROM api_tokens WHERE id = ? AND user_id = ?',
+                      (token_id, user_id)).rowcount > 0
+
+
+def api_error(message, status):
+    """JSON error response for API routes"""
+    response = jsonify({'error': message})
+    response.status_code = status
+    if status == 401:
+        response.headers['WWW-Authenticate'] = 'Bearer realm="api"'
+    return response
+
+
+def authenticate_token():
+    """
+    Check the request's Authorization: Bearer token
+    Returns (user, None) on success or (None, error_response).
+    """
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    token = token.strip()
+    if scheme.lower() != 'bearer' or not token:
+        return None, api_error('A bearer API token is required', 401)
+
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    db.close()
-    return user
+    row = db.execute('SELECT id, user_id, last_used_at FROM api_tokens WHERE token_hash = ?',
+                     (hash_token(token),)).fetchone()
+    if row is None:
+        return None, api_error('Invalid API token', 401)
+
+    user = load_user(row['user_id'])
+    if not user or not user['is_approved'] or not user['is_active']:
+        return None, api_error('This account cannot use the API', 403)
+
+    now = datetime.utcnow().replace(microsecond=0)
+    if not row['last_used_at'] or datetime.fromisoformat(row['last_used_at']) < now - TOKEN_TOUCH_INTERVAL:
+        db.execute('UPDATE api_tokens SET last_used_at = ? WHERE id = ?',
+                   (now.isoformat(' '), row['id']))
+        db.commit()
+    return user, None
+
+
+def token_required(f):
+    """
+    Decorator for API routes authenticated by an Authorization: Bearer token
+    Sets g.api_user; failures are JSON errors rather than login redirects.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user, error = authenticate_token()
+        if error:
+            return error
+        g.api_user = user
+        return f(*args, **kwargs)
+    return decorated_function
@@ -0,0 +1,70 @@
+"""
+Bulk PDF archive benchmark
+Seeds one user with synthetic bills (seed_data.seed()) and builds the same
+archive with bill_archive.build_archive() on process pools of different
+sizes, after a single-process baseline that renders and zips the bills
+inline.
+
+Usage: python benchmarks/bench_archive.py [--bills 2000] [--workers 1 2 4]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bill_archive
+from seed_data import seed
+from pdf_renderer import render_bill_pdf
+
+
+def serial_archive(db, job, folder, upload_folder):
+    """Baseline: render and write each bill in this process"""
+    templates = {row['id']: dict(row) for row in db.execute('SELECT * FROM templates')}
+    names = set()
+    with zipfile.ZipFile(os.path.join(folder, 'serial.zip'), 'w', zipfile.ZIP_STORED) as archive:
+        count = 0
+        for bill in bill_archive._iter_bills(db, job['user_id'], bill_archive._filters(job)):
+            pdf = render_bill_pdf(bill, templates[bill['template_id']], upload_folder=upload_folder)
+            archive.writestr(bill_archive.entry_name(bill, names), pdf)
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--bills', type=int, default=2000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        seed(os.path.join(tmp, 'archive.db'), args.bills, 1).close()
+        db = sqlite3.connect(os.path.join(tmp, 'archive.db'))
+        db.row_factory = sqlite3.Row
+        job = {'id': 'bench', 'user_id': 1, 'date_from': None, 'date_to': None}
+        upload_folder = os.path.join(tmp, 'uploads')
+        print(f'{os.cpu_count()} CPUs\n')
+
+        started = time.perf_counter()
+        count = serial_archive(db, job, tmp, upload_folder)
+        elapsed = time.perf_counter() - started
+        print(f"{'inline':<12} {elapsed:6.2f}s  {count / elapsed:7.0f} bills/s")
+
+        for workers in sorted(set(args.workers)):
+            # Start the pool outside the timing, as a running server would have
+            bill_archive.get_pool(workers).submit(int).result()
+            started = time.perf_counter()
+            count = bill_archive.build_archive(db, job, tmp, upload_folder, workers)
+            elapsed = time.perf_counter() - started
+            size = os.path.getsize(bill_archive.archive_path(tmp, job))
+            print(f"{f'{workers} workers':<12} {elapsed:6.2f}s  {count / elapsed:7.0f} bills/s  "
+                  f"{size / 2 ** 20:6.1f} MiB")
+        bill_archive.shutdown_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Streaming bill export benchmark
+Seeds one user with synthetic bills (seed_data.seed()), then downloads
+/history/export through the Flask test client in each format. Reports time
+to first byte, total time, size and rows per second, and the peak Python
+heap while streaming, measured with tracemalloc in a second pass so it
+stays flat however many rows there are.
+
+Usage: python benchmarks/bench_export.py [--bills 500000] [--database path/to/keep.db]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed_data import seed
+
+VARIANTS = [
+    ('csv', False),
+    ('csv', True),
+    ('xlsx', False),
+    ('xlsx', True),
+]
+
+
+def download(client, fmt, with_items):
+    """Stream one export; returns (first_byte_s, total_s, bytes)"""
+    started = time.perf_counter()
+    response = client.get('/history/export', query_string={'format': fmt, 'items': '1' if with_items else ''},
+                          buffered=False)
+    assert response.status_code == 200, response.status_code
+    first_byte = None
+    size = 0
+    for chunk in response.response:
+        if first_byte is None:
+            first_byte = time.perf_counter() - started
+        size += len(chunk)
+    response.close()
+    return first_byte, time.perf_counter() - started, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--bills', type=int, default=500_000)
+    parser.add_argument('--database', help='seed this file (or reuse it if it exists) instead of a temporary one')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = args.database or os.path.join(tmp, 'export.db')
+        if not os.path.exists(database):
+            seed(database, args.bills, 1).close()
+
+        from app import create_app
+        app = create_app({'DATABASE': database})
+        from database import get_db
+        with app.app_context():
+            bills = get_db().execute('SELECT COUNT(*) FROM bills WHERE user_id = 1').fetchone()[0]
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+        print(f"{bills} bills, chunk size {app.config['EXPORT_CHUNK_SIZE']}\n")
+
+        for fmt, with_items in VARIANTS:
+            first_byte, total, size = download(client, fmt, with_items)
+            tracemalloc.start()
+            download(client, fmt, with_items)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            label = f"{fmt}{' + items' if with_items else ''}"
+            print(f"{label:<12} first byte {first_byte * 1000:6.1f} ms  total {total:6.1f}s  "
+                  f"{size / 2 ** 20:7.1f} MiB  {bills / total:8.0f} bills/s  peak heap {peak / 2 ** 20:5.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Bulk GSTIN re-verification against a local stub service
+Starts a threaded HTTP stub that answers like a GST verification API (valid
+when the check digit matches) after a configurable delay, with an optional
+share of 503 responses. Seeds users into a temporary database, then runs
+gst_reverify.reverify_users() with a single worker and with a pool, and
+finally against a dead port to show the circuit breaker failing fast.
+
+Usage: python benchmarks/bench_gst_reverify.py [--users 500] [--latency-ms 20]
+       [--error-rate 0.05] [--workers 16]
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations
+from gst_verification import GSTIN_CHARSET, GSTClient, CircuitBreaker, gstin_check_digit
+
+
+def make_handler(latency, error_rate):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            threading.Event().wait(random.expovariate(1 / latency) if latency else 0)
+            if random.random() < error_rate:
+                payload, status = b'{"error": "busy"}', 503
+            else:
+                number = json.loads(body)['gst_number']
+                valid = gstin_check_digit(number[:14]) == number[14]
+                payload, status = json.dumps({'valid': valid, 'gst_number': number}).encode(), 200
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return StubHandler
+
+
+def random_gstin(valid=True):
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    first14 = (f'{random.randint(1, 37):02d}' + ''.join(random.choices(letters, k=5))
+               + f'{random.randint(0, 9999):04d}' + random.choice(letters) + '1Z')
+    check = gstin_check_digit(first14)
+    if not valid:
+        check = random.choice([c for c in GSTIN_CHARSET if c != check])
+    return first14 + check
+
+
+def seed(database, users):
+    db = sqlite3.connect(database)
+    db.row_factory = sqlite3.Row
+    migrations.migrate(db)
+    rows = []
+    for i in range(users):
+        roll = random.random()
+        # Mostly valid numbers; a few mistyped (bad check digit) and malformed
+        number = random_gstin() if roll < 0.9 else random_gstin(False) if roll < 0.97 else 'BAD'
+        rows.append((f'user{i}@example.com', '-', f'Biz {i}', 'Addr', 'Owner', '0', number))
+    db.executemany('INSERT INTO users (email, password_hash, business_name, business_address, '
+                   'owner_name, mobile, gst_number, is_approved) VALUES (?, ?, ?, ?, ?, ?, ?, 1)', rows)
+    db.commit()
+    db.close()
+
+
+def run(database, url, workers, label):
+    from app import create_app
+    import gst_reverify
+    from database import get_db
+
+    app = create_app({'DATABASE': database})
+    client = GSTClient(url, timeout=(1, 2), retries=2, backoff=0.05, pool_size=workers,
+                       breaker=CircuitBreaker(failure_threshold=10, reset_timeout=60))
+    with app.app_context():
+        db = get_db()
+        db.execute('UPDATE users SET gst_verified = 0')
+        db.commit()
+        stats = gst_reverify.reverify_users(db, client, workers=workers, batch_size=100)
+        verified = db.execute('SELECT COUNT(*) FROM users WHERE gst_verified = 1').fetchone()[0]
+    client.close()
+    print(f"{label:<22} {stats['throughput']:8.0f}/s  p50 {stats['p50_ms']:7.1f} ms  "
+          f"p95 {stats['p95_ms']:7.1f} ms  p99 {stats['p99_ms']:7.1f} ms  "
+          f"verified {verified}, rejected {stats['rejected']}, malformed {stats['invalid_offline']}, "
+          f"skipped {stats['skipped']}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(args.latency_ms / 1000, args.error_rate))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/verify'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'gst.db')
+        seed(database, args.users)
+        print(f"{args.users} users, stub latency ~{args.latency_ms:g} ms, {args.error_rate:.0%} 503s")
+        run(database, url, 1, '1 worker')
+        run(database, url, args.workers, f'{args.workers} workers')
+        # Nothing listens on port 9: every call fails until the breaker opens
+        stats = run(database, 'http://127.0.0.1:9/verify', args.workers, 'service down')
+        print(f"service down: {stats['elapsed']:.2f}s for {stats['checked']} numbers, all left unchanged")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
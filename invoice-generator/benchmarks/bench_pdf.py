@@ -0,0 +1,95 @@
+"""
+PDF export benchmark
+Compares the server-side vector renderer (pdf_renderer) with the current
+client-side approach, approximated here by rasterizing the same page content
+at html2canvas scale 2 (1588x2246 px per A4 page) and PNG-encoding each page,
+which is what downloadPDF() embeds into jsPDF. Browser layout and
+html2canvas DOM capture are not included, so the raster numbers are a
+lower bound on the client-side cost.
+
+Usage: python benchmarks/bench_pdf.py [--bills 20] [--items 10 40 150]
+"""
+import argparse
+import io
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFont
+import pdf_renderer
+
+RASTER_SCALE = 1588 / pdf_renderer.PAGE_WIDTH
+TEXT_OP = re.compile(rb'/(F\d) ([\d.]+) Tf .*? rg ([\d.-]+) ([\d.-]+) Td \((.*?)\) Tj ET')
+
+
+def sample_bill(item_count):
+    items = [{'name': f'Product {i} - assorted hardware, box of 12', 'quantity': (i % 7) + 1,
+              'rate': 125.5 + i, 'amount': ((i % 7) + 1) * (125.5 + i)} for i in range(item_count)]
+    subtotal = sum(item['amount'] for item in items)
+    bill = {'id': 1, 'bill_number': 'INV-0042', 'customer_name': 'Acme Traders',
+            'customer_mobile': '9876543210', 'customer_address': '14 MG Road, Bengaluru 560001',
+            'items_json': None, 'subtotal': subtotal, 'gst_enabled': 1, 'gst_percentage': 18,
+            'gst_amount': subtotal * 0.18, 'total': subtotal * 1.18, 'bill_date': '2026-03-31',
+            'created_at': '2026-03-31 10:00:00'}
+    template = {'business_name': 'Sri Lakshmi Enterprises', 'business_address': '2nd Cross, Jayanagar, Bengaluru',
+                'owner_name': 'R. Kumar', 'mobile': '9123456780', 'gst_number': '29ABCDE1234F1Z5',
+                'logo_path': None, 'signature_path': None, 'stamp_upload_path': None, 'stamp_path': None,
+                'stamp_type': 'rectangle'}
+    return bill, template, items
+
+
+def raster_pages(pages, fonts):
+    """PNG-encode each laid-out page the way html2canvas + toDataURL would"""
+    sizes = []
+    for page in pages:
+        canvas = Image.new('RGB', (1588, 2246), 'white')
+        draw = ImageDraw.Draw(canvas)
+        for op in page.ops:
+            match = TEXT_OP.match(op)
+            if not match:
+                continue
+            _font, size, x, y, text = match.groups()
+            font = fonts.setdefault(size, ImageFont.load_default(float(size) * RASTER_SCALE))
+            top = (pdf_renderer.PAGE_HEIGHT - float(y) - float(size)) * RASTER_SCALE
+            draw.text((float(x) * RASTER_SCALE, top), text.decode('latin-1'), fill='black', font=font)
+        buf = io.BytesIO()
+        canvas.save(buf, 'PNG')
+        sizes.append(len(buf.getvalue()))
+    return sum(sizes)
+
+
+def run(bills, item_counts):
+    fonts = {}
+    print(f"{'items':>6} {'pages':>6} | {'vector pages/s':>14} {'vector KB':>10} | "
+          f"{'raster pages/s':>14} {'raster KB':>10} | {'size ratio':>10}")
+    for item_count in item_counts:
+        bill, template, items = sample_bill(item_count)
+
+        start = time.perf_counter()
+        for _ in range(bills):
+            pdf = pdf_renderer.render_bill_pdf(bill, template, items)
+        vector_time = time.perf_counter() - start
+        renderer = pdf_renderer.InvoiceRenderer(bill, template, items)
+        pages = renderer.layout()
+
+        raster_runs = max(1, bills // 10)
+        start = time.perf_counter()
+        for _ in range(raster_runs):
+            raster_size = raster_pages(pages, fonts)
+        raster_time = time.perf_counter() - start
+
+        vector_pps = bills * len(pages) / vector_time
+        raster_pps = raster_runs * len(pages) / raster_time
+        print(f"{item_count:>6} {len(pages):>6} | {vector_pps:>14.1f} {len(pdf) / 1024:>10.1f} | "
+              f"{raster_pps:>14.1f} {raster_size / 1024:>10.1f} | {raster_size / len(pdf):>9.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--bills', type=int, default=20)
+    parser.add_argument('--items', type=int, nargs='+', default=[10, 40, 150])
+    args = parser.parse_args()
+    run(args.bills, args.items)
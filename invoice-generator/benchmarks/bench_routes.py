@@ -0,0 +1,420 @@
+"""
+Route latency and load benchmark
+Seeds a database with seed_data.seed() (or reuses one), logs in as seeded
+users and requests the main pages, reporting p50/p95/p99 latency,
+throughput and SQL statements per request for each route. Two drivers:
+
+  client  Flask's test client in this process, one request at a time.
+          SQL statements are counted with a sqlite3 trace callback.
+  http    a threaded local HTTP server in a child process (or --url),
+          driven by --concurrency threads over keep-alive connections.
+
+--save writes the results as a JSON baseline (by default
+benchmarks/baselines/<commit>-<driver>.json); --compare prints the change
+against an earlier baseline and exits with status 1 if p95 latency grew by
+more than --threshold percent or a route issues more SQL statements.
+
+Usage: python benchmarks/bench_routes.py [--driver client|http] [--users 20]
+       [--bills 100000] [--requests 200] [--concurrency 8]
+       [--database path/to/keep.db] [--save [path]] [--compare path]
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from gst_reverify import percentile
+from seed_data import PASSWORD, email_for, random_bill_data, seed
+
+ADMIN_EMAIL = 'admin@invoice.com'
+ADMIN_PASSWORD = 'admin123'
+
+# Route name -> (expected status, build(rng, user) -> (method, path, form, as))
+# where as is 'user', 'admin' or None for an anonymous request
+ROUTES = {
+    'login': (302, lambda rng, user: ('POST', '/login', {'email': user['email'], 'password': PASSWORD}, None)),
+    'index': (200, lambda rng, user: ('GET', '/', None, 'user')),
+    'history': (200, lambda rng, user: ('GET', '/history', None, 'user')),
+    'preview_bill': (200, lambda rng, user: ('GET', f"/bill/preview/{rng.choice(user['bill_ids'])}", None, 'user')),
+    'create_bill': (302, lambda rng, user: ('POST', '/bill/create', bill_form(rng), 'user')),
+    'admin_dashboard': (200, lambda rng, user: ('GET', '/admin/dashboard', None, 'admin')),
+}
+
+
+def bill_form(rng):
+    """A bill as the bill form posts it"""
+    bill = random_bill_data(time.time() - 30 * 86400, 30, rng)
+    return {
+        'customer_name': bill['customer_name'],
+        'customer_mobile': bill['customer_mobile'],
+        'customer_address': bill['customer_address'],
+        'bill_date': bill['bill_date'],
+        'item_name[]': [item['name'] for item in bill['items']],
+        'quantity[]': [item['quantity'] for item in bill['items']],
+        'rate[]': [item['rate'] for item in bill['items']],
+        'gst_enabled': 'on',
+        'gst_percentage': str(bill['gst_percentage']),
+    }
+
+
+def load_users(database, count):
+    """The first count seeded users, with a sample of each one's bill ids"""
+    db = sqlite3.connect(database)
+    db.row_factory = sqlite3.Row
+    rows = db.execute('SELECT id FROM users WHERE is_approved = 1 AND is_admin = 0 AND email LIKE ? '
+                      'ORDER BY id LIMIT ?', ('user%@example.com', count)).fetchall()
+    users = []
+    for row in rows:
+        bill_ids = [r['id'] for r in db.execute('SELECT id FROM bills WHERE user_id = ? ORDER BY random() LIMIT 500',
+                                                (row['id'],))]
+        if bill_ids:
+            users.append({'id': row['id'], 'email': email_for(row['id']), 'bill_ids': bill_ids})
+    db.close()
+    return users
+
+
+def summarize(timings, statements, errors, elapsed):
+    timings.sort()
+    return {
+        'requests': len(timings),
+        'errors': errors,
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(sum(timings) / len(timings), 3) if timings else 0.0,
+        'throughput_rps': round(len(timings) / elapsed, 1) if elapsed else 0.0,
+        'sql_per_request': round(sum(statements) / len(statements), 2) if statements else None,
+        'sql_max': max(statements) if statements else None,
+    }
+
+
+def create_bench_app(database):
+    """The app on the benchmark database, with the default admin created"""
+    from app import create_app, init_db
+    app = create_app({'DATABASE': database})
+    with app.app_context():
+        init_db()
+    return app
+
+
+# ============================================
+# Test client driver
+# ============================================
+
+def run_client(database, users, routes, requests, warmup, rng):
+    app = create_bench_app(database)
+    from database import get_db
+    from flask import request as flask_request
+
+    statements = [0]
+
+    def count_statement(sql):
+        statements[0] += 1
+
+    @app.before_request
+    def trace_statements():
+        if flask_request.endpoint != 'static':
+            get_db().set_trace_callback(count_statement)
+
+    def client_for(email, password):
+        client = app.test_client()
+        response = client.post('/login', data={'email': email, 'password': password})
+        assert response.status_code == 302, f'login as {email} failed ({response.status_code})'
+        return client
+
+    admin = client_for(ADMIN_EMAIL, ADMIN_PASSWORD)
+    user_clients = {user['id']: client_for(user['email'], PASSWORD) for user in users}
+
+    results = {}
+    for route in routes:
+        expected, build = ROUTES[route]
+        timings, counts, errors = [], [], 0
+
+        def one():
+            user = rng.choice(users)
+            method, path, form, as_ = build(rng, user)
+            # Logins need a client without a session, or they just redirect
+            client = (app.test_client() if as_ is None else
+                      admin if as_ == 'admin' else user_clients[user['id']])
+            statements[0] = 0
+            request_started = time.perf_counter()
+            response = client.open(path, method=method, data=form)
+            response.get_data()
+            return (time.perf_counter() - request_started) * 1000, statements[0], response.status_code
+
+        for _ in range(warmup):
+            one()
+        started = time.perf_counter()
+        for _ in range(requests):
+            ms, count, status = one()
+            timings.append(ms)
+            counts.append(count)
+            errors += status != expected
+        results[route] = summarize(timings, counts, errors, time.perf_counter() - started)
+        print_route(route, results[route])
+    return results
+
+
+# ============================================
+# HTTP driver
+# ============================================
+
+def serve(database, port):
+    """Child process: run the app on a threaded local server"""
+    import logging
+    from werkzeug.serving import make_server
+    app = create_bench_app(database)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def start_server(database):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port),
+                               '--database', database], cwd=tempfile.gettempdir())
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, f'http://127.0.0.1:{port}'
+        except OSError:
+            if server.poll() is not None:
+                raise SystemExit('benchmark server exited during startup')
+            time.sleep(0.2)
+    server.kill()
+    raise SystemExit('benchmark server did not start within 60s')
+
+
+class HttpSession:
+    """One keep-alive connection with its own session cookie"""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        self.cookie = None
+
+    def request(self, method, path, form=None):
+        headers = {}
+        body = None
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        if form is not None:
+            body = urlencode(form, doseq=True)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        for attempt in (1, 2):
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed an idle keep-alive connection; retry once
+                self.connection.close()
+                if attempt == 2:
+                    raise
+        for header in response.headers.get_all('Set-Cookie') or ():
+            if header.startswith('session='):
+                self.cookie = header.split(';', 1)[0]
+        return response.status
+
+    def login(self, email, password):
+        status = self.request('POST', '/login', {'email': email, 'password': password})
+        assert status == 302, f'login as {email} failed ({status})'
+        return self
+
+
+def run_http(base_url, users, routes, requests, warmup, concurrency, rng):
+    # Every thread has its own connections: one per role, plus an anonymous one
+    workers = []
+    for n in range(concurrency):
+        user = users[n % len(users)]
+        workers.append({
+            'user': user,
+            'user_session': HttpSession(base_url).login(user['email'], PASSWORD),
+            'admin_session': HttpSession(base_url).login(ADMIN_EMAIL, ADMIN_PASSWORD),
+            'anonymous': HttpSession(base_url),
+            'rng': random.Random(rng.random()),
+        })
+
+    results = {}
+    for route in routes:
+        expected, build = ROUTES[route]
+        per_worker = max(1, requests // concurrency)
+        timings, errors = [], [0]
+        lock = threading.Lock()
+        barrier = threading.Barrier(concurrency + 1)
+
+        def work(worker, count, record):
+            barrier.wait()
+            for _ in range(count):
+                method, path, form, as_ = build(worker['rng'], worker['user'])
+                if as_ is None:
+                    session = worker['anonymous']
+                    session.cookie = None
+                else:
+                    session = worker['admin_session'] if as_ == 'admin' else worker['user_session']
+                request_started = time.perf_counter()
+                status = session.request(method, path, form)
+                ms = (time.perf_counter() - request_started) * 1000
+                if record:
+                    with lock:
+                        timings.append(ms)
+                        errors[0] += status != expected
+
+        for count, record in ((max(1, warmup // concurrency), False), (per_worker, True)):
+            threads = [threading.Thread(target=work, args=(worker, count, record)) for worker in workers]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            started = time.perf_counter()
+            for thread in threads:
+                thread.join()
+        results[route] = summarize(timings, [], errors[0], time.perf_counter() - started)
+        print_route(route, results[route])
+    return results
+
+
+# ============================================
+# Reporting and baselines
+# ============================================
+
+def print_route(route, stats):
+    sql = f"{stats['sql_per_request']:6.1f}" if stats['sql_per_request'] is not None else '     -'
+    print(f"{route:<16} p50 {stats['p50_ms']:8.2f} ms  p95 {stats['p95_ms']:8.2f} ms  "
+          f"p99 {stats['p99_ms']:8.2f} ms  {stats['throughput_rps']:7.1f} req/s  "
+          f"SQL/req {sql}  errors {stats['errors']}")
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCH_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def compare(baseline, results, threshold):
+    """Print the change against a baseline; returns the list of regressed routes"""
+    meta = baseline['meta']
+    print(f"\nCompared with {meta.get('commit')} ({meta.get('created_at')}, {meta.get('driver')} driver, "
+          f"{meta.get('bills')} bills)")
+    regressed = []
+    for route, stats in results.items():
+        old = baseline['routes'].get(route)
+        if not old:
+            continue
+        change = (stats['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0.0
+        more_sql = (stats['sql_per_request'] is not None and old.get('sql_per_request') is not None
+                    and stats['sql_per_request'] > old['sql_per_request'])
+        flag = ''
+        if change > threshold or more_sql:
+            regressed.append(route)
+            flag = '  REGRESSION'
+        sql = (f"  SQL/req {old['sql_per_request']} -> {stats['sql_per_request']}"
+               if stats['sql_per_request'] is not None and old.get('sql_per_request') is not None else '')
+        print(f"{route:<16} p95 {old['p95_ms']:8.2f} -> {stats['p95_ms']:8.2f} ms ({change:+6.1f}%)  "
+              f"req/s {old['throughput_rps']:7.1f} -> {stats['throughput_rps']:7.1f}{sql}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--driver', choices=['client', 'http'], default='client')
+    parser.add_argument('--routes', nargs='+', choices=list(ROUTES), default=list(ROUTES))
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--bills', type=int, default=100_000)
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per route first')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads (http driver)')
+    parser.add_argument('--sessions', type=int, default=8, help='seeded users to log in as')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database', help='seed this file (or reuse it if it exists) instead of a temporary one')
+    parser.add_argument('--url', help='http driver: benchmark this running server instead of starting one '
+                                      '(it must use --database)')
+    parser.add_argument('--save', nargs='?', const='', metavar='PATH', help='write a JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', help='baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=20.0, help='allowed p95 growth in percent')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.database, args.serve)
+        return
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        database = args.database or os.path.join(tmp, 'routes.db')
+        if not os.path.exists(database):
+            seed(database, args.bills, args.users, pending=5, random_seed=args.seed).close()
+        users = load_users(database, args.sessions)
+        if not users:
+            raise SystemExit(f'{database} has no seeded users with bills')
+        db = sqlite3.connect(database)
+        bills, user_count = db.execute('SELECT (SELECT COUNT(*) FROM bills), (SELECT COUNT(*) FROM users)').fetchone()
+        db.close()
+        print(f'{bills} bills, {user_count} users, driver {args.driver}'
+              f"{f', concurrency {args.concurrency}' if args.driver == 'http' else ''}\n")
+
+        server = None
+        try:
+            if args.driver == 'client':
+                results = run_client(database, users, args.routes, args.requests, args.warmup, rng)
+            else:
+                base_url = args.url
+                if not base_url:
+                    server, base_url = start_server(database)
+                results = run_http(base_url, users, args.routes, args.requests, args.warmup,
+                                   args.concurrency, rng)
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+    meta = {
+        'commit': git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'driver': args.driver,
+        'concurrency': args.concurrency if args.driver == 'http' else 1,
+        'requests_per_route': args.requests,
+        'bills': bills,
+        'users': user_count,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+    if args.save is not None:
+        path = args.save or os.path.join(BENCH_DIR, 'baselines', f"{meta['commit'] or 'unknown'}-{args.driver}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'meta': meta, 'routes': results}, f, indent=2)
+        print(f'\nsaved baseline {path}')
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(json.load(f), results, args.threshold)
+        if regressed:
+            print(f"\n{len(regressed)} route(s) regressed: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Full-text bill search benchmark
+Seeds a temporary database with seed_data.seed() (which writes through
+billing.insert_bills(), so bills_fts is filled by the normal write path),
+then times bill_search.search() for typical queries (customer names, mobile
+and bill number prefixes, item and address words) against random users. A
+LIKE scan over the same columns is timed for comparison.
+
+Usage: python benchmarks/bench_search.py [--bills 1000000] [--users 100]
+       [--queries 200] [--database path/to/keep.db]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bill_search
+import billing
+from gst_reverify import percentile
+from seed_data import ITEMS, seed
+
+
+def sample_queries(db, user_id):
+    """One query of each kind, drawn from a random bill of this user"""
+    bill = db.execute('SELECT bill_number, customer_name, customer_mobile, customer_address FROM bills '
+                      'WHERE user_id = ? ORDER BY random() LIMIT 1', (user_id,)).fetchone()
+    return {
+        'first name': bill['customer_name'].split()[0],
+        'full name': bill['customer_name'],
+        'name prefix': bill['customer_name'][:3],
+        'mobile prefix': bill['customer_mobile'][:6],
+        'bill number': bill['bill_number'],
+        'item': random.choice(ITEMS),
+        'name + city': f"{bill['customer_name'].split()[1]} {bill['customer_address'].split(', ')[-1]}",
+        'no match': 'zzyzx',
+    }
+
+
+def like_search(db, user_id, query, page_size):
+    """The pre-FTS alternative: substring scan over the same columns"""
+    pattern = f'%{query}%'
+    return db.execute('''
+        SELECT id FROM bills
+        WHERE user_id = ? AND (customer_name LIKE ? OR customer_mobile LIKE ? OR customer_address LIKE ?
+            OR bill_number LIKE ? OR items_json LIKE ?)
+        ORDER BY created_at DESC, id DESC LIMIT ?
+    ''', (user_id, pattern, pattern, pattern, pattern, pattern, page_size)).fetchall()
+
+
+def search(db, user_id, query, page, page_size):
+    rows, _ = bill_search.search(db, user_id, query, page=page, page_size=page_size,
+                                 noise=billing.BILL_NUMBER_PREFIX)
+    return rows
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return (time.perf_counter() - started) * 1000, result
+
+
+def record(results, kind, ms, rows):
+    timings, hits = results.setdefault(kind, ([], []))
+    timings.append(ms)
+    hits.append(len(rows))
+
+
+def report(label, timings, hits):
+    timings.sort()
+    print(f'{label:<22} p50 {percentile(timings, 50):8.2f} ms  p95 {percentile(timings, 95):8.2f} ms  '
+          f'p99 {percentile(timings, 99):8.2f} ms  avg hits/page {sum(hits) / len(hits):5.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--bills', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=200, help='queries per kind')
+    parser.add_argument('--page-size', type=int, default=bill_search.DEFAULT_PAGE_SIZE)
+    parser.add_argument('--like-queries', type=int, default=20, help='LIKE scans per kind (slow)')
+    parser.add_argument('--database', help='seed this file (or reuse it if it exists) instead of a temporary one')
+    args = parser.parse_args()
+    random.seed(42)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = args.database or os.path.join(tmp, 'search.db')
+        if os.path.exists(database):
+            db = sqlite3.connect(database, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            args.users = db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+            args.bills = db.execute('SELECT COUNT(*) FROM bills').fetchone()[0]
+        else:
+            db = seed(database, args.bills, args.users)
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        print(f'database {os.path.getsize(database) / 2 ** 20:.0f} MiB, '
+              f'{args.bills // args.users} bills per user\n')
+
+        fts, like = {}, {}
+        for i in range(args.queries):
+            user_id = random.randint(1, args.users)
+            for kind, query in sample_queries(db, user_id).items():
+                record(fts, kind, *timed(lambda: search(db, user_id, query, 1, args.page_size)))
+                if kind == 'item':
+                    record(fts, 'item, page 5', *timed(lambda: search(db, user_id, query, 5, args.page_size)))
+                if i < args.like_queries:
+                    record(like, kind, *timed(lambda: like_search(db, user_id, query, args.page_size)))
+
+        print('FTS5 (bill_search.search)')
+        for kind, (timings, hits) in fts.items():
+            report(kind, timings, hits)
+        print('\nLIKE scan (for comparison)')
+        for kind, (timings, hits) in like.items():
+            report(kind, timings, hits)
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
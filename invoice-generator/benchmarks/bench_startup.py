@@ -0,0 +1,167 @@
+"""
+Worker cold start benchmark
+Starts fresh interpreters that import the app module (which builds the
+default app with create_app()) and serve one GET /login through the test
+client, the work a new WSGI worker or a test run does before its first
+request. Each run uses python -X importtime; the report gives the median
+import time of the app module, the time to the first response, and the
+app's direct imports that cost the most.
+
+--save writes the results as a JSON baseline (by default
+benchmarks/baselines/<commit>-startup.json); --compare prints the change
+against an earlier baseline and exits with status 1 if the median import or
+first-request time grew by more than --threshold percent.
+
+Usage: python benchmarks/bench_startup.py [--runs 10] [--top 12]
+       [--save [path]] [--compare path]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+
+from bench_routes import git_commit
+
+# Runs in the child: time the import and the first request, report on stdout
+CHILD = '''
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/login')
+done = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({'import_ms': (imported - started) * 1000, 'first_request_ms': (done - started) * 1000}))
+'''
+
+
+def parse_importtime(stderr):
+    """{module: (self_us, cumulative_us, depth)} from -X importtime output"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules[name.strip()] = (int(self_us), int(cumulative_us), depth)
+    return modules
+
+
+def app_imports(stderr):
+    """Cumulative time of each module imported directly by app.py, in microseconds"""
+    direct = {}
+    # -X importtime prints a module after everything it imported, so the
+    # app's own imports are the depth-1 lines just before the "app" line
+    lines = [line for line in stderr.splitlines() if line.startswith('import time:') and 'self [us]' not in line]
+    for index, line in enumerate(lines):
+        if line.rstrip().endswith('| app'):
+            for previous in reversed(lines[:index]):
+                self_us, cumulative_us, name = previous[len('import time:'):].split('|')
+                depth = (len(name) - len(name.lstrip()) - 1) // 2
+                if depth == 0:
+                    break
+                if depth == 1:
+                    direct[name.strip()] = int(cumulative_us)
+            break
+    return direct
+
+
+def run_once(env):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD], cwd=APP_DIR, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f'child failed:\n{result.stderr[-2000:]}')
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    modules = parse_importtime(result.stderr)
+    timings['importtime_ms'] = modules['app'][1] / 1000 if 'app' in modules else None
+    return timings, app_imports(result.stderr)
+
+
+def compare(baseline, results, threshold):
+    """Print the change against a baseline; returns the list of regressed measurements"""
+    meta = baseline['meta']
+    print(f"\nCompared with {meta.get('commit')} ({meta.get('created_at')}, {meta.get('runs')} runs)")
+    regressed = []
+    for key in ('import_ms', 'first_request_ms'):
+        old, new = baseline['results'][key], results[key]
+        change = (new - old) / old * 100 if old else 0.0
+        flag = ''
+        if change > threshold:
+            regressed.append(key)
+            flag = '  REGRESSION'
+        print(f"{key:<18} {old:8.1f} -> {new:8.1f} ms ({change:+6.1f}%){flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=12, help='direct imports to list')
+    parser.add_argument('--save', nargs='?', const='', metavar='PATH', help='write a JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', help='baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=20.0, help='allowed growth in percent')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'startup.db')
+        from app import create_app, init_db
+        with create_app({'DATABASE': database}).app_context():
+            init_db()
+        env = dict(os.environ, DATABASE=database)
+        env.pop('AUTO_MIGRATE', None)
+        # One unmeasured run so every run reads warm .pyc files
+        run_once(env)
+        runs, imports = [], defaultdict(list)
+        for _ in range(args.runs):
+            timings, direct = run_once(env)
+            runs.append(timings)
+            for module, cumulative_us in direct.items():
+                imports[module].append(cumulative_us / 1000)
+
+    results = {key: round(statistics.median(run[key] for run in runs), 2)
+               for key in ('import_ms', 'first_request_ms', 'importtime_ms')}
+    top = sorted(((module, statistics.median(times)) for module, times in imports.items()),
+                 key=lambda item: item[1], reverse=True)[:args.top]
+    results['imports_ms'] = {module: round(ms, 2) for module, ms in top}
+
+    print(f"{args.runs} cold starts (medians)\n")
+    print(f"import app          {results['import_ms']:8.1f} ms  (-X importtime: {results['importtime_ms']:.1f} ms)")
+    print(f"first response      {results['first_request_ms']:8.1f} ms  (import + GET /login)\n")
+    print('Slowest imports in app.py (cumulative):')
+    for module, ms in top:
+        print(f'  {module:<28} {ms:8.1f} ms')
+
+    meta = {
+        'commit': git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'runs': args.runs,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+    if args.save is not None:
+        path = args.save or os.path.join(BENCH_DIR, 'baselines', f"{meta['commit'] or 'unknown'}-startup.json")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+        print(f'\nsaved baseline {path}')
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(json.load(f), results, args.threshold)
+        if regressed:
+            print(f"\n{len(regressed)} measurement(s) regressed: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
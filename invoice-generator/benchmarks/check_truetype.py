@@ -0,0 +1,100 @@
+"""
+TrueType reader checks
+Parses each font with truetype.py, then subsets it to every glyph its cmap
+reaches (in slices, like documents would use them) and verifies that the
+subset's checksums are valid, that it parses again, and that each kept
+glyph's outline, composite parts and advance width are unchanged. When
+fontTools is installed, the cmap is also compared with fontTools' and every
+subset must load and decompile in it. Exits non-zero on the first failed
+check.
+
+Usage: python benchmarks/check_truetype.py [font.ttf ...]
+(default: the fonts pdf_renderer.find_fonts() finds, e.g. the Noto files)
+"""
+import io
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import truetype
+
+# Glyphs per subset; a long invoice uses a few dozen
+SLICE = 64
+
+
+def check(label, condition):
+    print(f"{'ok  ' if condition else 'FAIL'} {label}")
+    if not condition:
+        sys.exit(1)
+
+
+def checksums_valid(data):
+    count = struct.unpack('>H', data[4:6])[0]
+    for i in range(count):
+        tag, checksum, offset, length = struct.unpack('>4sLLL', data[12 + 16 * i:28 + 16 * i])
+        table = data[offset:offset + length]
+        if tag == b'head':
+            table = table[:8] + b'\0\0\0\0' + table[12:]
+        if truetype._checksum(table) != checksum:
+            return False
+    return truetype._checksum(data) == 0xB1B0AFBA
+
+
+def check_font(path):
+    print(path)
+    font = truetype.load_font(path)
+    check(f'{font.name}: {len(font.cmap)} characters, {font.num_glyphs} glyphs',
+          font.cmap and all(glyph < font.num_glyphs for glyph in font.cmap.values()))
+    check('loca offsets ascend within glyf',
+          all(a <= b for a, b in zip(font.loca, font.loca[1:])) and font.loca[-1] <= len(font.tables['glyf']))
+
+    try:
+        from fontTools.ttLib import TTFont
+    except ImportError:
+        TTFont = None
+        print('(fontTools not installed; skipping comparisons with it)')
+    if TTFont:
+        reference = TTFont(path)
+        check('cmap matches fontTools',
+              {code: reference.getGlyphID(name) for code, name in reference.getBestCmap().items()}
+              == font.cmap)
+
+    glyphs = sorted(set(font.cmap.values()))
+    for start in range(0, len(glyphs), SLICE):
+        wanted = glyphs[start:start + SLICE]
+        data = font.subset(wanted)
+        label = f'subset of glyphs {wanted[0]}-{wanted[-1]} ({len(data)} bytes)'
+        if not checksums_valid(data):
+            check(f'{label}: checksums', False)
+        subset = truetype.TrueTypeFont(data)
+        for glyph in [0, *wanted]:
+            original, copied = font._glyph(glyph), subset._glyph(glyph)
+            if (copied[:len(original)] != original or len(copied) - len(original) > 3
+                    or subset.metrics[glyph] != font.metrics[glyph]
+                    or any(part >= subset.num_glyphs
+                           or subset._glyph(part)[:len(font._glyph(part))] != font._glyph(part)
+                           for part in font._components(glyph))):
+                check(f'{label}: glyph {glyph} kept intact', False)
+        if TTFont:
+            loaded = TTFont(io.BytesIO(data))
+            order = loaded.getGlyphOrder()
+            for glyph in wanted:
+                loaded['glyf'][order[glyph]].expand(loaded['glyf'])
+    check(f'{(len(glyphs) + SLICE - 1) // SLICE} subsets keep their glyphs intact'
+          + (' and load in fontTools' if TTFont else ''), True)
+
+
+def main():
+    paths = sys.argv[1:]
+    if not paths:
+        import pdf_renderer
+        paths = pdf_renderer.find_fonts()
+    check('fonts to check (pass paths, or install Noto fonts)', paths)
+    for path in paths:
+        check_font(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+HTTP caching checks for /uploads
+Stores a content-addressed image and a legacy-named one in a temporary upload
+folder, then verifies Cache-Control, strong ETags, 304 responses to
+If-None-Match, 206 responses to Range and both offload modes through the
+Flask test client. Exits non-zero on the first failed check.
+
+Usage: python benchmarks/check_upload_caching.py
+"""
+import io
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+
+def check(label, condition):
+    print(f"{'ok  ' if condition else 'FAIL'} {label}")
+    if not condition:
+        sys.exit(1)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        from app import create_app
+        import uploads
+
+        app = create_app({'DATABASE': os.path.join(tmp, 'invoice.db'), 'UPLOAD_FOLDER': tmp,
+                          'AUTO_MIGRATE': True})
+        image = io.BytesIO()
+        Image.new('RGB', (400, 400), (30, 60, 90)).save(image, 'PNG')
+        hashed = uploads.store_upload(tmp, io.BytesIO(image.getvalue()), 'logo')
+        with open(os.path.join(tmp, 'logo_legacy.png'), 'wb') as f:
+            f.write(image.getvalue())
+        size = os.path.getsize(os.path.join(tmp, hashed))
+
+        client = app.test_client()
+        url = f'/uploads/{hashed}'
+
+        r = client.get(url)
+        check('content-addressed file served', r.status_code == 200 and len(r.data) == size)
+        check('Cache-Control immutable', 'immutable' in r.headers['Cache-Control']
+              and 'max-age=31536000' in r.headers['Cache-Control']
+              and 'no-cache' not in r.headers['Cache-Control'])
+        etag = r.headers['ETag']
+        check('strong ETag is the content hash', etag == f'"{hashed.partition(".")[0]}"')
+
+        r = client.get(url, headers={'If-None-Match': etag})
+        check('If-None-Match -> 304 without body', r.status_code == 304 and not r.data)
+        r = client.get(url, headers={'If-None-Match': '"other"'})
+        check('stale If-None-Match -> 200', r.status_code == 200)
+        r = client.get(url, headers={'Range': 'bytes=0-9'})
+        check('Range -> 206 partial body', r.status_code == 206 and len(r.data) == 10
+              and r.headers['Content-Range'] == f'bytes 0-9/{size}')
+
+        r = client.get('/uploads/logo_legacy.png')
+        check('legacy name revalidates', r.status_code == 200 and 'no-cache' in r.headers['Cache-Control'])
+        r = client.get('/uploads/logo_legacy.png', headers={'If-None-Match': r.headers['ETag']})
+        check('legacy If-None-Match -> 304', r.status_code == 304)
+        check('missing file -> 404', client.get('/uploads/nope.png').status_code == 404)
+        check('path traversal -> 404', client.get('/uploads/..%2Finvoice.db').status_code == 404)
+
+        app.config['UPLOADS_OFFLOAD'] = 'x-accel-redirect'
+        r = client.get(url)
+        check('X-Accel-Redirect with empty body', r.status_code == 200 and not r.data
+              and r.headers['X-Accel-Redirect'] == f'/_uploads/{hashed}')
+        r = client.get(url, headers={'If-None-Match': etag})
+        check('offloaded 304 skips the redirect', r.status_code == 304
+              and 'X-Accel-Redirect' not in r.headers)
+
+        app.config['UPLOADS_OFFLOAD'] = 'x-sendfile'
+        r = client.get(url)
+        check('X-Sendfile points at the file', not r.data
+              and r.headers['X-Sendfile'] == os.path.join(os.path.abspath(tmp), hashed))
+    print('All upload caching checks passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Synthetic data for the benchmarks
+Creates approved users (all sharing one password), one business template
+each, a few pending sign-ups for the admin dashboard, and bills with
+realistic customers and line items. Bills go through
+billing.insert_bills(), so bill_items, sales_rollups and bills_fts are
+filled by the normal write path. A fixed random seed makes runs repeatable.
+
+Usage: python benchmarks/seed_data.py path/to/bench.db [--users 20]
+       [--bills 100000] [--seed 42]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash
+
+import bill_search
+import billing
+import migrations
+
+PASSWORD = 'bench-password'
+
+FIRST_NAMES = ['Ravi', 'Priya', 'Anil', 'Sunita', 'Mohammed', 'Lakshmi', 'Suresh', 'Kavya', 'Arjun',
+               'Fatima', 'Vikram', 'Deepa', 'Rahul', 'Meena', 'Joseph', 'Anjali', 'Karthik', 'Pooja',
+               'Imran', 'Divya', 'Ganesh', 'Neha', 'Sanjay', 'Rekha', 'Harish', 'Ayesha']
+LAST_NAMES = ['Kumar', 'Sharma', 'Reddy', 'Iyer', 'Khan', 'Nair', 'Patel', 'Rao', 'Singh', 'Das',
+              'Gowda', 'Menon', 'Pillai', 'Joshi', 'Shetty', 'Verma', 'Naidu', 'Bhat']
+STREETS = ['MG Road', 'Brigade Road', 'Residency Road', 'Station Road', 'Temple Street',
+           'Gandhi Nagar', 'Market Lane', '2nd Cross', '5th Main', 'Church Street', 'Lake View']
+CITIES = ['Bengaluru', 'Mysuru', 'Chennai', 'Hyderabad', 'Pune', 'Kochi', 'Mangaluru', 'Hubballi',
+          'Coimbatore', 'Vijayawada', 'Madurai', 'Belagavi']
+ITEMS = ['Cement bag', 'Steel rod', 'PVC pipe', 'Wall paint', 'Ceramic tile', 'Copper wire',
+         'LED bulb', 'Door hinge', 'Wood screw', 'Plywood sheet', 'Water tank', 'Sand load',
+         'Granite slab', 'Switch board', 'Ceiling fan', 'Bathroom fitting', 'Primer', 'Putty']
+
+
+def email_for(user_id):
+    return f'user{user_id}@example.com'
+
+
+def random_bill_data(start, span_days, rng=random):
+    """Unvalidated bill dict, as posted to the bill form or the API"""
+    items = [{'name': rng.choice(ITEMS), 'quantity': str(rng.randint(1, 20)),
+              'rate': str(rng.randint(10, 5000))} for _ in range(rng.randint(1, 6))]
+    return {
+        'customer_name': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+        'customer_mobile': f'9{rng.randrange(10 ** 9):09d}',
+        'customer_address': f'{rng.randint(1, 400)}, {rng.choice(STREETS)}, {rng.choice(CITIES)}',
+        'bill_date': time.strftime('%Y-%m-%d', time.gmtime(start + rng.randrange(span_days) * 86400)),
+        'gst_enabled': True,
+        'gst_percentage': rng.choice([0, 5, 12, 18]),
+        'items': items,
+    }
+
+
+def random_bill(start, span_days, rng=random):
+    return billing.prepare_bill(random_bill_data(start, span_days, rng))
+
+
+def seed(database, bill_count, users, batch_size=5000, pending=0, random_seed=None):
+    """Create and fill a benchmark database; returns an open connection to it"""
+    if random_seed is not None:
+        random.seed(random_seed)
+    db = sqlite3.connect(database, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    migrations.migrate(db)
+    # Hashing is deliberately slow, so every user shares one hash
+    password_hash = generate_password_hash(PASSWORD)
+    db.executemany('INSERT INTO users (id, email, password_hash, business_name, business_address, '
+                   'owner_name, mobile, is_approved) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                   [(user_id, email_for(user_id), password_hash, f'Biz {user_id}', 'Addr',
+                     f'Owner {user_id}', '0', int(user_id <= users))
+                    for user_id in range(1, users + pending + 1)])
+    db.executemany('INSERT INTO templates (id, user_id, business_name, business_address, owner_name, '
+                   'mobile) VALUES (?, ?, ?, ?, ?, ?)',
+                   [(user_id, user_id, f'Biz {user_id}', 'Addr', f'Owner {user_id}', '0')
+                    for user_id in range(1, users + 1)])
+
+    start = time.time() - 730 * 86400
+    started = time.perf_counter()
+    per_user = bill_count // users
+    for user_id in range(1, users + 1):
+        for offset in range(0, per_user, batch_size):
+            bills = [random_bill(start, 730) for _ in range(min(batch_size, per_user - offset))]
+            db.execute('BEGIN IMMEDIATE')
+            billing.insert_bills(db, user_id, user_id, bills)
+            db.execute('COMMIT')
+        print(f'\rseeded {user_id * per_user} bills', end='', flush=True)
+    elapsed = time.perf_counter() - started
+    print(f'\rseeded {users * per_user} bills in {elapsed:.0f}s ({users * per_user / elapsed:.0f} bills/s, '
+          f'including bill_items, rollups and bills_fts)')
+
+    started = time.perf_counter()
+    bill_search.optimize(db)
+    db.execute('ANALYZE')
+    print(f'optimized bills_fts in {time.perf_counter() - started:.1f}s')
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('database')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--pending', type=int, default=5, help='extra users awaiting approval')
+    parser.add_argument('--bills', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    if os.path.exists(args.database):
+        parser.error(f'{args.database} already exists')
+    db = seed(args.database, args.bills, args.users, pending=args.pending, random_seed=args.seed)
+    db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    db.close()
+    print(f'{args.database}: {os.path.getsize(args.database) / 2 ** 20:.0f} MiB, '
+          f'users {email_for(1)}..{email_for(args.users)} with password {PASSWORD!r}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Concurrency stress check for bill number allocation
+Starts several processes that each create bills for the same user against
+one SQLite file, mixing single bills (as create_bill() does) with block
+reservations (as bulk import does). Exits non-zero if any bill number is
+duplicated or the sequence has gaps.
+
+Usage: python benchmarks/stress_bill_numbers.py [--processes 8] [--bills 200]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import billing
+import migrations
+from database import ConnectionPool
+
+
+def worker(database, user_id, bills, seed, fy_reset):
+    pool = ConnectionPool(database)
+    db = pool.acquire()
+    numbering = billing.BillNumbering(financial_year_reset=fy_reset)
+    bill = billing.prepare_bill({'customer_name': f'Worker {seed}', 'bill_date': '2026-03-31',
+                                 'items': [{'name': 'Item', 'quantity': 1, 'rate': 1}]})
+    created = 0
+    step = 0
+    while created < bills:
+        # Every fifth write reserves a block of up to 25, the rest are single bills
+        block = min(bills - created, 1 + (seed + step) % 25) if step % 5 == 0 else 1
+        billing.insert_bills(db, user_id, 1, [bill] * block, numbering)
+        db.commit()
+        created += block
+        step += 1
+    pool.release(db)
+
+
+def run(processes, bills, fy_reset):
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'stress.db')
+        db = ConnectionPool(database).connect()
+        migrations.migrate(db)
+        db.execute("INSERT INTO users (email, password_hash, business_name, business_address, owner_name, mobile) "
+                   "VALUES ('stress@example.com', '-', 'B', 'A', 'O', '0')")
+        db.commit()
+
+        started = time.perf_counter()
+        workers = [multiprocessing.Process(target=worker, args=(database, 1, bills, seed, fy_reset))
+                   for seed in range(processes)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        elapsed = time.perf_counter() - started
+
+        numbers = [row[0] for row in db.execute('SELECT bill_number FROM bills ORDER BY id')]
+        duplicates = {number: count for number, count in Counter(numbers).items() if count > 1}
+        sequence = sorted(int(number.rsplit('/', 1)[-1].rsplit('-', 1)[-1]) for number in numbers)
+        expected = list(range(1, processes * bills + 1))
+        db.close()
+
+    result = {
+        'processes': processes,
+        'bills': len(numbers),
+        'duplicates': len(duplicates),
+        'contiguous': sequence == expected,
+        'failed_workers': sum(process.exitcode != 0 for process in workers),
+        'bills_per_second': round(len(numbers) / elapsed),
+    }
+    print(json.dumps(result, indent=2))
+    return not duplicates and sequence == expected and not result['failed_workers']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--bills', type=int, default=200, help='bills per process')
+    parser.add_argument('--fy-reset', action='store_true', help='use financial-year numbering')
+    args = parser.parse_args()
+    sys.exit(0 if run(args.processes, args.bills, args.fy_reset) else 1)
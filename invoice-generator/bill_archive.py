@@ -0,0 +1,338 @@
+"""
+Bulk PDF archives of a user's bills
+An archive job renders every bill in a date range with pdf_renderer and
+writes the PDFs into a ZIP file on disk, one entry at a time, so neither
+the rendered documents nor the archive are ever held in memory as a whole.
+
+Rendering runs on a shared process pool in batches; a bounded number of
+batches is in flight at once and results are written in bill order. The
+archive is built by a background job (see jobs.py) on whichever worker
+claims it, and records its progress in bill_archives, so any worker can
+answer the browser's progress polls. A running archive whose heartbeat stops
+(the worker exited) is reported as failed, as is a queued one that no worker
+picks up within QUEUE_TIMEOUT (none running, or its job was lost). Bills
+with text the PDF renderer cannot draw are left out and listed in the finished
+archive's error field.
+"""
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.utils import secure_filename
+from bill_history import filter_clause
+import jobs
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+# Bills per pool task; enough to amortize pickling, small enough to keep
+# every process busy near the end of a job
+BATCH_SIZE = 8
+
+# Rendered batches waiting to be written, per pool process
+MAX_IN_FLIGHT = 4
+
+# Bill numbers named in a finished archive's note about left-out bills
+MAX_SKIPPED_LISTED = 10
+
+# Seconds between progress writes, and without one before a running archive
+# is considered dead
+PROGRESS_INTERVAL = 0.5
+STALE_AFTER = 300
+
+# Seconds a queued archive may wait for a job worker before it is given up
+QUEUE_TIMEOUT = 1800
+
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(workers=DEFAULT_WORKERS):
+    """The process pool shared by all archive jobs in this process"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn, not fork: the web server process has threads (and open
+            # SQLite connections) that must not be copied into the children
+            _pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context('spawn'))
+            _pool_workers = workers
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _render_batch(batch, upload_folder, fonts=None):
+    """
+    Pool task: render a list of (bill, template) dicts to PDF bytes
+    A bill with text none of the fonts can show comes back as None.
+    """
+    from pdf_renderer import UnsupportedText, render_bill_pdf
+    pdfs = []
+    for bill, template in batch:
+        try:
+            pdfs.append(render_bill_pdf(bill, template, upload_folder=upload_folder, fonts=fonts))
+        except UnsupportedText:
+            pdfs.append(None)
+    return pdfs
+
+
+def _archive_filename(date_from, date_to):
+    period = f"{date_from or 'start'}_to_{date_to or 'today'}"
+    return f'invoices_{period}.zip'
+
+
+def entry_name(bill, used):
+    """Unique file name inside the archive for a bill's PDF"""
+    base = secure_filename(bill['bill_number'] or '') or f"bill-{bill['id']}"
+    name = f'{base}.pdf'
+    if name in used:
+        name = f"{base}-{bill['id']}.pdf"
+    used.add(name)
+    return name
+
+
+def _iter_bills(db, user_id, filters, chunk_size=500):
+    """Yield a user's bills in the range as dicts, oldest first, in keyset chunks"""
+    where, params = filter_clause(filters)
+    position = None
+    while True:
+        keyset = ' AND (b.created_at, b.id) > (?, ?)' if position else ''
+        rows = db.execute(f'''
+            SELECT b.* FROM bills b
+            WHERE b.user_id = ?{where}{keyset}
+            ORDER BY b.created_at, b.id
+            LIMIT ?
+        ''', (user_id, *params, *(position or ()), chunk_size)).fetchall()
+        yield from (dict(row) for row in rows)
+        if len(rows) < chunk_size:
+            return
+        position = (rows[-1]['created_at'], rows[-1]['id'])
+
+
+# ============================================
+# Job records
+# ============================================
+
+def _filters(job):
+    return {'date_from': job['date_from'], 'date_to': job['date_to']}
+
+
+def create_job(db, user_id, date_from=None, date_to=None):
+    """Queue an archive job and return its id, or None if the range has no bills"""
+    where, params = filter_clause({'date_from': date_from, 'date_to': date_to})
+    total = db.execute(f'SELECT COUNT(*) FROM bills b WHERE b.user_id = ?{where}',
+                       (user_id, *params)).fetchone()[0]
+    if not total:
+        return None
+    job_id = secrets.token_urlsafe(16)
+    db.execute('''
+        INSERT INTO bill_archives (id, user_id, date_from, date_to, status, total, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (job_id, user_id, date_from, date_to, QUEUED, total, time.time()))
+    # Archives can take minutes; quicker jobs go first
+    jobs.enqueue(db, 'bill_archive', {'archive_id': job_id}, user_id=user_id,
+                 priority=jobs.PRIORITY_LOW, max_attempts=1)
+    db.commit()
+    return job_id
+
+
+def get_job(db, job_id, user_id):
+    """A user's job as a dict with a percent field, or None"""
+    row = db.execute('SELECT * FROM bill_archives WHERE id = ? AND user_id = ?',
+                     (job_id, user_id)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    if _is_stale(job):
+        job['error'] = ('The export stopped unexpectedly; please start it again' if job['status'] == RUNNING
+                        else 'The export was not started in time; please start it again')
+        job['status'] = FAILED
+    job['percent'] = 100 if job['status'] == DONE else (
+        int(job['done'] * 100 / job['total']) if job['total'] else 0)
+    return job
+
+
+def _is_stale(job):
+    """Whether a queued or running job has been given up on"""
+    age = time.time() - (job['updated_at'] or 0)
+    return ((job['status'] == RUNNING and age > STALE_AFTER)
+            or (job['status'] == QUEUED and age > QUEUE_TIMEOUT))
+
+
+def active_job(db, user_id):
+    """Id of the user's queued or running job, if it is still alive"""
+    now = time.time()
+    row = db.execute('''
+        SELECT id FROM bill_archives
+        WHERE user_id = ? AND ((status = ? AND updated_at > ?) OR (status = ? AND updated_at > ?))
+        ORDER BY created_at DESC LIMIT 1
+    ''', (user_id, QUEUED, now - QUEUE_TIMEOUT, RUNNING, now - STALE_AFTER)).fetchone()
+    return row['id'] if row else None
+
+
+def _update(db, job_id, **fields):
+    fields['updated_at'] = time.time()
+    db.execute(f"UPDATE bill_archives SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+               (*fields.values(), job_id))
+    db.commit()
+
+
+def archive_path(folder, job):
+    return os.path.join(folder, f"{job['id']}.zip")
+
+
+def cleanup(db, folder, max_age):
+    """Delete finished or abandoned jobs older than max_age seconds and their files; returns how many"""
+    now = time.time()
+    rows = db.execute('''
+        SELECT id FROM bill_archives
+        WHERE created_at < datetime('now', ?) AND (status IN (?, ?)
+            OR (status = ? AND updated_at < ?) OR (status = ? AND updated_at < ?))
+    ''', (f'-{int(max_age)} seconds', DONE, FAILED, RUNNING, now - STALE_AFTER,
+          QUEUED, now - QUEUE_TIMEOUT)).fetchall()
+    for row in rows:
+        for path in (archive_path(folder, row), archive_path(folder, row) + '.part'):
+            if os.path.exists(path):
+                os.unlink(path)
+        db.execute('DELETE FROM bill_archives WHERE id = ?', (row['id'],))
+    db.commit()
+    return len(rows)
+
+
+# ============================================
+# Building archives
+# ============================================
+
+def build_archive(db, job, folder, upload_folder, workers=DEFAULT_WORKERS, progress=None,
+                  fonts=None, skipped=None):
+    """
+    Render a job's bills into its ZIP file
+    progress(done) is called as bills are processed. Bills whose text the
+    PDF renderer cannot draw are left out, and their numbers appended to skipped.
+    Returns the number of bills archived.
+    """
+    templates = {}
+
+    def template_for(bill):
+        template_id = bill['template_id']
+        if template_id not in templates:
+            row = db.execute('SELECT * FROM templates WHERE id = ?', (template_id,)).fetchone()
+            if row is None:
+                # Fall back to the user's current template if the bill's is gone
+                row = db.execute('SELECT * FROM templates WHERE user_id = ? ORDER BY id DESC LIMIT 1',
+                                 (bill['user_id'],)).fetchone()
+            templates[template_id] = dict(row) if row else None
+        return templates[template_id]
+
+    pool = get_pool(workers)
+    in_flight = deque()
+    names = set()
+    done = 0
+    written = 0
+    path = archive_path(folder, job)
+    part_path = path + '.part'
+
+    def write_oldest(archive):
+        nonlocal done, written
+        batch_names, future = in_flight.popleft()
+        for (name, bill_number), pdf in zip(batch_names, future.result()):
+            if pdf is None:
+                if skipped is not None:
+                    skipped.append(bill_number)
+                continue
+            archive.writestr(name, pdf)
+            written += 1
+        done += len(batch_names)
+        if progress:
+            progress(done)
+
+    os.makedirs(folder, exist_ok=True)
+    try:
+        # PDF streams are already deflated, so entries are stored as-is
+        with zipfile.ZipFile(part_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            batch = []
+            for bill in _iter_bills(db, job['user_id'], _filters(job)):
+                template = template_for(bill)
+                if template is None:
+                    continue
+                batch.append((bill, template))
+                if len(batch) == BATCH_SIZE:
+                    in_flight.append(([(entry_name(b, names), b['bill_number']) for b, _ in batch],
+                                      pool.submit(_render_batch, batch, upload_folder, fonts)))
+                    batch = []
+                    if len(in_flight) >= workers * MAX_IN_FLIGHT:
+                        write_oldest(archive)
+            if batch:
+                in_flight.append(([(entry_name(b, names), b['bill_number']) for b, _ in batch],
+                                  pool.submit(_render_batch, batch, upload_folder, fonts)))
+            while in_flight:
+                write_oldest(archive)
+        os.replace(part_path, path)
+    except BaseException:
+        for _, future in in_flight:
+            future.cancel()
+        if os.path.exists(part_path):
+            os.unlink(part_path)
+        raise
+    return written
+
+
+@jobs.handler('bill_archive')
+def run_job(payload, job):
+    """Build an archive to completion, recording progress (job handler)"""
+    from flask import current_app
+    from database import get_db
+
+    config = current_app.config
+    db = get_db()
+    job_id = payload['archive_id']
+    archive = db.execute('SELECT * FROM bill_archives WHERE id = ?', (job_id,)).fetchone()
+    if archive is None or archive['status'] != QUEUED or _is_stale(archive):
+        # Cleaned up, or reported as failed, before it ran
+        return None
+    _update(db, job_id, status=RUNNING, done=0, error=None)
+    last_write = 0.0
+
+    def progress(done):
+        nonlocal last_write
+        now = time.monotonic()
+        if now - last_write >= PROGRESS_INTERVAL:
+            _update(db, job_id, done=done)
+            job.touch(db)
+            last_write = now
+
+    skipped = []
+    try:
+        done = build_archive(db, archive, config['ARCHIVE_FOLDER'], config['UPLOAD_FOLDER'],
+                             config['ARCHIVE_WORKERS'], progress, config['PDF_FONTS'], skipped)
+    except Exception as e:
+        if db.in_transaction:
+            db.rollback()
+        _update(db, job_id, status=FAILED, error=str(e) or e.__class__.__name__)
+        raise
+    # A finished archive's error notes the bills it had to leave out
+    note = None
+    if skipped:
+        listed = ', '.join(str(number) for number in skipped[:MAX_SKIPPED_LISTED])
+        more = len(skipped) - MAX_SKIPPED_LISTED
+        note = (f"{len(skipped)} invoice{'s' if len(skipped) != 1 else ''} left out because the server "
+                f"cannot draw their text in a PDF; download them from their preview page: {listed}"
+                + (f' and {more} more' if more > 0 else ''))
+    _update(db, job_id, status=DONE, done=done, total=done, error=note,
+            filename=_archive_filename(archive['date_from'], archive['date_to']))
+    return {'bills': done, 'skipped': len(skipped)}
@@ -0,0 +1,296 @@
+"""
+Spreadsheet export of bill history
+Bills are read oldest first in keyset chunks over (created_at, id), the
+same index the history page uses, and each chunk is encoded and handed to
+the response as soon as it is read. Memory use does not grow with the
+number of rows, the first bytes leave before the last query runs, and no
+read transaction stays open while a slow client downloads.
+
+XLSX files are written directly as a streamed zip with inline strings, so
+no spreadsheet library (and no temporary file) is needed.
+"""
+import csv
+import io
+import json
+import re
+import zipfile
+from datetime import datetime
+from xml.sax.saxutils import escape
+from bill_history import filter_clause
+from migrations import query_sample
+
+DEFAULT_CHUNK_SIZE = 1000
+
+FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# (header, kind) per output column; kind picks the XLSX cell type and style
+BILL_COLUMNS = [
+    ('Bill Number', 'text'),
+    ('Bill Date', 'date'),
+    ('Created At', 'datetime'),
+    ('Customer Name', 'text'),
+    ('Customer Mobile', 'text'),
+    ('Customer Address', 'text'),
+    ('Subtotal', 'money'),
+    ('GST %', 'number'),
+    ('GST Amount', 'money'),
+    ('Total', 'money'),
+]
+
+ITEM_COLUMNS = [
+    ('Line', 'number'),
+    ('Item', 'text'),
+    ('Quantity', 'number'),
+    ('Rate', 'money'),
+    ('Amount', 'money'),
+]
+
+
+def columns(with_items=False):
+    return BILL_COLUMNS + ITEM_COLUMNS if with_items else BILL_COLUMNS
+
+
+def _bill_values(row):
+    return [row['bill_number'], row['bill_date'], row['created_at'], row['customer_name'],
+            row['customer_mobile'], row['customer_address'], row['subtotal'],
+            row['gst_percentage'] if row['gst_enabled'] else 0, row['gst_amount'], row['total']]
+
+
+def _items(items_json):
+    try:
+        items = json.loads(items_json or '[]')
+    except ValueError:
+        return []
+    return [item for item in items if isinstance(item, dict)] if isinstance(items, list) else []
+
+
+def chunk_query(user_id, filters, with_items, position, chunk_size):
+    """SQL and parameters for the chunk of bills after position ((created_at, id) or None)"""
+    where, params = filter_clause(filters)
+    items_column = ', items_json' if with_items else ''
+    keyset = ' AND (created_at, id) > (?, ?)' if position else ''
+    return f'''
+        SELECT id, bill_number, bill_date, created_at, customer_name, customer_mobile,
+            customer_address, subtotal, gst_enabled, gst_percentage, gst_amount, total{items_column}
+        FROM bills b
+        WHERE user_id = ?{where}{keyset}
+        ORDER BY created_at, id
+        LIMIT ?
+    ''', (user_id, *params, *(position or ()), chunk_size)
+
+
+@query_sample('bill_export.iter_chunks')
+def _chunk_samples(db):
+    yield 'first chunk', *chunk_query(1, {}, False, None, DEFAULT_CHUNK_SIZE)
+    yield 'date range with items, later chunk', *chunk_query(
+        1, {'date_from': '2025-04-01', 'date_to': '2026-03-31'}, True, ('2025-06-30 18:20:00', 4200),
+        DEFAULT_CHUNK_SIZE)
+
+
+def iter_chunks(db, user_id, filters=None, with_items=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield lists of output rows (one per bill, or one per line item)
+    Each chunk is read by its own query, continuing after the last
+    (created_at, id) seen.
+    """
+    position = None
+    while True:
+        rows = db.execute(*chunk_query(user_id, filters or {}, with_items, position, chunk_size)).fetchall()
+        if not rows:
+            return
+
+        if with_items:
+            chunk = []
+            for row in rows:
+                bill = _bill_values(row)
+                items = _items(row['items_json'])
+                for line, item in enumerate(items, 1):
+                    chunk.append(bill + [line, item.get('name'), item.get('quantity'),
+                                         item.get('rate'), item.get('amount')])
+                if not items:
+                    chunk.append(bill + [None] * len(ITEM_COLUMNS))
+        else:
+            chunk = [_bill_values(row) for row in rows]
+        yield chunk
+
+        if len(rows) < chunk_size:
+            return
+        position = (rows[-1]['created_at'], rows[-1]['id'])
+
+
+# ============================================
+# CSV
+# ============================================
+
+# Cells starting with these are run as formulas when the file is opened in
+# a spreadsheet ("CSV injection"); such text is prefixed with a quote
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+_PLAIN_NUMBER = re.compile(r'^[+-]?[\d .()]+$')
+
+
+def _csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES) and not _PLAIN_NUMBER.match(value):
+        return "'" + value
+    return value
+
+
+def stream_csv(chunks, with_items=False):
+    """Encode row chunks as CSV, yielding bytes per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # The BOM makes Excel read the file as UTF-8 (customer names, the ₹ sign)
+    buffer.write('\ufeff')
+    writer.writerow([header for header, _ in columns(with_items)])
+    yield buffer.getvalue().encode('utf-8')
+    for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_csv_cell(value) for value in row] for row in chunk)
+        yield buffer.getvalue().encode('utf-8')
+
+
+# ============================================
+# XLSX
+# ============================================
+
+_EXCEL_EPOCH = datetime(1899, 12, 30)
+
+# Characters XML 1.0 does not allow, even escaped
+_XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# Style index (into cellXfs in STYLES_XML) per column kind
+_STYLE = {'text': 0, 'number': 0, 'money': 2, 'date': 3, 'datetime': 4}
+_HEADER_STYLE = 1
+
+CONTENT_TYPES_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>'''
+
+ROOT_RELS_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>'''
+
+WORKBOOK_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Bills" sheetId="1" r:id="rId1"/></sheets>
+</workbook>'''
+
+WORKBOOK_RELS_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>'''
+
+STYLES_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="2"><numFmt numFmtId="164" formatCode="yyyy-mm-dd"/><numFmt numFmtId="165" formatCode="yyyy-mm-dd hh:mm"/></numFmts>
+<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="5">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>
+<xf numFmtId="4" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+</cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>'''
+
+
+def _excel_serial(value, kind):
+    """Excel date serial for a 'YYYY-MM-DD[ HH:MM:SS]' string, or None"""
+    try:
+        moment = datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S' if kind == 'datetime' else '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+    delta = moment - _EXCEL_EPOCH
+    return delta.days + delta.seconds / 86400
+
+
+def _text_cell(value, style=0):
+    text = escape(_XML_ILLEGAL.sub('', str(value)))
+    style_attr = f' s="{style}"' if style else ''
+    return f'<c t="inlineStr"{style_attr}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _cell(value, kind):
+    if value is None or value == '':
+        return '<c/>'
+    if kind in ('date', 'datetime'):
+        serial = _excel_serial(value, kind)
+        if serial is None:
+            return _text_cell(value)
+        return f'<c s="{_STYLE[kind]}"><v>{serial!r}</v></c>'
+    if kind in ('number', 'money'):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return _text_cell(value)
+        style_attr = f' s="{_STYLE[kind]}"' if _STYLE[kind] else ''
+        return f'<c{style_attr}><v>{number!r}</v></c>'
+    return _text_cell(value)
+
+
+class _ZipSink(io.RawIOBase):
+    """Write-only, unseekable file that collects what zipfile writes to it"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_xlsx(chunks, with_items=False):
+    """Encode row chunks as a single-sheet XLSX workbook, yielding bytes as they are produced"""
+    kinds = [kind for _, kind in columns(with_items)]
+    sink = _ZipSink()
+    # An unseekable sink makes zipfile write sizes after each entry, so
+    # nothing has to be rewound
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', CONTENT_TYPES_XML)
+        archive.writestr('_rels/.rels', ROOT_RELS_XML)
+        archive.writestr('xl/workbook.xml', WORKBOOK_XML)
+        archive.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS_XML)
+        archive.writestr('xl/styles.xml', STYLES_XML)
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                        b'<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" '
+                        b'activePane="bottomLeft" state="frozen"/></sheetView></sheetViews><sheetData>')
+            header = ''.join(_text_cell(name, _HEADER_STYLE) for name, _ in columns(with_items))
+            sheet.write(f'<row>{header}</row>'.encode('utf-8'))
+            yield sink.drain()
+            for chunk in chunks:
+                sheet.write(''.join(
+                    '<row>' + ''.join(_cell(value, kind) for value, kind in zip(row, kinds)) + '</row>'
+                    for row in chunk).encode('utf-8'))
+                yield sink.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+
+def stream(fmt, chunks, with_items=False):
+    return stream_xlsx(chunks, with_items) if fmt == 'xlsx' else stream_csv(chunks, with_items)
@@ -0,0 +1,133 @@
+"""
+Bill history queries
+Keyset pagination over (created_at, id) so every page costs the same no
+matter how many bills a user has, plus the date and amount filters shared
+by the history page and its JSON endpoint.
+"""
+import base64
+import json
+from datetime import datetime
+from migrations import query_sample
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+HISTORY_COLUMNS = '''
+    b.id, b.bill_number, b.customer_name, b.customer_mobile, b.subtotal,
+    b.gst_enabled, b.gst_percentage, b.gst_amount, b.total, b.bill_date,
+    b.created_at, t.business_name
+'''
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value.strip(), '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def _parse_amount(value):
+    if value is None or str(value).strip() == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_filters(args):
+    """Read date range and amount filters from request args, dropping invalid values"""
+    return {
+        'date_from': _parse_date(args.get('date_from')),
+        'date_to': _parse_date(args.get('date_to')),
+        'min_amount': _parse_amount(args.get('min_amount')),
+        'max_amount': _parse_amount(args.get('max_amount')),
+    }
+
+
+def parse_page_size(value, default=DEFAULT_PAGE_SIZE):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def encode_cursor(row):
+    """Opaque cursor pointing just past the given row"""
+    raw = json.dumps([row['created_at'], row['id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into (created_at, id), or None if it is malformed"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, bill_id = json.loads(raw)
+        return str(created_at), int(bill_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def filter_clause(filters, alias='b'):
+    """Build the WHERE fragment and parameters for history filters"""
+    clauses = []
+    params = []
+    if filters.get('date_from'):
+        clauses.append(f'{alias}.bill_date >= ?')
+        params.append(filters['date_from'])
+    if filters.get('date_to'):
+        clauses.append(f'{alias}.bill_date <= ?')
+        params.append(filters['date_to'])
+    if filters.get('min_amount') is not None:
+        clauses.append(f'{alias}.total >= ?')
+        params.append(filters['min_amount'])
+    if filters.get('max_amount') is not None:
+        clauses.append(f'{alias}.total <= ?')
+        params.append(filters['max_amount'])
+    return ''.join(f' AND {clause}' for clause in clauses), params
+
+
+def page_query(user_id, filters, position, page_size):
+    """SQL and parameters for a history page (one extra row tells if there is a next)"""
+    where, params = filter_clause(filters)
+    if position:
+        where += ' AND (b.created_at, b.id) < (?, ?)'
+        params.extend(position)
+    return f'''
+        SELECT {HISTORY_COLUMNS}
+        FROM bills b
+        LEFT JOIN templates t ON b.template_id = t.id
+        WHERE b.user_id = ?{where}
+        ORDER BY b.created_at DESC, b.id DESC
+        LIMIT ?
+    ''', (user_id, *params, page_size + 1)
+
+
+@query_sample('bill_history.fetch_page')
+def _page_samples(db):
+    yield 'first page', *page_query(1, {}, None, DEFAULT_PAGE_SIZE)
+    yield 'filtered, later page', *page_query(
+        1, {'date_from': '2025-04-01', 'date_to': '2026-03-31', 'min_amount': 500.0, 'max_amount': 50000.0},
+        ('2025-11-02 10:15:00', 1200), DEFAULT_PAGE_SIZE)
+
+
+def fetch_page(db, user_id, filters=None, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Fetch one page of a user's bills, newest first
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    rows = db.execute(*page_query(user_id, filters or {}, decode_cursor(cursor), page_size)).fetchall()
+
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, encode_cursor(rows[-1])
+    return rows, None
+
+
+def row_to_dict(row):
+    return {key: row[key] for key in row.keys()}
@@ -0,0 +1,145 @@
+"""
+Full-text bill search
+bills_fts (an FTS5 table, see migration 10) indexes each bill's number,
+customer name, mobile and address and the names of its line items under
+rowid = bills.id. insert_bills() adds new bills to it in the same
+transaction, so the index never lags the bills table.
+
+Every bill also carries an owner token ('u<user_id>'); searches AND it with
+the user's terms so FTS5 only scores that user's matching bills. Results are
+ordered by bm25 relevance and paginated by page number, since bm25 has to
+score every match before the first row can be returned anyway.
+
+bm25 also counts, once per query, how many bills in the whole index contain
+each term; that is what makes a word found in nearly every bill (such as
+the bill number prefix) expensive, and why build_match() drops it.
+"""
+import re
+from bill_history import HISTORY_COLUMNS, filter_clause
+from migrations import query_sample, rebuild_bill_search
+
+DEFAULT_PAGE_SIZE = 20
+
+# Searched columns, in index order, with their bm25 weights: a hit on the
+# bill number or customer beats one buried in the address or item list
+SEARCH_WEIGHTS = {
+    'bill_number': 10.0,
+    'customer_name': 5.0,
+    'customer_mobile': 5.0,
+    'customer_address': 1.0,
+    'items': 2.0,
+}
+
+# Longer queries add little but make every MATCH more expensive
+MAX_TERMS = 8
+
+_TERM = re.compile(r'[^\W_]+')
+
+
+def owner_token(user_id):
+    return f'u{int(user_id)}'
+
+
+def build_match(user_id, query, noise=''):
+    """
+    Turn free text into an FTS5 MATCH expression for one user's bills
+    Every word must match somewhere in the searched columns; the last one
+    may be a prefix, for search-as-you-type. Words in noise (text every bill
+    carries, like the bill number prefix) are dropped unless nothing else
+    is left. Returns None if the query contains nothing searchable.
+    """
+    terms = _TERM.findall((query or '').lower())[:MAX_TERMS]
+    noise_terms = set(_TERM.findall((noise or '').lower()))
+    terms = [term for term in terms if term not in noise_terms] or terms
+    if not terms:
+        return None
+    # Terms are quoted so FTS5 operators and column names in user input are
+    # taken literally. Exact terms let FTS5 skip through the owner's postings;
+    # a prefix term has to merge every matching term's list in full, so only
+    # the word still being typed is one.
+    phrases = ' '.join(f'"{term}"' for term in terms[:-1]) + f' "{terms[-1]}"*'
+    return f'owner : {owner_token(user_id)} AND {{{" ".join(SEARCH_WEIGHTS)}}} : ({phrases.strip()})'
+
+
+def index_bills(db, user_id, bills):
+    """Add bills to bills_fts from an iterable of (bill_id, bill_number, bill)"""
+    db.executemany('''
+        INSERT INTO bills_fts (rowid, owner, bill_number, customer_name, customer_mobile,
+            customer_address, items)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [(bill_id, owner_token(user_id), bill_number, bill['customer_name'],
+           bill['customer_mobile'], bill['customer_address'],
+           ' '.join(item['name'] for item in bill['items']))
+          for bill_id, bill_number, bill in bills])
+
+
+def remove_user(db, user_id):
+    """Drop a user's bills from the index (caller deletes the bills themselves)"""
+    db.execute('DELETE FROM bills_fts WHERE rowid IN (SELECT id FROM bills WHERE user_id = ?)',
+               (user_id,))
+
+
+def parse_page(value):
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 1
+
+
+def search_query(match, user_id, filters, page, page_size):
+    """SQL and parameters for a page of search results for a MATCH expression"""
+    where, params = filter_clause(filters)
+    weights = ', '.join(str(weight) for weight in SEARCH_WEIGHTS.values())
+    # CROSS JOIN pins bills_fts as the outer loop; left to itself the planner
+    # walks the user's bills and re-runs the MATCH for every one of them
+    return f'''
+        SELECT {HISTORY_COLUMNS}, bm25(bills_fts, 0, {weights}) AS rank
+        FROM bills_fts
+        CROSS JOIN bills b ON b.id = bills_fts.rowid
+        LEFT JOIN templates t ON b.template_id = t.id
+        WHERE bills_fts MATCH ? AND b.user_id = ?{where}
+        ORDER BY rank, b.id DESC
+        LIMIT ? OFFSET ?
+    ''', (match, user_id, *params, page_size + 1, (page - 1) * page_size)
+
+
+@query_sample('bill_search.search')
+def _search_samples(db):
+    yield 'first page', *search_query(build_match(1, 'acme traders'), 1, {}, 1, DEFAULT_PAGE_SIZE)
+    yield 'filtered, later page', *search_query(
+        build_match(1, 'widg'), 1, {'date_from': '2025-04-01', 'min_amount': 500.0}, 3, DEFAULT_PAGE_SIZE)
+
+
+def search(db, user_id, query, filters=None, page=1, page_size=DEFAULT_PAGE_SIZE, noise=''):
+    """
+    Search a user's bills, best match first
+    filters are the history filters (dates, amounts); noise is passed to
+    build_match(). Returns (rows, next_page); next_page is None on the last
+    page.
+    """
+    match = build_match(user_id, query, noise)
+    if match is None:
+        return [], None
+    rows = db.execute(*search_query(match, user_id, filters or {}, page, page_size)).fetchall()
+
+    if len(rows) > page_size:
+        return rows[:page_size], page + 1
+    return rows, None
+
+
+def rebuild_index(db):
+    """Recompute bills_fts from the bills table in one transaction, then merge its segments"""
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        rebuild_bill_search(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    optimize(db)
+
+
+def optimize(db):
+    """Merge the index's b-tree segments into one, which makes queries cheaper"""
+    db.execute("INSERT INTO bills_fts (bills_fts) VALUES ('optimize')")
+    db.commit()
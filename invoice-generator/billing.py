@@ -0,0 +1,440 @@
+"""
+Bill validation, totals and persistence shared by the bill form, the JSON
+API, the bulk import endpoint and the import-bills CLI command
+"""
+import csv
+import io
+import json
+import math
+from datetime import datetime
+from bill_search import index_bills
+
+BILL_NUMBER_PREFIX = 'INV'
+
+BILL_COLUMNS = ('user_id', 'template_id', 'bill_number', 'customer_name', 'customer_mobile',
+                'customer_address', 'items_json', 'subtotal', 'gst_enabled', 'gst_percentage',
+                'gst_amount', 'total', 'bill_date')
+
+
+class BillError(ValueError):
+    """Raised when a submitted bill cannot be accepted"""
+
+
+def _finite(value):
+    """float(value), refusing the nan and infinities float() also accepts"""
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f'{value!r} is not a finite number')
+    return number
+
+
+def build_items(names, quantities, rates):
+    """
+    Build line items from parallel lists of names, quantities and rates
+    Blank names and unparseable numbers are skipped, as on the bill form.
+    Raises BillError if an item's amount overflows.
+    """
+    items = []
+    for i, name in enumerate(names):
+        name = (name or '').strip()
+        if not name:
+            continue
+        qty = quantities[i] if i < len(quantities) else 0
+        rate = rates[i] if i < len(rates) else 0
+        try:
+            qty = _finite(qty) if qty not in (None, '') else 0
+            rate = _finite(rate) if rate not in (None, '') else 0
+        except (TypeError, ValueError):
+            continue
+        amount = qty * rate
+        if not math.isfinite(amount):
+            raise BillError(f'item {name!r} amount is too large')
+        items.append({
+            'name': name,
+            'quantity': qty,
+            'rate': rate,
+            'amount': amount
+        })
+    return items
+
+
+def compute_totals(items, gst_enabled, gst_percentage):
+    """Return (subtotal, gst_percentage, gst_amount, total) for the items"""
+    subtotal = sum(item['amount'] for item in items)
+    gst_percentage = float(gst_percentage or 0) if gst_enabled else 0
+    gst_amount = (subtotal * gst_percentage / 100) if gst_enabled else 0
+    return subtotal, gst_percentage, gst_amount, subtotal + gst_amount
+
+
+def _truthy(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in ('1', 'true', 'yes', 'on', 'y')
+
+
+def _parse_bill_date(value):
+    if not value:
+        return datetime.now().strftime('%Y-%m-%d')
+    try:
+        return datetime.strptime(str(value).strip(), '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        raise BillError(f'Invalid bill_date {value!r}, expected YYYY-MM-DD')
+
+
+def prepare_bill(data):
+    """
+    Validate one bill dict and compute its totals
+    data: customer_name, customer_mobile, customer_address, bill_date,
+    gst_enabled, gst_percentage and items (list of name/quantity/rate).
+    Raises BillError on invalid input.
+    """
+    customer_name = str(data.get('customer_name') or '').strip()
+    if not customer_name:
+        raise BillError('customer_name is required')
+
+    raw_items = data.get('items') or []
+    if not isinstance(raw_items, list):
+        raise BillError('items must be a list')
+    for position, item in enumerate(raw_items, 1):
+        if not isinstance(item, dict):
+            raise BillError(f'item {position} must be an object')
+        for field in ('quantity', 'rate'):
+            try:
+                _finite(item.get(field) or 0)
+            except (TypeError, ValueError):
+                raise BillError(f'item {position} has invalid {field} {item.get(field)!r}')
+    items = build_items([item.get('name') for item in raw_items],
+                        [item.get('quantity') for item in raw_items],
+                        [item.get('rate') for item in raw_items])
+    if not items:
+        raise BillError('at least one item with a name is required')
+
+    gst_enabled = _truthy(data.get('gst_enabled'))
+    try:
+        gst_percentage = _finite(data.get('gst_percentage') or 0)
+    except (TypeError, ValueError):
+        raise BillError(f"Invalid gst_percentage {data.get('gst_percentage')!r}")
+    if gst_enabled and not 0 <= gst_percentage <= 100:
+        raise BillError('gst_percentage must be between 0 and 100')
+
+    subtotal, gst_percentage, gst_amount, total = compute_totals(items, gst_enabled, gst_percentage)
+    if not math.isfinite(total):
+        raise BillError('bill total is too large')
+    return {
+        'customer_name': customer_name,
+        'customer_mobile': str(data.get('customer_mobile') or '').strip(),
+        'customer_address': str(data.get('customer_address') or '').strip(),
+        'bill_date': _parse_bill_date(data.get('bill_date')),
+        'items': items,
+        'subtotal': subtotal,
+        'gst_enabled': gst_enabled,
+        'gst_percentage': gst_percentage,
+        'gst_amount': gst_amount,
+        'total': total,
+    }
+
+
+class BillNumbering:
+    """How bill numbers are formatted and when their sequence restarts"""
+
+    def __init__(self, prefix=BILL_NUMBER_PREFIX, width=4, financial_year_reset=False,
+                 financial_year_start_month=4):
+        self.prefix = prefix
+        self.width = width
+        self.financial_year_reset = financial_year_reset
+        self.financial_year_start_month = financial_year_start_month
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('BILL_NUMBER_PREFIX', BILL_NUMBER_PREFIX),
+                   config.get('BILL_NUMBER_WIDTH', 4),
+                   config.get('BILL_NUMBER_FY_RESET', False),
+                   config.get('FINANCIAL_YEAR_START_MONTH', 4))
+
+    def financial_year(self, bill_date):
+        """Financial year label for a YYYY-MM-DD date, e.g. '25-26'"""
+        date = datetime.strptime(bill_date, '%Y-%m-%d') if bill_date else datetime.now()
+        start = date.year if date.month >= self.financial_year_start_month else date.year - 1
+        return f"{start % 100:02d}-{(start + 1) % 100:02d}"
+
+    def series(self, bill_date=None):
+        """Key of the sequence a bill dated bill_date draws its number from"""
+        if self.financial_year_reset:
+            return f"{self.prefix}/{self.financial_year(bill_date)}"
+        return self.prefix
+
+    def format(self, number, bill_date=None):
+        if self.financial_year_reset:
+            return f"{self.prefix}/{self.financial_year(bill_date)}/{number:0{self.width}d}"
+        return f"{self.prefix}-{number:0{self.width}d}"
+
+
+DEFAULT_NUMBERING = BillNumbering()
+
+
+def last_bill_sequence(db, user_id):
+    """Sequence number of the user's most recent bill, or 0 (used to seed bill_sequences)"""
+    last_bill = db.execute('SELECT bill_number FROM bills WHERE user_id = ? ORDER BY id DESC LIMIT 1',
+                           (user_id,)).fetchone()
+    if last_bill and last_bill['bill_number']:
+        try:
+            return int(last_bill['bill_number'].split('-')[-1].split('/')[-1])
+        except ValueError:
+            return 0
+    return 0
+
+
+def allocate_bill_numbers(db, user_id, count=1, bill_date=None, numbering=None):
+    """
+    Reserve a block of count consecutive bill numbers for the user
+    The UPDATE ... RETURNING takes the database write lock, so the block is
+    unique across workers and processes. Call it inside the transaction
+    that inserts the bills so a rollback also releases the numbers.
+    """
+    numbering = numbering or DEFAULT_NUMBERING
+    series = numbering.series(bill_date)
+    bump = 'UPDATE bill_sequences SET last_value = last_value + ? WHERE user_id = ? AND series = ? RETURNING last_value'
+    row = db.execute(bump, (count, user_id, series)).fetchone()
+    if row is None:
+        # First bill in this series: continue from any bills numbered before
+        # sequences existed, unless the series restarts every financial year
+        seed = 0 if numbering.financial_year_reset else last_bill_sequence(db, user_id)
+        db.execute('INSERT OR IGNORE INTO bill_sequences (user_id, series, last_value) VALUES (?, ?, ?)',
+                   (user_id, series, seed))
+        row = db.execute(bump, (count, user_id, series)).fetchone()
+    last = row['last_value']
+    return [numbering.format(number, bill_date) for number in range(last - count + 1, last + 1)]
+
+
+def insert_bills(db, user_id, template_id, bills, numbering=None):
+    """
+    Number and insert prepared bills and their line items
+    One block of numbers is reserved per sequence series (a batch can span
+    financial years). Bills and bill_items are each written with a single
+    executemany, and the batch is added to the search index. The caller
+    owns the transaction. Returns a list of (bill_id, bill_number) in input
+    order.
+    """
+    numbering = numbering or DEFAULT_NUMBERING
+    by_series = {}
+    for index, bill in enumerate(bills):
+        by_series.setdefault(numbering.series(bill['bill_date']), []).append(index)
+    numbers = [None] * len(bills)
+    for indexes in by_series.values():
+        block = allocate_bill_numbers(db, user_id, len(indexes), bills[indexes[0]]['bill_date'], numbering)
+        for index, number in zip(indexes, block):
+            numbers[index] = number
+    db.executemany(f'''
+        INSERT INTO bills ({', '.join(BILL_COLUMNS)})
+        VALUES ({', '.join('?' * len(BILL_COLUMNS))})
+    ''', [(user_id, template_id, number, bill['customer_name'], bill['customer_mobile'],
+           bill['customer_address'], json.dumps(bill['items']), bill['subtotal'],
+           bill['gst_enabled'], bill['gst_percentage'], bill['gst_amount'], bill['total'],
+           bill['bill_date'])
+          for number, bill in zip(numbers, bills)])
+
+    # The transaction holds the write lock and bills uses AUTOINCREMENT, so
+    # the rows just inserted have consecutive ids ending at last_insert_rowid()
+    last_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+    bill_ids = range(last_id - len(bills) + 1, last_id + 1)
+    insert_bill_items(db, user_id, zip(bill_ids, (bill['items'] for bill in bills)))
+    add_to_rollups(db, user_id, bills)
+    index_bills(db, user_id, zip(bill_ids, numbers, bills))
+    return list(zip(bill_ids, numbers))
+
+
+def create_bill(db, user_id, template_id, data, numbering=None):
+    """
+    Validate, number and save one bill in its own transaction
+    Returns (bill_id, bill_number); raises BillError before anything is
+    written if the bill is invalid.
+    """
+    bill = prepare_bill(data)
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        (bill_id, bill_number), = insert_bills(db, user_id, template_id, [bill], numbering)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return bill_id, bill_number
+
+
+def add_to_rollups(db, user_id, bills):
+    """Fold a batch of new bills into the user's monthly sales_rollups rows"""
+    buckets = {}
+    for bill in bills:
+        key = ((bill['bill_date'] or datetime.now().strftime('%Y-%m-%d'))[:7],
+               float(bill['gst_percentage'] or 0))
+        bucket = buckets.setdefault(key, [0, 0.0, 0.0, 0.0])
+        bucket[0] += 1
+        bucket[1] += bill['subtotal']
+        bucket[2] += bill['gst_amount']
+        bucket[3] += bill['total']
+    db.executemany('''
+        INSERT INTO sales_rollups (user_id, month, gst_percentage, bill_count,
+            taxable_value, gst_amount, total)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, month, gst_percentage) DO UPDATE SET
+            bill_count = bill_count + excluded.bill_count,
+            taxable_value = taxable_value + excluded.taxable_value,
+            gst_amount = gst_amount + excluded.gst_amount,
+            total = total + excluded.total
+    ''', [(user_id, month, rate, *values) for (month, rate), values in buckets.items()])
+
+
+def insert_bill_items(db, user_id, bills_items):
+    """Write bill_items rows for an iterable of (bill_id, items)"""
+    db.executemany('''
+        INSERT INTO bill_items (bill_id, user_id, position, name, quantity, rate, amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [(bill_id, user_id, position, item['name'], item['quantity'], item['rate'], item['amount'])
+          for bill_id, items in bills_items
+          for position, item in enumerate(items, 1)])
+
+
+def backfill_bill_items(db, batch_size=1000, log=None):
+    """
+    Populate bill_items from bills.items_json for bills that predate it
+    Works in id order, one committed batch at a time, and records its
+    progress in maintenance_state, so an interrupted run resumes where it
+    stopped. Bills that already have items are skipped. Returns the number
+    of bills processed.
+    """
+    row = db.execute("SELECT value FROM maintenance_state WHERE key = 'bill_items_backfill'").fetchone()
+    position = int(row['value']) if row else 0
+    last_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM bills').fetchone()[0]
+    processed = 0
+    while position < last_id:
+        end = position + batch_size
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('''
+                INSERT INTO bill_items (bill_id, user_id, position, name, quantity, rate, amount)
+                SELECT b.id, b.user_id, item.key + 1,
+                    json_extract(item.value, '$.name'),
+                    COALESCE(json_extract(item.value, '$.quantity'), 0),
+                    COALESCE(json_extract(item.value, '$.rate'), 0),
+                    COALESCE(json_extract(item.value, '$.amount'), 0)
+                FROM bills b, json_each(b.items_json) item
+                WHERE b.id > ? AND b.id <= ?
+                    AND json_valid(b.items_json)
+                    AND json_type(b.items_json) = 'array'
+                    AND NOT EXISTS (SELECT 1 FROM bill_items bi WHERE bi.bill_id = b.id)
+            ''', (position, end))
+            db.execute('''
+                INSERT INTO maintenance_state (key, value) VALUES ('bill_items_backfill', ?)
+                ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            ''', (str(min(end, last_id)),))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        processed += db.execute('SELECT COUNT(*) FROM bills WHERE id > ? AND id <= ?',
+                                (position, end)).fetchone()[0]
+        position = min(end, last_id)
+        if log:
+            log(f'Backfilled bills up to id {position} of {last_id}')
+    return processed
+
+
+# ============================================
+# Bulk import parsing
+# ============================================
+
+def parse_jsonl(text):
+    """Yield (row_number, bill_dict_or_error) for JSON lines (or a JSON array)"""
+    stripped = text.lstrip()
+    if stripped.startswith('['):
+        try:
+            records = json.loads(stripped)
+        except ValueError as e:
+            yield 1, BillError(f'Invalid JSON: {e}')
+            return
+        for row, record in enumerate(records, 1):
+            yield row, record if isinstance(record, dict) else BillError('each bill must be an object')
+        return
+
+    for row, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield row, BillError(f'Invalid JSON: {e}')
+            continue
+        yield row, record if isinstance(record, dict) else BillError('each bill must be an object')
+
+
+def parse_csv(text):
+    """
+    Yield (row_number, bill_dict) from CSV with one line item per row
+    Consecutive rows sharing a 'ref' value form one bill; without a ref
+    column every row is its own single-item bill. Row numbers refer to the
+    first data row of each bill (the header is row 1).
+    """
+    reader = csv.DictReader(io.StringIO(text))
+    current_ref = None
+    current = None
+    for row, record in enumerate(reader, 2):
+        record = {(key or '').strip(): (value or '').strip() for key, value in record.items()}
+        ref = record.get('ref') or None
+        item = {'name': record.get('item_name'), 'quantity': record.get('quantity'),
+                'rate': record.get('rate')}
+        if current is not None and ref is not None and ref == current_ref:
+            current[1]['items'].append(item)
+            continue
+        if current is not None:
+            yield current
+        current_ref = ref
+        current = (row, {
+            'customer_name': record.get('customer_name'),
+            'customer_mobile': record.get('customer_mobile'),
+            'customer_address': record.get('customer_address'),
+            'bill_date': record.get('bill_date'),
+            'gst_enabled': record.get('gst_enabled'),
+            'gst_percentage': record.get('gst_percentage'),
+            'items': [item],
+        })
+    if current is not None:
+        yield current
+
+
+def import_bills(db, user_id, template_id, records, numbering=None):
+    """
+    Validate and insert a batch of bills in one transaction
+    records: iterable of (row_number, bill_dict_or_BillError).
+    Returns {'created', 'bill_number_ranges', 'errors'}; invalid rows are
+    reported and skipped, valid rows are all written together. A batch can
+    span financial years, so there is one [first, last] range per numbering
+    series.
+    """
+    numbering = numbering or DEFAULT_NUMBERING
+    prepared = []
+    errors = []
+    for row, record in records:
+        try:
+            if isinstance(record, Exception):
+                raise record
+            prepared.append(prepare_bill(record))
+        except BillError as e:
+            errors.append({'row': row, 'error': str(e)})
+
+    ranges = {}
+    if prepared:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            inserted = insert_bills(db, user_id, template_id, prepared, numbering)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        # Each series' numbers are one consecutive block, handed out in input order
+        for bill, (_bill_id, number) in zip(prepared, inserted):
+            ranges.setdefault(numbering.series(bill['bill_date']), [number, number])[1] = number
+
+    return {
+        'created': len(prepared),
+        'bill_number_ranges': list(ranges.values()),
+        'errors': errors,
+    }
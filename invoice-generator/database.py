@@ -0,0 +1,115 @@
+"""
+Database connection management for the invoice generator
+Connections are kept on flask.g for the whole request and handed back to a
+small per-process pool at teardown, so pragmas are only applied once per
+connection instead of once per query helper.
+"""
+import os
+import queue
+import sqlite3
+import threading
+from flask import g, current_app
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """Bounded LIFO pool of SQLite connections for one database file"""
+
+    def __init__(self, database, pragmas=None, max_size=8, factory=sqlite3.Connection):
+        self.database = database
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self.factory = factory
+        self.max_size = max_size
+        self._idle = queue.LifoQueue(maxsize=max_size)
+        self._pid = os.getpid()
+
+    def connect(self):
+        """Open a new connection with the configured pragmas applied"""
+        db = sqlite3.connect(self.database, check_same_thread=False, factory=self.factory)
+        db.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            db.execute(f'PRAGMA {name} = {value}')
+        return db
+
+    def _check_fork(self):
+        # Connections must never cross a fork (e.g. Gunicorn preload); drop
+        # anything inherited from the parent without closing it.
+        if self._pid != os.getpid():
+            self._idle = queue.LifoQueue(maxsize=self.max_size)
+            self._pid = os.getpid()
+
+    def acquire(self):
+        """Take an idle connection from the pool or open a new one"""
+        self._check_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, db):
+        """Return a connection to the pool, closing it if the pool is full"""
+        self._check_fork()
+        try:
+            if db.in_transaction:
+                db.rollback()
+            self._idle.put_nowait(db)
+        except (queue.Full, sqlite3.Error):
+            db.close()
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def get_pool():
+    """Get the connection pool for the current app's database"""
+    config = current_app.config
+    database = config['DATABASE']
+    pool = _pools.get(database)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(database)
+            if pool is None:
+                pool = ConnectionPool(database, config['SQLITE_PRAGMAS'], config['DB_POOL_SIZE'],
+                                      config['SQLITE_CONNECTION_FACTORY'])
+                _pools[database] = pool
+    return pool
+
+
+def get_db():
+    """Get the database connection for the current request"""
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+
+def close_db(exception=None):
+    """Return the request's connection to the pool"""
+    db = g.pop('db', None)
+    if db is not None:
+        get_pool().release(db)
+
+
+def init_app(app):
+    """Register database configuration defaults and teardown handling"""
+    app.config.setdefault('DATABASE', os.environ.get('DATABASE', 'invoice.db'))
+    app.config.setdefault('SQLITE_PRAGMAS', DEFAULT_PRAGMAS)
+    app.config.setdefault('DB_POOL_SIZE', int(os.environ.get('DB_POOL_SIZE', 8)))
+    # sqlite3.Connection subclass for pooled connections (metrics.py swaps in
+    # one that times every statement)
+    app.config.setdefault('SQLITE_CONNECTION_FACTORY', sqlite3.Connection)
+    app.teardown_appcontext(close_db)
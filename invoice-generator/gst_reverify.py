@@ -0,0 +1,132 @@
+"""
+Bulk GSTIN re-verification
+Walks users.gst_number in id order, rejects malformed numbers offline, and
+checks the rest against the verification service on a bounded thread pool
+sharing one pooled GSTClient. Results are written back to users.gst_verified
+one transaction per batch; numbers the service could not answer for are left
+unchanged and reported as skipped.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from auth import user_cache
+from gst_verification import GSTServiceError, gst_format_error
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _check(client, gst_number):
+    started = time.perf_counter()
+    try:
+        valid, _ = client.verify(gst_number)
+        outcome = 1 if valid else 0
+    except GSTServiceError:
+        outcome = None
+    return outcome, time.perf_counter() - started
+
+
+def _write_back(db, statuses):
+    """Apply {user_id: gst_verified} in one transaction, touching only changed rows"""
+    if not statuses:
+        return 0
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        changed = []
+        for user_id, verified in statuses.items():
+            row = db.execute('''
+                UPDATE users SET gst_verified = ?, version = version + 1
+                WHERE id = ? AND gst_verified IS NOT ?
+                RETURNING id, version
+            ''', (verified, user_id, verified)).fetchone()
+            if row:
+                changed.append(row)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    for row in changed:
+        user_cache.invalidate(row['id'], row['version'])
+    return len(changed)
+
+
+def _batches(db, batch_size, user_ids=None):
+    """Yield users with a GST number in id order, batch_size rows at a time"""
+    if user_ids is not None:
+        ids = sorted(set(user_ids))
+        for start in range(0, len(ids), batch_size):
+            chunk = ids[start:start + batch_size]
+            rows = db.execute(f'''
+                SELECT id, gst_number FROM users
+                WHERE id IN ({', '.join('?' * len(chunk))})
+                    AND gst_number IS NOT NULL AND gst_number != ''
+                ORDER BY id
+            ''', chunk).fetchall()
+            if rows:
+                yield rows
+        return
+
+    last_id = 0
+    while True:
+        rows = db.execute('''
+            SELECT id, gst_number FROM users
+            WHERE id > ? AND gst_number IS NOT NULL AND gst_number != ''
+            ORDER BY id LIMIT ?
+        ''', (last_id, batch_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1]['id']
+
+
+def reverify_users(db, client, workers=8, batch_size=200, user_ids=None, log=None):
+    """
+    Re-verify stored GST numbers and update users.gst_verified
+    user_ids limits the run to those users (e.g. right after an import).
+    Returns a stats dict with counts, throughput and latency percentiles.
+    """
+    stats = {'checked': 0, 'invalid_offline': 0, 'verified': 0, 'rejected': 0,
+             'skipped': 0, 'updated': 0}
+    latencies = []
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for rows in _batches(db, batch_size, user_ids):
+            statuses = {}
+            online = []
+            for row in rows:
+                if gst_format_error(row['gst_number']):
+                    statuses[row['id']] = 0
+                    stats['invalid_offline'] += 1
+                else:
+                    online.append(row)
+            # The pool bounds concurrency; map keeps results in row order
+            results = pool.map(lambda row: _check(client, row['gst_number'].strip().upper()), online)
+            for row, (outcome, elapsed) in zip(online, results):
+                latencies.append(elapsed)
+                if outcome is None:
+                    stats['skipped'] += 1
+                    continue
+                statuses[row['id']] = outcome
+                stats['verified' if outcome else 'rejected'] += 1
+
+            stats['checked'] += len(rows)
+            stats['updated'] += _write_back(db, statuses)
+            if log:
+                log(f"{stats['checked']} checked, {stats['updated']} updated, "
+                    f"{stats['skipped']} skipped (circuit {client.breaker.state})")
+
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    stats.update({
+        'elapsed': elapsed,
+        'throughput': stats['checked'] / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    })
+    return stats
@@ -2,61 +2,250 @@
 GST Verification Module
 Validates GST numbers and optionally verifies them via API
 """
+import json
+import random
 import re
-import requests
-from typing import Dict, Tuple
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 
-def validate_gst_format(gst_number: str) -> bool:
+# 2 digits (state) + PAN (5 letters, 4 digits, 1 letter) + entity code + Z + check digit
+GSTIN_PATTERN = re.compile(r'[0-9]{2}[A-Z]{5}[0-9]{4}[A-Z][1-9A-Z]Z[0-9A-Z]')
+GSTIN_CHARSET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_CHAR_VALUES = {char: value for value, char in enumerate(GSTIN_CHARSET)}
+
+FORMAT_ERROR = 'Invalid GST format. Should be 15 characters (e.g., 29ABCDE1234F1ZW)'
+CHECKSUM_ERROR = 'Invalid GST number: check digit does not match'
+
+def gstin_check_digit(first14: str) -> str:
     """
-    Validate GST number format
-    Format: 2 digits (state code) + 10 chars (PAN) + 1 char (entity number) + Z + 1 check digit
-    Example: 29ABCDE1234F1Z5
+    Compute the GSTIN check digit (mod 36) for the first 14 characters
+    Each character's value is weighted 1, 2, 1, 2, ...; the quotient and
+    remainder of each product by 36 are summed.
     """
+    total = 0
+    for position, char in enumerate(first14):
+        product = _CHAR_VALUES[char] * (2 if position % 2 else 1)
+        total += product // 36 + product % 36
+    return GSTIN_CHARSET[(36 - total % 36) % 36]
+
+def gst_format_error(gst_number: str) -> Optional[str]:
+    """Return why a GST number is malformed, or None if it is well formed"""
     if not gst_number:
-        return False
-    
+        return 'GST number is required'
     gst_number = gst_number.strip().upper()
-    
-    # GST should be 15 characters
-    if len(gst_number) != 15:
-        return False
-    
-    # Pattern: 2 digits + 10 alphanumeric (PAN format) + 1 digit + Z + 1 alphanumeric
-    pattern = r'^[0-9]{2}[A-Z]{5}[0-9]{4}[A-Z]{1}[1-9A-Z]{1}Z[0-9A-Z]{1}$'
-    
-    return bool(re.match(pattern, gst_number))
+    if len(gst_number) != 15 or not GSTIN_PATTERN.fullmatch(gst_number):
+        return FORMAT_ERROR
+    if gstin_check_digit(gst_number[:14]) != gst_number[14]:
+        return CHECKSUM_ERROR
+    return None
+
+def validate_gst_format(gst_number: str) -> bool:
+    """
+    Validate GST number format and check digit
+    Format: 2 digits (state code) + 10 chars (PAN) + 1 char (entity number) + Z + 1 check digit
+    Example: 29ABCDE1234F1ZW
+    """
+    return gst_format_error(gst_number) is None
 
-def verify_gst_online(gst_number: str, api_key: str = None) -> Tuple[bool, Dict]:
+class VerificationCache:
+    """
+    LRU+TTL cache of verify_gst() results keyed by (GST number, online)
+    With persist enabled, results are also kept in the gst_verifications
+    table so they survive restarts and are shared by every worker.
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = 24 * 3600,
+                 negative_ttl: float = 3600, persist: bool = False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.persist = persist
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, bool], db=None) -> Optional[Dict]:
+        """Return a cached result or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return dict(entry[0])
+            self._entries.pop(key, None)
+
+        if self.persist and db is not None:
+            row = db.execute('''
+                SELECT result, expires_at FROM gst_verifications
+                WHERE gst_number = ? AND online = ? AND expires_at > ?
+            ''', (key[0], int(key[1]), now)).fetchone()
+            if row:
+                result = json.loads(row[0])
+                with self._lock:
+                    self.hits += 1
+                    self._store(key, result, row[1])
+                return dict(result)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: Tuple[str, bool], result: Dict, db=None):
+        """Cache a result; invalid results expire after negative_ttl"""
+        expires_at = time.time() + (self.ttl if result.get('valid') else self.negative_ttl)
+        with self._lock:
+            self._store(key, dict(result), expires_at)
+        if self.persist and db is not None:
+            db.execute('''
+                INSERT INTO gst_verifications (gst_number, online, result, expires_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (gst_number, online) DO UPDATE
+                SET result = excluded.result, expires_at = excluded.expires_at
+            ''', (key[0], int(key[1]), json.dumps(result), expires_at))
+            db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, key, result, expires_at):
+        self._entries[key] = (result, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+verification_cache = VerificationCache()
+
+class GSTServiceError(Exception):
+    """The verification service could not give an answer (retryable)"""
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for a while
+    After failure_threshold consecutive failures the circuit opens and calls
+    fail fast for reset_timeout seconds; then one trial call is let through
+    and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+class GSTClient:
+    """
+    HTTP client for a GST verification API
+    Connections are pooled in one requests.Session shared by all threads.
+    Every call has connect/read timeouts, and timeouts, connection errors,
+    429 and 5xx responses are retried with jittered exponential backoff.
+    A CircuitBreaker fails calls fast while the service is down.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, api_url: str, api_key: str = None, timeout: Tuple[float, float] = (3.05, 10),
+                 retries: int = 3, backoff: float = 0.5, pool_size: int = 16,
+                 breaker: CircuitBreaker = None):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        # Imported here: requests is slow to import and only needed once a
+        # verification service is configured
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if api_key:
+            self.session.headers['Authorization'] = f'Bearer {api_key}'
+
+    def verify(self, gst_number: str) -> Tuple[bool, Dict]:
+        """Ask the service about one GST number; raises GSTServiceError if it cannot answer"""
+        import requests
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                raise GSTServiceError('Verification service unavailable (circuit open)')
+            try:
+                response = self.session.post(self.api_url, json={'gst_number': gst_number},
+                                             timeout=self.timeout)
+                if response.status_code in self.RETRY_STATUSES:
+                    raise GSTServiceError(f'Verification service returned {response.status_code}')
+                response.raise_for_status()
+                data = response.json()
+            except (requests.ConnectionError, requests.Timeout, GSTServiceError) as e:
+                self.breaker.record_failure()
+                if attempt == self.retries:
+                    raise GSTServiceError(str(e))
+                # Full jitter: sleep somewhere in [0, backoff * 2^attempt]
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+                continue
+            except (requests.RequestException, ValueError) as e:
+                # 4xx or a malformed body will not improve with retries
+                self.breaker.record_success()
+                raise GSTServiceError(f'Verification service error: {e}')
+            self.breaker.record_success()
+            return bool(data.get('valid', False)), data
+
+    def close(self):
+        self.session.close()
+
+def verify_gst_online(gst_number: str, api_key: str = None, client: GSTClient = None) -> Tuple[bool, Dict]:
     """
     Verify GST number online using API
     Returns: (is_valid, details_dict)
     
-    Note: This is a placeholder. You'll need to integrate with actual GST API
-    Popular options:
-    - GST API by MasterIndia
-    - GST Verification API by various providers
+    With a GSTClient the configured service is queried; service failures
+    come back as details with retryable=True. Without one this stays a
+    placeholder that reports format validation only.
     """
     if not validate_gst_format(gst_number):
         return False, {'error': 'Invalid GST format'}
     
-    # Placeholder for API integration
-    # In production, you would call the actual GST verification API here
-    
-    # Example API call structure (commented out):
-    # try:
-    #     response = requests.post(
-    #         'https://api.gstverification.com/verify',
-    #         json={'gst_number': gst_number},
-    #         headers={'Authorization': f'Bearer {api_key}'},
-    #         timeout=10
-    #     )
-    #     if response.status_code == 200:
-    #         data = response.json()
-    #         return data.get('valid', False), data
-    #     else:
-    #         return False, {'error': 'API error'}
-    # except Exception as e:
-    #     return False, {'error': str(e)}
+    if client is not None:
+        try:
+            return client.verify(gst_number)
+        except GSTServiceError as e:
+            return False, {'error': str(e), 'retryable': True}
     
     # For now, return format validation result
     return True, {
@@ -66,45 +255,55 @@ def verify_gst_online(gst_number: str, api_key: str = None) -> Tuple[bool, Dict]
         'verified_online': False
     }
 
-def verify_gst(gst_number: str, use_api: bool = False, api_key: str = None) -> Dict:
+def verify_gst(gst_number: str, use_api: bool = False, api_key: str = None,
+               cache: VerificationCache = verification_cache, db=None,
+               client: GSTClient = None) -> Dict:
     """
     Main GST verification function
-    Returns a dictionary with verification results
+    Returns a dictionary with verification results. Malformed numbers are
+    rejected offline; well-formed ones are answered from the cache when
+    possible (pass db to use the persistent tier).
     """
-    if not gst_number:
+    error = gst_format_error(gst_number)
+    if error:
         return {
             'valid': False,
-            'error': 'GST number is required',
+            'error': error,
             'verified_online': False
         }
     
     gst_number = gst_number.strip().upper()
-    
-    # First check format
-    if not validate_gst_format(gst_number):
-        return {
-            'valid': False,
-            'error': 'Invalid GST format. Should be 15 characters (e.g., 29ABCDE1234F1Z5)',
-            'verified_online': False
-        }
+    online = bool(client or (use_api and api_key))
+    key = (gst_number, online)
+    if cache is not None:
+        cached = cache.get(key, db)
+        if cached is not None:
+            return cached
     
     # If API verification is requested
-    if use_api and api_key:
-        is_valid, details = verify_gst_online(gst_number, api_key)
-        return {
+    if online:
+        is_valid, details = verify_gst_online(gst_number, api_key, client)
+        result = {
             'valid': is_valid,
             'gst_number': gst_number,
             'details': details,
             'verified_online': True
         }
+        if details.get('retryable'):
+            result['error'] = 'GST verification service unavailable, please try again later'
+    else:
+        # Return format validation only
+        result = {
+            'valid': True,
+            'gst_number': gst_number,
+            'message': 'GST format is valid',
+            'verified_online': False
+        }
     
-    # Return format validation only
-    return {
-        'valid': True,
-        'gst_number': gst_number,
-        'message': 'GST format is valid',
-        'verified_online': False
-    }
+    # Service outages say nothing about the number, so they are not cached
+    if cache is not None and not result.get('details', {}).get('retryable'):
+        cache.put(key, result, db)
+    return result
 
 def extract_state_code(gst_number: str) -> str:
     """Extract state code from GST number"""
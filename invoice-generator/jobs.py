@@ -0,0 +1,404 @@
+"""
+Background jobs
+Slow work is recorded in the jobs table and run by worker threads, so the
+request that asks for it only pays for an INSERT: GST lookups for new
+sign-ups, normalizing uploaded images, purging a deleted user's data and
+building PDF archives. Every process shares the one queue without a broker.
+A worker claims the highest-priority job that is due with a single
+UPDATE ... RETURNING and holds it for JOB_LEASE seconds; if its process
+dies, the lease runs out and the job is queued again.
+
+A handler is registered with @handler(kind) and called with the job's
+payload and its Job inside an app context; its return value is stored as
+the job's JSON result. Failures are retried with exponential backoff up to
+the job's max_attempts, except PermanentJobError.
+
+Each web process starts JOB_WORKERS threads on its first request and, at
+exit, waits up to JOB_SHUTDOWN_TIMEOUT seconds for running jobs. `flask
+run-jobs` runs a dedicated worker process instead (set JOB_WORKERS=0 for
+the web processes).
+"""
+import atexit
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from flask import current_app, g, has_app_context
+from database import get_db
+import metrics
+from migrations import query_sample
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+STATUSES = (QUEUED, RUNNING, DONE, FAILED)
+
+# Higher runs first
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = -10
+
+DEFAULT_WORKERS = 2
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_LEASE = 600
+DEFAULT_RETRY_BACKOFF = 5.0
+DEFAULT_SHUTDOWN_TIMEOUT = 30
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+# Seconds between sweeps for expired leases and old finished jobs
+SWEEP_INTERVAL = 30
+
+HANDLERS = {}
+
+# Set after a request queues a job, so idle workers in this process wake at once
+_wakeup = threading.Event()
+_start_lock = threading.Lock()
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler when retrying cannot help"""
+
+
+def handler(kind):
+    """Register the function that runs jobs of this kind"""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+class Job:
+    """A claimed job, as passed to its handler"""
+
+    def __init__(self, row, lease):
+        self.id = row['id']
+        self.kind = row['kind']
+        self.user_id = row['user_id']
+        self.attempts = row['attempts']
+        self.max_attempts = row['max_attempts']
+        self.payload = json.loads(row['payload'])
+        self.lease = lease
+        self._renew_at = time.monotonic() + lease / 2
+
+    def touch(self, db):
+        """Extend the lease; handlers that may outlive it call this as they make progress"""
+        if time.monotonic() < self._renew_at:
+            return
+        db.execute('UPDATE jobs SET lease_expires = ? WHERE id = ? AND attempts = ?',
+                   (time.time() + self.lease, self.id, self.attempts))
+        db.commit()
+        self._renew_at = time.monotonic() + self.lease / 2
+
+
+# ============================================
+# Queue operations
+# ============================================
+
+def enqueue(db, kind, payload=None, user_id=None, priority=PRIORITY_NORMAL, max_attempts=3, delay=0):
+    """
+    Queue a job and return its id
+    The job is inserted in the caller's transaction (the caller commits), so
+    it exists only if the change that asked for it does. user_id is the
+    user allowed to poll its status.
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f'No handler for job kind {kind!r}')
+    row = db.execute('''
+        INSERT INTO jobs (kind, payload, user_id, priority, max_attempts, run_after)
+        VALUES (?, ?, ?, ?, ?, ?)
+        RETURNING id
+    ''', (kind, json.dumps(payload or {}), user_id, priority, max_attempts, time.time() + delay)).fetchone()
+    if has_app_context():
+        g.jobs_enqueued = True
+    return row['id']
+
+
+# Statements on the partial indexes of migration 13; they are registered
+# with their real status values for explain-queries below
+_CLAIM_SQL = '''
+    UPDATE jobs SET status = ?, attempts = attempts + 1, worker = ?, lease_expires = ?,
+        started_at = CURRENT_TIMESTAMP
+    WHERE id = (
+        SELECT id FROM jobs WHERE status = ? AND run_after <= ?
+        ORDER BY priority DESC, run_after, id LIMIT 1
+    )
+    RETURNING *
+'''
+
+_REQUEUE_EXPIRED_SQL = '''
+    UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END,
+        finished_at = CASE WHEN attempts >= max_attempts THEN CURRENT_TIMESTAMP END,
+        error = 'The worker stopped before the job finished',
+        worker = NULL, lease_expires = NULL, run_after = ?
+    WHERE status = ? AND lease_expires < ?
+'''
+
+_PRUNE_SQL = "DELETE FROM jobs WHERE status = ? AND finished_at < datetime('now', ?)"
+
+
+@query_sample('jobs')
+def _job_samples(db):
+    now = time.time()
+    yield 'claim', _CLAIM_SQL, (RUNNING, 'host:1234:1', now + DEFAULT_LEASE, QUEUED, now)
+    yield 'sweep expired leases', _REQUEUE_EXPIRED_SQL, (FAILED, QUEUED, now, RUNNING, now)
+    yield 'prune finished', _PRUNE_SQL, (DONE, f'-{DEFAULT_MAX_AGE} seconds')
+
+
+def claim(db, worker, lease):
+    """Mark the next due job running and return it, or None"""
+    now = time.time()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute(_CLAIM_SQL, (RUNNING, worker, now + lease, QUEUED, now)).fetchone()
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return Job(row, lease) if row else None
+
+
+def _record(db, job, status, result=None, error=None, run_after=None):
+    # attempts identifies this run: a job whose lease expired may have been
+    # claimed again since, and that run owns it now
+    db.execute('''
+        UPDATE jobs SET status = ?, result = ?, error = ?, worker = NULL, lease_expires = NULL,
+            run_after = COALESCE(?, run_after),
+            finished_at = CASE WHEN ? THEN CURRENT_TIMESTAMP END
+        WHERE id = ? AND attempts = ?
+    ''', (status, None if result is None else json.dumps(result), error, run_after,
+          status in (DONE, FAILED), job.id, job.attempts))
+    db.commit()
+
+
+def run(job):
+    """Run a claimed job's handler and record the outcome; returns 'done', 'retry' or 'failed'"""
+    started = time.perf_counter()
+    db = get_db()
+    try:
+        func = HANDLERS.get(job.kind)
+        if func is None:
+            raise PermanentJobError(f'No handler for job kind {job.kind!r}')
+        result = func(job.payload, job)
+    except Exception as e:
+        if db.in_transaction:
+            db.rollback()
+        error = str(e) or e.__class__.__name__
+        if isinstance(e, PermanentJobError) or job.attempts >= job.max_attempts:
+            logger.exception('Job %s (%s) failed after %d attempt(s)', job.id, job.kind, job.attempts)
+            _record(db, job, FAILED, error=error)
+            outcome = FAILED
+        else:
+            delay = current_app.config['JOB_RETRY_BACKOFF'] * 2 ** (job.attempts - 1)
+            logger.warning('Job %s (%s) failed, retrying in %.0fs: %s', job.id, job.kind, delay, error)
+            _record(db, job, QUEUED, error=error, run_after=time.time() + delay)
+            outcome = 'retry'
+    else:
+        _record(db, job, DONE, result=result)
+        outcome = DONE
+    metrics.JOB_SECONDS.observe((job.kind, outcome), time.perf_counter() - started)
+    return outcome
+
+
+def sweep(db, max_age=DEFAULT_MAX_AGE):
+    """
+    Requeue running jobs whose lease expired (or fail them when out of
+    attempts) and delete jobs that completed more than max_age seconds ago;
+    failed jobs stay for an admin to look at. Returns (requeued, deleted).
+    """
+    now = time.time()
+    requeued = db.execute(_REQUEUE_EXPIRED_SQL, (FAILED, QUEUED, now, RUNNING, now)).rowcount
+    deleted = db.execute(_PRUNE_SQL, (DONE, f'-{int(max_age)} seconds')).rowcount
+    db.commit()
+    return requeued, deleted
+
+
+def run_pending(worker='cli'):
+    """Run every job that is due now in this thread; returns {outcome: count}"""
+    config = current_app.config
+    db = get_db()
+    sweep(db, config['JOB_MAX_AGE'])
+    outcomes = {}
+    while True:
+        job = claim(db, worker, config['JOB_LEASE'])
+        if job is None:
+            return outcomes
+        outcome = run(job)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+
+# ============================================
+# Status
+# ============================================
+
+def job_to_dict(row):
+    return {
+        'id': row['id'],
+        'kind': row['kind'],
+        'status': row['status'],
+        'priority': row['priority'],
+        'attempts': row['attempts'],
+        'max_attempts': row['max_attempts'],
+        'error': row['error'],
+        'result': json.loads(row['result']) if row['result'] else None,
+        'created_at': row['created_at'],
+        'started_at': row['started_at'],
+        'finished_at': row['finished_at'],
+    }
+
+
+def get_job(db, job_id, user_id=None):
+    """A job as a dict, or None; with user_id, only if that user may see it"""
+    row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None or (user_id is not None and row['user_id'] != user_id):
+        return None
+    return job_to_dict(row)
+
+
+def summary(db):
+    """{kind: {status: count}} over every job still in the table"""
+    counts = {}
+    for row in db.execute('SELECT kind, status, COUNT(*) AS n FROM jobs GROUP BY kind, status ORDER BY kind'):
+        counts.setdefault(row['kind'], {})[row['status']] = row['n']
+    return counts
+
+
+def recent_jobs(db, status=None, limit=50):
+    """Newest jobs first, optionally only those with a status"""
+    where, params = ('WHERE status = ?', (status,)) if status else ('', ())
+    rows = db.execute(f'SELECT * FROM jobs {where} ORDER BY id DESC LIMIT ?', (*params, limit)).fetchall()
+    return [job_to_dict(row) for row in rows]
+
+
+def retry(db, job_id):
+    """Queue a failed job again with one more attempt; returns whether it was failed"""
+    updated = db.execute('''
+        UPDATE jobs SET status = ?, run_after = ?, max_attempts = MAX(max_attempts, attempts + 1),
+            finished_at = NULL
+        WHERE id = ? AND status = ?
+    ''', (QUEUED, time.time(), job_id, FAILED)).rowcount
+    if updated and has_app_context():
+        g.jobs_enqueued = True
+    return bool(updated)
+
+
+# ============================================
+# Workers
+# ============================================
+
+class WorkerPool:
+    """Threads that claim and run jobs for one app until stop()"""
+
+    def __init__(self, app, size):
+        self.app = app
+        self.size = size
+        self.pid = os.getpid()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._running = {}
+        self._last_sweep = 0.0
+        self._sweep_lock = threading.Lock()
+
+    def start(self):
+        for number in range(self.size):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{number + 1}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        name = f'{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}'
+        config = self.app.config
+        while not self._stopping.is_set():
+            ran = False
+            try:
+                with self.app.app_context():
+                    db = get_db()
+                    self._maybe_sweep(db)
+                    job = claim(db, name, config['JOB_LEASE'])
+                    if job is not None:
+                        ran = True
+                        self._running[name] = job.id
+                        try:
+                            run(job)
+                        finally:
+                            self._running.pop(name, None)
+            except Exception:
+                logger.exception('Job worker %s error', name)
+            if not ran:
+                _wakeup.wait(config['JOB_POLL_INTERVAL'])
+                _wakeup.clear()
+
+    def _maybe_sweep(self, db):
+        with self._sweep_lock:
+            if time.monotonic() - self._last_sweep < SWEEP_INTERVAL:
+                return
+            self._last_sweep = time.monotonic()
+        requeued, _deleted = sweep(db, self.app.config['JOB_MAX_AGE'])
+        if requeued:
+            logger.warning('Requeued %d job(s) whose worker stopped', requeued)
+
+    def stop(self, timeout=DEFAULT_SHUTDOWN_TIMEOUT):
+        """
+        Stop claiming jobs and wait up to timeout seconds for running ones
+        Returns the ids of jobs still running; they are retried elsewhere
+        once their lease expires.
+        """
+        self._stopping.set()
+        _wakeup.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        unfinished = list(self._running.values())
+        if unfinished:
+            logger.warning('Stopped with job(s) %s still running', ', '.join(map(str, unfinished)))
+        return unfinished
+
+
+def _start_workers():
+    """before_request: start this process's workers on its first request"""
+    app = current_app._get_current_object()
+    if not app.config['JOB_WORKERS']:
+        return
+    pool = app.extensions.get('jobs')
+    # A pool started before a pre-forking server forked has no threads here
+    if pool is not None and pool.pid == os.getpid():
+        return
+    with _start_lock:
+        pool = app.extensions.get('jobs')
+        if pool is not None and pool.pid == os.getpid():
+            return
+        pool = WorkerPool(app, app.config['JOB_WORKERS'])
+        pool.start()
+        app.extensions['jobs'] = pool
+        atexit.register(pool.stop, app.config['JOB_SHUTDOWN_TIMEOUT'])
+
+
+def _notify_workers(exception=None):
+    # Runs after the request's transaction, so the new job is visible
+    if g.pop('jobs_enqueued', False):
+        _wakeup.set()
+
+
+def serve(app, workers):
+    """Run a worker pool in the foreground until SIGINT or SIGTERM (the run-jobs command)"""
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+    pool = WorkerPool(app, workers)
+    pool.start()
+    app.extensions['jobs'] = pool
+    stop.wait()
+    return pool.stop(app.config['JOB_SHUTDOWN_TIMEOUT'])
+
+
+def init_app(app):
+    app.config.setdefault('JOB_WORKERS', DEFAULT_WORKERS)
+    app.config.setdefault('JOB_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+    app.config.setdefault('JOB_LEASE', DEFAULT_LEASE)
+    app.config.setdefault('JOB_RETRY_BACKOFF', DEFAULT_RETRY_BACKOFF)
+    app.config.setdefault('JOB_SHUTDOWN_TIMEOUT', DEFAULT_SHUTDOWN_TIMEOUT)
+    app.config.setdefault('JOB_MAX_AGE', DEFAULT_MAX_AGE)
+    app.before_request(_start_workers)
+    app.teardown_appcontext(_notify_workers)
@@ -0,0 +1,348 @@
+"""
+Request, SQL and template instrumentation with a Prometheus text exposition
+init_app() times every request (before_request/after_request), swaps the
+pooled SQLite connections for InstrumentedConnection so each statement is
+counted and timed against the route that issued it (including fetching its
+rows, where most of a SELECT's work happens), and times Jinja renders
+through Flask's template signals. Statements slower than SLOW_QUERY_MS are
+logged and counted. Each response carries a Server-Timing header splitting
+its time into database, templates and the rest.
+
+Metrics live in this process, like the caches they report on; with several
+workers each one exposes its own numbers. Work done while a streamed
+response body is being sent happens after the request is recorded and is
+not included.
+"""
+import bisect
+import logging
+import math
+import sqlite3
+import threading
+import time
+from flask import g, request, has_app_context, has_request_context, before_render_template, template_rendered
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+DEFAULT_SLOW_QUERY_MS = 100
+
+# Row-by-row iteration is charged to the request in slices of this many
+# seconds rather than per row
+ITERATION_FLUSH_SECONDS = 0.005
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    """Fixed-bucket histogram with labels; buckets are made cumulative when rendered"""
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> per-bucket counts (the last one is +Inf), then the sum
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values[:-1]):
+                cumulative += count
+                le = f'le="{_number(float(bound))}"' if bound != math.inf else 'le="+Inf"'
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(values[-1])}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('invoice_http_request_duration_seconds',
+                            'Time from before_request to after_request, by route', ('route', 'method'))
+REQUESTS = Counter('invoice_http_requests_total', 'Responses by route and status code',
+                   ('route', 'method', 'status'))
+SQL_STATEMENTS = Histogram('invoice_sql_statements_per_request', 'SQL statements executed per request',
+                           ('route',), COUNT_BUCKETS)
+SQL_SECONDS = Histogram('invoice_sql_duration_seconds_per_request',
+                        'Time spent executing SQL per request', ('route',))
+SLOW_STATEMENTS = Counter('invoice_sql_slow_statements_total',
+                          'Statements slower than SLOW_QUERY_MS, by route', ('route',))
+TEMPLATE_SECONDS = Histogram('invoice_template_render_seconds', 'Jinja render time by template',
+                             ('template',))
+JOB_SECONDS = Histogram('invoice_job_duration_seconds', 'Background job run time by kind and outcome',
+                        ('kind', 'outcome'))
+
+METRICS = [REQUEST_SECONDS, REQUESTS, SQL_STATEMENTS, SQL_SECONDS, SLOW_STATEMENTS, TEMPLATE_SECONDS,
+           JOB_SECONDS]
+
+# name -> object with hits and misses attributes
+_caches = {}
+
+
+def register_cache(name, cache):
+    """Report a cache's hits and misses (any object with those two counters)"""
+    _caches[name] = cache
+
+
+def _cache_lines():
+    lines = []
+    samples = [(name, cache.hits, cache.misses) for name, cache in sorted(_caches.items())]
+    for metric, kind, help, value in (
+            ('invoice_cache_hits_total', 'counter', 'Cache lookups answered from the cache', lambda h, m: h),
+            ('invoice_cache_misses_total', 'counter', 'Cache lookups that had to load', lambda h, m: m),
+            ('invoice_cache_hit_ratio', 'gauge', 'Hits over lookups since start',
+             lambda h, m: h / (h + m) if h + m else 0.0)):
+        lines += [f'# HELP {metric} {help}', f'# TYPE {metric} {kind}']
+        lines += [f'{metric}{_labels(("cache",), (name,))} {_number(value(hits, misses))}'
+                  for name, hits, misses in samples]
+    return lines
+
+
+def render():
+    """Every metric in Prometheus text format"""
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += _cache_lines()
+    return '\n'.join(lines) + '\n'
+
+
+# ============================================
+# SQL statement timing
+# ============================================
+
+def _route():
+    return (request.endpoint or 'unmatched') if has_request_context() else None
+
+
+def _record_statement(sql, seconds, before=None):
+    """
+    Charge seconds of a statement's work to the current request
+    before is the statement's time so far when this is a later fetch: the
+    statement is counted once, and flagged slow once, when its total first
+    reaches SLOW_QUERY_MS.
+    """
+    stats = g.get('sql_stats') if has_app_context() else None
+    if stats is not None:
+        if before is None:
+            stats[0] += 1
+        stats[1] += seconds
+    so_far = before or 0.0
+    if so_far < InstrumentedConnection.slow_query_ms / 1000 <= so_far + seconds:
+        route = _route()
+        SLOW_STATEMENTS.inc((route or '-',))
+        if stats is not None:
+            stats[2] += 1
+        logger.warning('Slow SQL (%.1f ms%s) in %s: %s', (so_far + seconds) * 1000,
+                       '' if before is None else ' so far, fetching rows', route or 'background work',
+                       ' '.join(sql.split())[:500])
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """sqlite3 cursor that times its statement and every fetch of its rows"""
+
+    _sql = None
+    _seconds = 0.0
+    _unrecorded = 0.0
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._executed(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self._executed(sql, time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._fetched(time.perf_counter() - started)
+
+    def fetchmany(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(*args, **kwargs)
+        finally:
+            self._fetched(time.perf_counter() - started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._fetched(time.perf_counter() - started)
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except Exception:
+            # StopIteration included: the loop is over
+            self._fetched(time.perf_counter() - started)
+            raise
+        self._unrecorded += time.perf_counter() - started
+        if self._unrecorded >= ITERATION_FLUSH_SECONDS:
+            self._fetched(0.0)
+        return row
+
+    def _executed(self, sql, seconds):
+        if self._unrecorded:
+            self._fetched(0.0)
+        self._sql = sql
+        self._seconds = seconds
+        _record_statement(sql, seconds)
+
+    def _fetched(self, seconds):
+        seconds += self._unrecorded
+        self._unrecorded = 0.0
+        if self._sql is None:
+            return
+        before = self._seconds
+        self._seconds += seconds
+        _record_statement(self._sql, seconds, before)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection whose statements run on InstrumentedCursor; also times commit()"""
+
+    slow_query_ms = DEFAULT_SLOW_QUERY_MS
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute() does not go through cursor(), so route it there
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            _record_statement('COMMIT', time.perf_counter() - started)
+
+
+# ============================================
+# Request and template hooks
+# ============================================
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    # statements, seconds, slow statements
+    g.sql_stats = [0, 0.0, 0]
+    g.template_seconds = 0.0
+
+
+def _finish_request(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.endpoint or 'unmatched'
+    statements, sql_seconds, slow = g.sql_stats
+    REQUEST_SECONDS.observe((route, request.method), elapsed)
+    REQUESTS.inc((route, request.method, str(response.status_code)))
+    SQL_STATEMENTS.observe((route,), statements)
+    SQL_SECONDS.observe((route,), sql_seconds)
+    slow_note = f', {slow} slow' if slow else ''
+    plural = '' if statements == 1 else 's'
+    response.headers['Server-Timing'] = ', '.join([
+        f'db;dur={sql_seconds * 1000:.1f};desc="{statements} SQL statement{plural}{slow_note}"',
+        f'tpl;dur={g.template_seconds * 1000:.1f};desc="Templates"',
+        f'app;dur={elapsed * 1000:.1f};desc="Total"',
+    ])
+    return response
+
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault('template_starts', []).append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    starts = g.get('template_starts')
+    if not starts:
+        return
+    seconds = time.perf_counter() - starts.pop()
+    TEMPLATE_SECONDS.observe((template.name or '<string>',), seconds)
+    # Only the outermost render counts towards the request's template time
+    if not starts and 'template_seconds' in g:
+        g.template_seconds += seconds
+
+
+def init_app(app):
+    """Install the request hooks, template signals and instrumented connections"""
+    app.config.setdefault('METRICS_ENABLED', True)
+    app.config.setdefault('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS)
+    if not app.config['METRICS_ENABLED']:
+        return
+    InstrumentedConnection.slow_query_ms = app.config['SLOW_QUERY_MS']
+    if app.config.get('SQLITE_CONNECTION_FACTORY', sqlite3.Connection) is sqlite3.Connection:
+        app.config['SQLITE_CONNECTION_FACTORY'] = InstrumentedConnection
+    # Call this before registering other request hooks: the timing then
+    # starts before theirs and ends after theirs
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_rendered, app)
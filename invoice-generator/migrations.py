@@ -0,0 +1,449 @@
+"""
+Schema migrations for the invoice generator
+Each migration runs once, in order, inside its own transaction. The schema
+version is tracked with SQLite's PRAGMA user_version.
+"""
+import ast
+import re
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a migration function for a schema version"""
+    def decorator(f):
+        MIGRATIONS.append((version, description, f))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return f
+    return decorator
+
+
+def get_version(db):
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def _columns(db, table):
+    return {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}
+
+
+def migrate(db, target=None, log=None):
+    """
+    Apply pending migrations up to target (default: latest)
+    Returns the list of versions applied.
+    """
+    applied = []
+    for version, description, apply in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        # BEGIN IMMEDIATE serializes concurrent workers; re-check the version
+        # once the write lock is held.
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if get_version(db) >= version:
+                db.rollback()
+                continue
+            apply(db)
+            db.execute(f'PRAGMA user_version = {int(version)}')
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        applied.append(version)
+        if log:
+            log(f'Applied migration {version}: {description}')
+    return applied
+
+
+@migration(1, 'initial schema')
+def _initial_schema(db):
+    # IF NOT EXISTS keeps this safe for databases created before migrations
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            business_name TEXT NOT NULL,
+            business_address TEXT NOT NULL,
+            owner_name TEXT NOT NULL,
+            mobile TEXT NOT NULL,
+            gst_number TEXT,
+            gst_verified INTEGER DEFAULT 0,
+            is_admin INTEGER DEFAULT 0,
+            is_approved INTEGER DEFAULT 0,
+            is_active INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            approved_at TIMESTAMP,
+            approved_by INTEGER,
+            FOREIGN KEY (approved_by) REFERENCES users (id)
+        )
+    ''')
+
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            business_name TEXT NOT NULL,
+            business_address TEXT NOT NULL,
+            owner_name TEXT NOT NULL,
+            mobile TEXT NOT NULL,
+            gst_number TEXT,
+            default_date TEXT,
+            logo_path TEXT,
+            signature_path TEXT,
+            stamp_upload_path TEXT,
+            stamp_data TEXT,
+            stamp_type TEXT,
+            stamp_business_name TEXT,
+            stamp_place TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS bills (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            template_id INTEGER,
+            bill_number TEXT,
+            customer_name TEXT NOT NULL,
+            customer_mobile TEXT,
+            customer_address TEXT,
+            items_json TEXT,
+            subtotal REAL,
+            gst_enabled INTEGER DEFAULT 0,
+            gst_percentage REAL,
+            gst_amount REAL,
+            total REAL,
+            bill_date TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (template_id) REFERENCES templates (id)
+        )
+    ''')
+
+
+@migration(2, 'users.version for user cache invalidation')
+def _users_version(db):
+    if 'version' not in _columns(db, 'users'):
+        db.execute('ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+
+@migration(3, 'indexes for per-user bill, template and admin queries')
+def _hot_query_indexes(db):
+    # History and dashboard: WHERE user_id = ? ORDER BY created_at DESC (id breaks ties)
+    db.execute('CREATE INDEX IF NOT EXISTS idx_bills_user_created ON bills (user_id, created_at, id)')
+    # Bill numbering: WHERE user_id = ? ORDER BY id DESC LIMIT 1
+    db.execute('CREATE INDEX IF NOT EXISTS idx_bills_user_id ON bills (user_id, id)')
+    # Latest template: WHERE user_id = ? ORDER BY id DESC LIMIT 1
+    db.execute('CREATE INDEX IF NOT EXISTS idx_templates_user_id ON templates (user_id, id)')
+    # Admin dashboard filters
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_admin_approved ON users (is_admin, is_approved, created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_admin_created ON users (is_admin, created_at)')
+    db.execute('ANALYZE')
+
+
+
+@migration(4, 'per-user bill number sequences')
+def _bill_sequences(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS bill_sequences (
+            user_id INTEGER NOT NULL,
+            series TEXT NOT NULL,
+            last_value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, series),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+
+
+@migration(5, 'normalized bill_items table')
+def _bill_items(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS bill_items (
+            id INTEGER PRIMARY KEY,
+            bill_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL COLLATE NOCASE,
+            quantity REAL NOT NULL DEFAULT 0,
+            rate REAL NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (bill_id) REFERENCES bills (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_bill_items_user_name ON bill_items (user_id, name)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_bill_items_bill ON bill_items (bill_id)')
+    # Progress markers for resumable maintenance jobs such as backfills
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+
+ROLLUP_MONTH = "substr(COALESCE(NULLIF(bill_date, ''), created_at), 1, 7)"
+
+
+@migration(6, 'monthly sales and GST rollups')
+def _sales_rollups(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS sales_rollups (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            gst_percentage REAL NOT NULL DEFAULT 0,
+            bill_count INTEGER NOT NULL DEFAULT 0,
+            taxable_value REAL NOT NULL DEFAULT 0,
+            gst_amount REAL NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month, gst_percentage),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_sales_rollups(db)
+
+
+def rebuild_sales_rollups(db):
+    """Recompute every sales_rollups row from bills (caller owns the transaction)"""
+    db.execute('DELETE FROM sales_rollups')
+    db.execute(f'''
+        INSERT INTO sales_rollups (user_id, month, gst_percentage, bill_count,
+            taxable_value, gst_amount, total)
+        SELECT user_id, {ROLLUP_MONTH}, COALESCE(gst_percentage, 0), COUNT(*),
+            COALESCE(SUM(subtotal), 0), COALESCE(SUM(gst_amount), 0), COALESCE(SUM(total), 0)
+        FROM bills
+        GROUP BY 1, 2, 3
+    ''')
+
+
+@migration(7, 'generated stamps stored as files instead of data URLs')
+def _stamp_files(db):
+    if 'stamp_path' not in _columns(db, 'templates'):
+        db.execute('ALTER TABLE templates ADD COLUMN stamp_path TEXT')
+    if db.execute("SELECT 1 FROM templates WHERE stamp_data IS NOT NULL AND stamp_data != '' LIMIT 1").fetchone():
+        # Only needed for databases that already hold data URLs
+        from flask import current_app
+        import uploads
+        uploads.extract_stamp_data(db, current_app.config['UPLOAD_FOLDER'])
+
+
+@migration(8, 'templates.version for preview cache invalidation')
+def _templates_version(db):
+    if 'version' not in _columns(db, 'templates'):
+        db.execute('ALTER TABLE templates ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+
+@migration(9, 'persistent GST verification cache')
+def _gst_verifications(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS gst_verifications (
+            gst_number TEXT NOT NULL,
+            online INTEGER NOT NULL DEFAULT 0,
+            result TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (gst_number, online)
+        ) WITHOUT ROWID
+    ''')
+
+
+@migration(10, 'full-text search index over bills')
+def _bill_search(db):
+    # rowid is the bill id; owner holds a 'u<user_id>' token so a search
+    # intersects with that user's postings instead of filtering afterwards
+    db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS bills_fts USING fts5(
+            owner, bill_number, customer_name, customer_mobile, customer_address, items,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    ''')
+    rebuild_bill_search(db)
+
+
+def rebuild_bill_search(db):
+    """Repopulate bills_fts from bills (caller owns the transaction)"""
+    db.execute('DELETE FROM bills_fts')
+    db.execute('''
+        INSERT INTO bills_fts (rowid, owner, bill_number, customer_name, customer_mobile,
+            customer_address, items)
+        SELECT id, 'u' || user_id, bill_number, customer_name, customer_mobile, customer_address,
+            CASE WHEN json_valid(items_json) THEN
+                (SELECT group_concat(json_extract(value, '$.name'), ' ') FROM json_each(items_json))
+            END
+        FROM bills
+    ''')
+
+
+@migration(11, 'bulk PDF archive jobs')
+def _bill_archives(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS bill_archives (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            date_from TEXT,
+            date_to TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            total INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0,
+            filename TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_bill_archives_user ON bill_archives (user_id, created_at)')
+
+
+@migration(12, 'per-user API tokens')
+def _api_tokens(db):
+    # Only a SHA-256 of each token is stored; prefix is shown to tell them apart
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS api_tokens (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            token_hash TEXT NOT NULL UNIQUE,
+            prefix TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_api_tokens_user ON api_tokens (user_id, id)')
+
+
+@migration(13, 'background job queue')
+def _jobs(db):
+    # run_after and lease_expires are Unix times, compared on every claim
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            user_id INTEGER,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after REAL NOT NULL,
+            lease_expires REAL,
+            worker TEXT,
+            result TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (priority DESC, run_after, id)
+        WHERE status = 'queued'
+    ''')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_leases ON jobs (lease_expires) WHERE status = 'running'")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_done ON jobs (finished_at) WHERE status = 'done'")
+    db.execute('CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user_id, id)')
+
+
+@migration(14, 'users change stamp for cross-process user cache invalidation')
+def _users_stamp(db):
+    # One counter bumped by every users.version change or delete; each
+    # process compares it once per request and drops its cached users when
+    # another process (or worker) changed one
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS cache_stamps (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    db.execute("INSERT OR IGNORE INTO cache_stamps (name, value) VALUES ('users', 0)")
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_stamp_update AFTER UPDATE OF version ON users
+        BEGIN
+            UPDATE cache_stamps SET value = value + 1 WHERE name = 'users';
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_stamp_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE cache_stamps SET value = value + 1 WHERE name = 'users';
+        END
+    ''')
+
+
+# ============================================
+# Query plan inspection
+# ============================================
+
+QUERY_SAMPLES = []
+
+
+def query_sample(name):
+    """
+    Register representative queries for explain-queries
+    The decorated function takes the database and yields (variant, sql,
+    params) built by the same code the app runs, with realistic values:
+    dynamic SQL is covered, and the planner sees the values that decide
+    whether a partial index applies. Literal queries not registered here
+    are still found by collect_queries().
+    """
+    def decorator(f):
+        QUERY_SAMPLES.append((name, f))
+        return f
+    return decorator
+
+
+def sample_queries(db):
+    """(location, sql, params) for every registered sample"""
+    queries = []
+    for name, samples in QUERY_SAMPLES:
+        for variant, sql, params in samples(db):
+            location = f'{name} ({variant})' if variant else name
+            queries.append((location, ' '.join(sql.split()), tuple(params)))
+    return queries
+
+
+def collect_queries(path):
+    """Find every literal SQL string passed to .execute()/.executemany() in a module"""
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    queries = []
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr in ('execute', 'executemany') and node.args
+                and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str)):
+            sql = ' '.join(node.args[0].value.split())
+            if sql.split(' ', 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'):
+                queries.append((node.lineno, sql))
+    return sorted(set(queries))
+
+
+_FULL_SCAN = re.compile(r'^SCAN \w+( AS \w+)?( USING (COVERING )?INDEX \w+)?$')
+
+
+def _partial_indexes(db):
+    return {row['name'] for row in db.execute('''
+        SELECT il.name FROM sqlite_master m, pragma_index_list(m.name) il
+        WHERE m.type = 'table' AND il.partial
+    ''')}
+
+
+def explain_queries(db, queries):
+    """
+    Run EXPLAIN QUERY PLAN for each (location, sql, params)
+    params None binds NULL to every placeholder (the literal queries from
+    collect_queries()). Scanning a partial index only reads the rows it
+    covers, so it is not flagged. Yields (location, sql, plan_lines, warnings).
+    """
+    partial = _partial_indexes(db)
+    for location, sql, params in queries:
+        if params is None:
+            params = (None,) * sql.count('?')
+        plan = [row['detail'] for row in db.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+        warnings = [line for line in plan
+                    if (_FULL_SCAN.match(line) and line.rsplit(' ', 1)[-1] not in partial)
+                    or 'TEMP B-TREE' in line]
+        yield location, sql, plan, warnings
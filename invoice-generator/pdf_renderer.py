@@ -0,0 +1,777 @@
+"""
+Server-side PDF rendering for invoices
+Produces compact vector PDFs: text is real, searchable text set in the
+base-14 Helvetica fonts, and the logo, signature and stamp are embedded once
+per document as image XObjects. Item rows that do not fit flow onto
+continuation pages with the table header repeated, and the totals and
+signature block is always kept together, like pagination.js.
+
+Text WinAnsi cannot encode (Tamil, Devanagari, ...) is set in an embedded
+TrueType font instead, subset to the glyphs the document uses. Text that no
+configured font can show, or that needs a shaping engine (Indic conjuncts,
+reordered vowel signs), raises UnsupportedText rather than coming out as
+question marks or misspelled.
+"""
+import functools
+import hashlib
+import io
+import json
+import os
+import re
+import unicodedata
+import zlib
+from PIL import Image
+from truetype import load_font
+
+# A4 in points, 20mm margins (same as pagination.js)
+PAGE_WIDTH = 595.28
+PAGE_HEIGHT = 841.89
+MARGIN = 56.69
+CONTENT_WIDTH = PAGE_WIDTH - 2 * MARGIN
+BOTTOM = PAGE_HEIGHT - MARGIN
+
+# Longest side, in pixels, of embedded images (about 300 dpi at print size)
+MAX_IMAGE_PIXELS = 600
+
+BLUE = (30, 58, 138)
+SLATE = (71, 85, 105)
+MUTED = (100, 116, 139)
+LIGHT = (148, 163, 184)
+BORDER = (226, 232, 240)
+HEADER_FILL = (248, 250, 252)
+BLACK = (15, 23, 42)
+
+# Advance widths (1/1000 em) for characters 32-126, from the standard AFM files
+_HELVETICA = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556,
+    278, 278, 584, 584, 584, 556, 1015,
+    667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833,
+    722, 778, 667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611,
+    278, 278, 278, 469, 556, 333,
+    556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833,
+    556, 556, 556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500,
+    334, 260, 334, 584,
+]
+_HELVETICA_BOLD = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556,
+    333, 333, 584, 584, 584, 611, 975,
+    722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833,
+    722, 778, 667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611,
+    333, 278, 333, 584, 556, 333,
+    556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889,
+    611, 611, 611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500,
+    389, 280, 389, 584,
+]
+FONTS = {
+    'F1': ('Helvetica', _HELVETICA),
+    'F2': ('Helvetica-Bold', _HELVETICA_BOLD),
+}
+REGULAR = 'F1'
+BOLD = 'F2'
+
+# Width of every WinAnsi byte, per Helvetica font
+_BYTE_WIDTHS = {key: [widths[byte - 32] if 32 <= byte <= 126 else 556 for byte in range(256)]
+                for key, (_base, widths) in FONTS.items()}
+
+# TrueType fonts looked for, in this order, when no font list is configured;
+# text Helvetica cannot show uses the first of them with glyphs for it
+FONT_FILES = [
+    'NotoSans-Regular.ttf', 'DejaVuSans.ttf',
+    'NotoSansDevanagari-Regular.ttf', 'NotoSansTamil-Regular.ttf', 'NotoSansTelugu-Regular.ttf',
+    'NotoSansKannada-Regular.ttf', 'NotoSansMalayalam-Regular.ttf', 'NotoSansBengali-Regular.ttf',
+    'NotoSansGujarati-Regular.ttf', 'NotoSansGurmukhi-Regular.ttf', 'NotoSansOriya-Regular.ttf',
+]
+FONT_DIRS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts'),
+    '/usr/share/fonts',
+    '/usr/local/share/fonts',
+]
+
+# Indic text needs a shaping engine, which this renderer does not have, for
+# conjuncts, half forms, reph, reordered vowel signs and consonant-vowel
+# ligatures. It is only drawn when the font's glyphs in typed order read
+# correctly: letters, plus in Devanagari and Tamil the vowel signs that
+# follow their consonant unchanged. Anything else raises UnsupportedText.
+_INDIC = re.compile('[\u0900-\u0dff]')
+_UNSHAPED_SIGNS = frozenset(
+    '\u0901\u0902\u0903\u093c\u093e\u0940\u0941\u0942\u0943\u0947\u0948\u094b\u094c\u094d'
+    '\u0b82\u0bbe\u0bbf\u0bc0\u0bcd'
+)
+# A Devanagari virama before a letter (or a joiner) makes a conjunct, half
+# form or reph; रु रू, டி டீ, ஸ்ரீ and க்ஷ are ligatures in every font
+_SHAPED_SEQUENCES = re.compile(
+    '\u094d(?=[\u200c\u200d]|\\w)|\u0930[\u0941\u0942]|\u0b9f[\u0bbf\u0bc0]'
+    '|[\u0bb6\u0bb8]\u0bcd\u0bb0\u0bc0|\u0b95\u0bcd\u0bb7')
+
+
+class UnsupportedText(ValueError):
+    """Text that cannot be drawn with a document's fonts"""
+
+    def __init__(self, chars, reason='no font has glyphs for it'):
+        super().__init__(f'cannot draw {chars!r}: {reason}')
+        self.chars = chars
+
+
+def _encode(text):
+    """Encode text for a WinAnsi base-14 font"""
+    return text.encode('cp1252')
+
+
+def _needs_shaping(text):
+    """The first word of text that only a shaping engine could draw correctly, or None"""
+    if not _INDIC.search(text):
+        return None
+    for word in text.split():
+        if _SHAPED_SEQUENCES.search(word) or any(
+                _INDIC.match(char) and unicodedata.category(char) in ('Mn', 'Mc')
+                and char not in _UNSHAPED_SIGNS for char in word):
+            return word
+    return None
+
+
+def money(value):
+    return f'Rs. {float(value or 0):.2f}'
+
+
+def _escape(data):
+    return data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+
+def _pdf_string(text):
+    """A PDF text string: literal if Latin-1 can encode it, else UTF-16 hex"""
+    try:
+        return b'(' + _escape(text.encode('latin-1')) + b')'
+    except UnicodeEncodeError:
+        return b'<FEFF' + text.encode('utf-16-be').hex().upper().encode() + b'>'
+
+
+def _color(rgb):
+    return ' '.join(f'{c / 255:.3f}' for c in rgb)
+
+
+# ============================================
+# Embedded fonts
+# ============================================
+
+@functools.lru_cache(maxsize=None)
+def find_fonts(dirs=tuple(FONT_DIRS)):
+    """Paths of the readable FONT_FILES installed under dirs, in FONT_FILES order"""
+    found = {}
+    for top in dirs:
+        for root, _dirs, files in os.walk(top):
+            for name in files:
+                if name in FONT_FILES:
+                    found.setdefault(name, os.path.join(root, name))
+    paths = []
+    for name in FONT_FILES:
+        if name in found:
+            try:
+                load_font(found[name])
+            except (OSError, ValueError):
+                continue
+            paths.append(found[name])
+    return tuple(paths)
+
+
+def _to_unicode(glyphs):
+    """ToUnicode CMap mapping glyph ids back to the text they were set for"""
+    lines = [b'/CIDInit /ProcSet findresource begin', b'12 dict begin', b'begincmap',
+             b'/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def',
+             b'/CMapName /Adobe-Identity-UCS def', b'/CMapType 2 def',
+             b'1 begincodespacerange', b'<0000> <FFFF>', b'endcodespacerange']
+    entries = sorted(glyphs.items())
+    for start in range(0, len(entries), 100):
+        chunk = entries[start:start + 100]
+        lines.append(b'%d beginbfchar' % len(chunk))
+        lines.extend(b'<%04X> <%s>' % (glyph, text.encode('utf-16-be').hex().upper().encode())
+                     for glyph, text in chunk)
+        lines.append(b'endbfchar')
+    lines += [b'endcmap', b'CMapName currentdict /CMap defineresource pop', b'end', b'end']
+    return b'\n'.join(lines)
+
+
+class FontSet:
+    """
+    The fonts of one document
+    Text WinAnsi can encode is set in Helvetica (F1, F2); anything else in
+    the first embedded TrueType font with glyphs for it (U1, U2, ...), with
+    bold drawn by also stroking the outlines. Embedded fonts are written as
+    Type0 fonts subset to the glyphs the document used, with a ToUnicode
+    CMap so the text can still be searched and copied.
+    """
+
+    def __init__(self, paths=None):
+        if paths is None:
+            paths = find_fonts()
+        self.embedded = {f'U{n}': load_font(path) for n, path in enumerate(paths, 1)}
+        self.glyphs = {key: {} for key in self.embedded}
+
+    def _font_for(self, char, font, current):
+        if current in self.embedded and not char.isalpha() and ord(char) in self.embedded[current].cmap:
+            # Spaces, digits and punctuation stay in the script's font
+            return current
+        try:
+            _encode(char)
+            return font
+        except UnicodeEncodeError:
+            pass
+        for key, embedded in self.embedded.items():
+            if ord(char) in embedded.cmap:
+                return key
+        return None
+
+    def runs(self, text, font):
+        """
+        Split text into (font key, text) runs
+        Raises UnsupportedText if no font has a glyph for some character, or
+        the text needs shaping (see _UNSHAPED_SIGNS).
+        """
+        text = str(text)
+        try:
+            _encode(text)
+            return [(font, text)]
+        except UnicodeEncodeError:
+            pass
+        word = _needs_shaping(text)
+        if word:
+            raise UnsupportedText(word, 'it needs a text shaping engine')
+        if '₹' in text and self._font_for('₹', font, None) is None:
+            text = text.replace('₹', 'Rs.')
+        runs = []
+        missing = set()
+        key, run = None, ''
+        for char in text:
+            char_key = self._font_for(char, font, key)
+            if char_key is None:
+                # Invisible format characters (zero width joiners) can go
+                if unicodedata.category(char) != 'Cf':
+                    missing.add(char)
+                continue
+            if char_key != key and run:
+                runs.append((key, run))
+                run = ''
+            key = char_key
+            run += char
+        if missing:
+            raise UnsupportedText(''.join(sorted(missing)))
+        if run or not runs:
+            runs.append((key or font, run))
+        return runs
+
+    def width(self, text, font, size):
+        try:
+            return sum(map(_BYTE_WIDTHS[font].__getitem__, _encode(str(text)))) * size / 1000
+        except UnicodeEncodeError:
+            pass
+        total = 0
+        for key, run in self.runs(text, font):
+            if key in self.embedded:
+                embedded = self.embedded[key]
+                total += sum(embedded.width(embedded.cmap[ord(char)]) for char in run)
+            else:
+                total += sum(map(_BYTE_WIDTHS[key].__getitem__, _encode(run)))
+        return total * size / 1000
+
+    def wrap(self, text, font, size, max_width):
+        """Greedy word wrap; words longer than a line are broken by character"""
+        lines = []
+        for paragraph in str(text or '').splitlines() or ['']:
+            line = ''
+            for word in paragraph.split():
+                candidate = f'{line} {word}' if line else word
+                if self.width(candidate, font, size) <= max_width:
+                    line = candidate
+                    continue
+                if line:
+                    lines.append(line)
+                line = ''
+                for char in word:
+                    if self.width(line + char, font, size) > max_width and line:
+                        lines.append(line)
+                        line = ''
+                    line += char
+            lines.append(line)
+        return lines
+
+    def show(self, key, run):
+        """The string operand that draws a run"""
+        if key not in self.embedded:
+            return b'(' + _escape(_encode(run)) + b')'
+        embedded, used = self.embedded[key], self.glyphs[key]
+        codes = []
+        for char in run:
+            glyph = embedded.cmap[ord(char)]
+            used.setdefault(glyph, char)
+            codes.append(b'%04X' % glyph)
+        return b'<' + b''.join(codes) + b'>'
+
+    def write(self, writer):
+        """Write the fonts the document used; returns {key: object number}"""
+        fonts = {key: writer.add(('<< /Type /Font /Subtype /Type1 /BaseFont /%s '
+                                  '/Encoding /WinAnsiEncoding >>' % base).encode())
+                 for key, (base, _widths) in FONTS.items()}
+        for key, embedded in self.embedded.items():
+            glyphs = self.glyphs[key]
+            if not glyphs:
+                continue
+            # Subset fonts are named with a tag derived from the glyphs they hold
+            digest = hashlib.md5(repr(sorted(glyphs)).encode()).digest()
+            name = ''.join(chr(65 + byte % 26) for byte in digest[:6]) + '+' + embedded.name
+            data = embedded.subset(glyphs)
+            font_file = writer.add_stream(f'/Length1 {len(data)}', data)
+            bbox = ' '.join(f'{embedded.scale(value):.0f}' for value in embedded.bbox)
+            descriptor = writer.add((
+                f'<< /Type /FontDescriptor /FontName /{name} /Flags 4 /FontBBox [{bbox}] /ItalicAngle 0 '
+                f'/Ascent {embedded.scale(embedded.ascent):.0f} /Descent {embedded.scale(embedded.descent):.0f} '
+                f'/CapHeight {embedded.scale(embedded.cap_height):.0f} /StemV 80 '
+                f'/FontFile2 {font_file} 0 R >>').encode())
+            widths = ' '.join(f'{glyph} [{embedded.width(glyph):.0f}]' for glyph in sorted(glyphs))
+            descendant = writer.add((
+                f'<< /Type /Font /Subtype /CIDFontType2 /BaseFont /{name} '
+                '/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> '
+                f'/FontDescriptor {descriptor} 0 R /W [{widths}] /CIDToGIDMap /Identity >>').encode())
+            to_unicode = writer.add_stream('', _to_unicode(glyphs))
+            fonts[key] = writer.add((
+                f'<< /Type /Font /Subtype /Type0 /BaseFont /{name} /Encoding /Identity-H '
+                f'/DescendantFonts [{descendant} 0 R] /ToUnicode {to_unicode} 0 R >>').encode())
+        return fonts
+
+
+# ============================================
+# Low-level PDF object writer
+# ============================================
+
+class PDFWriter:
+    """Minimal PDF 1.4 object writer with a cross-reference table"""
+
+    def __init__(self):
+        self.objects = []
+
+    def reserve(self):
+        self.objects.append(None)
+        return len(self.objects)
+
+    def set(self, number, body):
+        self.objects[number - 1] = body
+
+    def add(self, body):
+        number = self.reserve()
+        self.set(number, body)
+        return number
+
+    def add_stream(self, entries, data, compress=True):
+        if compress:
+            data = zlib.compress(data, 6)
+            entries += ' /Filter /FlateDecode'
+        return self.add(b'<< ' + entries.encode() + b' /Length %d >>\nstream\n' % len(data)
+                        + data + b'\nendstream')
+
+    def tobytes(self, root, info=None):
+        out = io.BytesIO()
+        out.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number, body in enumerate(self.objects, 1):
+            offsets.append(out.tell())
+            out.write(b'%d 0 obj\n' % number + body + b'\nendobj\n')
+        xref = out.tell()
+        out.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(self.objects) + 1))
+        for offset in offsets:
+            out.write(b'%010d 00000 n \n' % offset)
+        trailer = b'<< /Size %d /Root %d 0 R' % (len(self.objects) + 1, root)
+        if info:
+            trailer += b' /Info %d 0 R' % info
+        out.write(b'trailer\n' + trailer + b' >>\nstartxref\n%d\n%%%%EOF\n' % xref)
+        return out.getvalue()
+
+
+class EmbeddedImage:
+    """An image XObject, written to the document once and drawn by name"""
+
+    def __init__(self, name, width, height, entries, data, compress, smask=None):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.entries = entries
+        self.data = data
+        self.compress = compress
+        self.smask = smask
+
+    @classmethod
+    def load(cls, name, source):
+        """Load from a file path or raw bytes; returns None if unreadable"""
+        try:
+            image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+            image.load()
+        except (OSError, ValueError):
+            return None
+
+        too_big = max(image.size) > MAX_IMAGE_PIXELS
+        if image.format == 'JPEG' and image.mode in ('RGB', 'L') and not too_big:
+            if isinstance(source, bytes):
+                data = source
+            else:
+                with open(source, 'rb') as f:
+                    data = f.read()
+            colorspace = '/DeviceRGB' if image.mode == 'RGB' else '/DeviceGray'
+            return cls(name, image.width, image.height,
+                       f'/ColorSpace {colorspace} /BitsPerComponent 8 /Filter /DCTDecode',
+                       data, compress=False)
+
+        if too_big:
+            image.thumbnail((MAX_IMAGE_PIXELS, MAX_IMAGE_PIXELS))
+        smask = None
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            image = image.convert('RGBA')
+            alpha = image.getchannel('A')
+            if alpha.getextrema()[0] < 255:
+                smask = alpha.tobytes()
+        image = image.convert('RGB')
+        return cls(name, image.width, image.height,
+                   '/ColorSpace /DeviceRGB /BitsPerComponent 8', image.tobytes(),
+                   compress=True, smask=smask)
+
+    def write(self, writer):
+        entries = f'/Type /XObject /Subtype /Image /Width {self.width} /Height {self.height} '
+        if self.smask is not None:
+            mask = writer.add_stream(
+                f'/Type /XObject /Subtype /Image /Width {self.width} /Height {self.height} '
+                '/ColorSpace /DeviceGray /BitsPerComponent 8', self.smask)
+            entries += f'/SMask {mask} 0 R '
+        return writer.add_stream(entries + self.entries, self.data, self.compress)
+
+
+class Page:
+    """Drawing operations for one page, using top-down y coordinates"""
+
+    def __init__(self, fonts):
+        self.fonts = fonts
+        self.ops = []
+        self.images = set()
+
+    def text(self, x, y, value, font=REGULAR, size=10, color=BLACK, align='left'):
+        value = str(value)
+        if align != 'left':
+            width = self.fonts.width(value, font, size)
+            x -= width if align == 'right' else width / 2
+        try:
+            data = _encode(value)
+        except UnicodeEncodeError:
+            pass
+        else:
+            self.ops.append(b'BT /%s %.2f Tf %s rg %.2f %.2f Td (%s) Tj ET' % (
+                font.encode(), size, _color(color).encode(), x, PAGE_HEIGHT - y, _escape(data)))
+            return
+        runs = self.fonts.runs(value, font)
+        shown = []
+        for n, (key, run) in enumerate(runs):
+            string = self.fonts.show(key, run)
+            if n:
+                shown.append(b'/%s %.2f Tf' % (key.encode(), size))
+            if key in self.fonts.embedded and font == BOLD:
+                shown.append(b'2 Tr %.2f w %s RG %s Tj 0 Tr' % (size / 30, _color(color).encode(), string))
+            else:
+                shown.append(string + b' Tj')
+        self.ops.append(b'BT /%s %.2f Tf %s rg %.2f %.2f Td %s ET' % (
+            runs[0][0].encode(), size, _color(color).encode(), x, PAGE_HEIGHT - y, b' '.join(shown)))
+
+    def rect(self, x, y, width, height, fill):
+        self.ops.append(b'%s rg %.2f %.2f %.2f %.2f re f' % (
+            _color(fill).encode(), x, PAGE_HEIGHT - y - height, width, height))
+
+    def line(self, x1, y1, x2, y2, color=BORDER, width=0.75):
+        self.ops.append(b'%s RG %.2f w %.2f %.2f m %.2f %.2f l S' % (
+            _color(color).encode(), width, x1, PAGE_HEIGHT - y1, x2, PAGE_HEIGHT - y2))
+
+    def image(self, image, x, y, max_width, max_height, align='left', valign='top'):
+        """Draw an image scaled to fit the box; returns the drawn (width, height)"""
+        scale = min(max_width / image.width, max_height / image.height)
+        width, height = image.width * scale, image.height * scale
+        if align == 'center':
+            x += (max_width - width) / 2
+        elif align == 'right':
+            x += max_width - width
+        if valign == 'bottom':
+            y += max_height - height
+        elif valign == 'middle':
+            y += (max_height - height) / 2
+        self.ops.append(b'q %.2f 0 0 %.2f %.2f %.2f cm /%s Do Q' % (
+            width, height, x, PAGE_HEIGHT - y - height, image.name.encode()))
+        self.images.add(image.name)
+        return width, height
+
+    def content(self):
+        return b'\n'.join(self.ops)
+
+
+# ============================================
+# Invoice layout
+# ============================================
+
+# Items table columns: (key, title, width, align)
+COLUMNS = [
+    ('index', '#', 30, 'left'),
+    ('name', 'ITEM', CONTENT_WIDTH - 250, 'left'),
+    ('quantity', 'QTY', 60, 'right'),
+    ('rate', 'RATE', 80, 'right'),
+    ('amount', 'AMOUNT', 80, 'right'),
+]
+CELL_PADDING = 8
+ROW_LEADING = 12
+TABLE_HEADER_HEIGHT = 24
+
+
+def _stamp_source(template, upload_folder):
+    keys = template.keys()
+    stamp = (template['stamp_path'] if 'stamp_path' in keys else None) or template['stamp_upload_path']
+    if stamp:
+        return os.path.join(upload_folder, stamp)
+    return None
+
+
+class InvoiceRenderer:
+    """Lays out one bill and its template onto A4 pages"""
+
+    def __init__(self, bill, template, items=None, upload_folder='uploads', fonts=None):
+        self.bill = bill
+        self.template = template
+        if items is None:
+            items = json.loads(bill['items_json']) if bill['items_json'] else []
+        self.items = items
+        self.upload_folder = upload_folder
+        self.fonts = FontSet(fonts)
+        self.images = {}
+        self.pages = []
+        self.page = None
+        self.y = MARGIN
+
+    def _image(self, name, source):
+        if not source:
+            return None
+        if isinstance(source, str):
+            source = os.path.join(self.upload_folder, source) if not os.path.isabs(source) else source
+            if not os.path.exists(source):
+                return None
+        if name not in self.images:
+            self.images[name] = EmbeddedImage.load(name, source)
+        return self.images[name]
+
+    def new_page(self, continued=False):
+        self.page = Page(self.fonts)
+        self.pages.append(self.page)
+        self.y = MARGIN
+        if continued:
+            self.page.text(MARGIN, self.y + 10, f"{self.template['business_name']}", BOLD, 10, BLUE)
+            self.page.text(PAGE_WIDTH - MARGIN, self.y + 10,
+                           f"Invoice #{self.bill['bill_number']} (continued)", REGULAR, 10, MUTED, 'right')
+            self.page.line(MARGIN, self.y + 20, PAGE_WIDTH - MARGIN, self.y + 20)
+            self.y += 36
+
+    def render_header(self):
+        page, template, bill = self.page, self.template, self.bill
+        top = self.y
+        x = MARGIN
+        left_bottom = top
+
+        logo = self._image('Logo', template['logo_path'])
+        if logo:
+            page.image(logo, MARGIN, top, 75, 75, align='center', valign='middle')
+            x += 97
+            left_bottom = top + 75
+
+        y = top + 20
+        page.text(x, y, template['business_name'], BOLD, 20, BLUE)
+        y += 6
+        for line in self.fonts.wrap(template['business_address'], REGULAR, 10, 225):
+            y += 13
+            page.text(x, y, line, REGULAR, 10, SLATE)
+        y += 6
+        details = [('Owner:', template['owner_name']), ('Mobile:', template['mobile'])]
+        if template['gst_number'] and bill['gst_enabled']:
+            details.append(('GSTIN:', template['gst_number']))
+        for label, value in details:
+            y += 14
+            page.text(x, y, label, BOLD, 10)
+            page.text(x + self.fonts.width(label, BOLD, 10) + 4, y, value or '', REGULAR, 10)
+        left_bottom = max(left_bottom, y + 4)
+
+        right = PAGE_WIDTH - MARGIN
+        page.text(right, top + 18, 'INVOICE', BOLD, 18, LIGHT, 'right')
+        page.text(right, top + 40, f"#{bill['bill_number']}", BOLD, 12, BLACK, 'right')
+        bill_date = bill['bill_date'] or (bill['created_at'] or '')[:10]
+        page.text(right, top + 56, f'Date: {bill_date}', REGULAR, 10, MUTED, 'right')
+
+        self.y = max(left_bottom, top + 60) + 18
+        page.line(MARGIN, self.y, PAGE_WIDTH - MARGIN, self.y, (238, 238, 238), 1.5)
+        self.y += 26
+
+    def render_customer(self):
+        page, bill = self.page, self.bill
+        page.text(MARGIN, self.y + 9, 'BILL TO', BOLD, 9, MUTED)
+        self.y += 28
+        page.text(MARGIN, self.y, bill['customer_name'], BOLD, 13.5, BLACK)
+        if bill['customer_mobile']:
+            self.y += 15
+            page.text(MARGIN, self.y, bill['customer_mobile'], REGULAR, 10, SLATE)
+        if bill['customer_address']:
+            for line in self.fonts.wrap(bill['customer_address'], REGULAR, 10, 225):
+                self.y += 13
+                page.text(MARGIN, self.y, line, REGULAR, 10, SLATE)
+        self.y += 22
+
+    def render_table_header(self):
+        page = self.page
+        page.rect(MARGIN, self.y, CONTENT_WIDTH, TABLE_HEADER_HEIGHT, HEADER_FILL)
+        page.line(MARGIN, self.y + TABLE_HEADER_HEIGHT, PAGE_WIDTH - MARGIN,
+                  self.y + TABLE_HEADER_HEIGHT, BORDER, 1.5)
+        x = MARGIN
+        for key, title, width, align in COLUMNS:
+            tx = x + CELL_PADDING if align == 'left' else x + width - CELL_PADDING
+            page.text(tx, self.y + 15.5, title, BOLD, 8.5, MUTED, align)
+            x += width
+        self.y += TABLE_HEADER_HEIGHT
+
+    def _row_cells(self, index, item):
+        return {
+            'index': [str(index)],
+            'name': self.fonts.wrap(item.get('name', ''), BOLD, 10, COLUMNS[1][2] - 2 * CELL_PADDING),
+            'quantity': [str(int(float(item.get('quantity') or 0)))],
+            'rate': [money(item.get('rate'))],
+            'amount': [money(item.get('amount'))],
+        }
+
+    def render_items(self):
+        self.render_table_header()
+        for index, item in enumerate(self.items, 1):
+            cells = self._row_cells(index, item)
+            height = max(len(lines) for lines in cells.values()) * ROW_LEADING + 14
+            if self.y + height > BOTTOM:
+                self.new_page(continued=True)
+                self.render_table_header()
+            x = MARGIN
+            for key, _title, width, align in COLUMNS:
+                tx = x + CELL_PADDING if align == 'left' else x + width - CELL_PADDING
+                font = BOLD if key in ('name', 'amount') else REGULAR
+                color = MUTED if key == 'index' else (SLATE if key in ('quantity', 'rate') else BLACK)
+                for n, line in enumerate(cells[key]):
+                    self.page.text(tx, self.y + 17 + n * ROW_LEADING, line, font, 10, color, align)
+                x += width
+            self.y += height
+            self.page.line(MARGIN, self.y, PAGE_WIDTH - MARGIN, self.y)
+        self.y += 20
+
+    def _totals_rows(self):
+        rows = [('Subtotal', money(self.bill['subtotal']))]
+        if self.bill['gst_enabled']:
+            rows.append((f"GST ({self.bill['gst_percentage']}%)", money(self.bill['gst_amount'])))
+        return rows
+
+    def _signature_height(self):
+        return 75 if self.template['stamp_type'] == 'circle' else 115
+
+    def render_totals_and_signature(self):
+        rows = self._totals_rows()
+        totals_height = len(rows) * 22 + 6 + 20 + 30
+        signature_height = self._signature_height() + 6 + 14
+        if self.y + totals_height + signature_height + 34 > BOTTOM:
+            self.new_page(continued=True)
+
+        page = self.page
+        right = PAGE_WIDTH - MARGIN
+        left = right - 190
+        for label, value in rows:
+            self.y += 16
+            page.text(left, self.y, label, REGULAR, 10, SLATE)
+            page.text(right, self.y, value, BOLD if label == 'Subtotal' else REGULAR, 10, SLATE, 'right')
+            self.y += 6
+        self.y += 6
+        page.line(left, self.y, right, self.y, BORDER, 1.5)
+        self.y += 20
+        page.text(left, self.y, 'Total', BOLD, 13.5, BLUE)
+        page.text(right, self.y, money(self.bill['total']), BOLD, 13.5, BLUE, 'right')
+        self.y += 30
+
+        self.render_signature()
+
+        self.y += 30
+        page.text(PAGE_WIDTH / 2, self.y, 'Thank you for your business!', REGULAR, 9, LIGHT, 'center')
+
+    def render_signature(self):
+        page, template = self.page, self.template
+        box_width = 150
+        left = PAGE_WIDTH - MARGIN - box_width
+        area = self._signature_height()
+        top = self.y
+
+        stamp = self._image('Stamp', _stamp_source(template, self.upload_folder))
+        signature = self._image('Signature', template['signature_path'])
+        if template['stamp_type'] == 'circle':
+            # Stamp underneath, signature centred on top of it
+            if stamp:
+                page.image(stamp, left + 5, top, box_width - 10, 68, align='center', valign='bottom')
+            if signature:
+                page.image(signature, left + 5, top + area - 56, box_width - 10, 45,
+                           align='center', valign='bottom')
+        else:
+            # Stamp at the bottom, signature sitting just above it
+            if stamp:
+                page.image(stamp, left + 5, top + area - 68, box_width - 10, 68,
+                           align='right', valign='bottom')
+            if signature:
+                page.image(signature, left + 5, top, box_width - 10, 45,
+                           align='center', valign='bottom')
+
+        self.y = top + area + 6
+        page.line(left, self.y, left + box_width, self.y, LIGHT, 0.75)
+        self.y += 14
+        page.text(left + box_width / 2, self.y, 'AUTHORIZED SIGNATURE', BOLD, 8.5, SLATE, 'center')
+
+    def layout(self):
+        self.new_page()
+        self.render_header()
+        self.render_customer()
+        self.render_items()
+        self.render_totals_and_signature()
+        if len(self.pages) > 1:
+            for number, page in enumerate(self.pages, 1):
+                page.text(PAGE_WIDTH / 2, PAGE_HEIGHT - MARGIN / 2,
+                          f'Page {number} of {len(self.pages)}', REGULAR, 8, LIGHT, 'center')
+        return self.pages
+
+    def render(self):
+        """Lay out the invoice and return the PDF as bytes"""
+        pages = self.layout()
+        writer = PDFWriter()
+        catalog = writer.reserve()
+        pages_root = writer.reserve()
+        fonts = self.fonts.write(writer)
+        images = {name: image.write(writer) for name, image in self.images.items() if image}
+
+        font_resources = ' '.join(f'/{key} {num} 0 R' for key, num in fonts.items())
+        kids = []
+        for page in pages:
+            content = writer.add_stream('', page.content())
+            xobjects = ' '.join(f'/{name} {images[name]} 0 R' for name in sorted(page.images))
+            resources = f'/Font << {font_resources} >>'
+            if xobjects:
+                resources += f' /XObject << {xobjects} >>'
+            kids.append(writer.add((
+                f'<< /Type /Page /Parent {pages_root} 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+                f'/Resources << {resources} >> /Contents {content} 0 R >>').encode()))
+
+        writer.set(pages_root, (f'<< /Type /Pages /Count {len(kids)} /Kids ['
+                                + ' '.join(f'{kid} 0 R' for kid in kids) + '] >>').encode())
+        writer.set(catalog, f'<< /Type /Catalog /Pages {pages_root} 0 R >>'.encode())
+        info = writer.add(b'<< /Title ' + _pdf_string(f"Invoice {self.bill['bill_number']}")
+                          + b' /Producer (Invoice Generator) >>')
+        return writer.tobytes(catalog, info)
+
+
+def render_bill_pdf(bill, template, items=None, upload_folder='uploads', fonts=None):
+    """
+    Render a bills row and its templates row to PDF bytes
+    fonts lists the TrueType files for text Helvetica cannot show (None:
+    find_fonts()). Raises UnsupportedText if the text cannot be drawn.
+    """
+    return InvoiceRenderer(bill, template, items, upload_folder, fonts).render()
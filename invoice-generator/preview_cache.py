@@ -0,0 +1,157 @@
+"""
+Rendered invoice preview cache
+Bills never change after creation, so a preview's HTML depends only on the
+bill, its template row and the Jinja templates on disk. Rendered pages are
+kept in an in-process LRU (and optionally in a directory shared by all
+workers) keyed by (bill_id, template_id, template_version).
+
+templates.version is bumped whenever template() saves; this process forgets
+stale entries immediately and other workers notice within
+TEMPLATE_VERSION_TTL seconds, when they re-read the version.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from database import get_db
+
+CachedPreview = namedtuple('CachedPreview', 'user_id template_id template_version etag html')
+
+# Jinja templates whose source feeds the preview page
+SOURCE_TEMPLATES = ('preview.html', 'base.html')
+
+
+class PreviewCache:
+    """LRU of rendered previews with an optional on-disk second tier"""
+
+    def __init__(self, max_size=256, directory=None, version_ttl=10):
+        self.max_size = max_size
+        self.directory = directory
+        self.version_ttl = version_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._salt = None
+        self._lock = threading.Lock()
+
+    def configure(self, config, template_folder):
+        self.max_size = config['PREVIEW_CACHE_SIZE']
+        self.directory = config['PREVIEW_CACHE_DIR']
+        self.version_ttl = config['TEMPLATE_VERSION_TTL']
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        # Any edit to the page templates changes every ETag and disk key
+        digest = hashlib.sha256()
+        for name in SOURCE_TEMPLATES:
+            with open(os.path.join(template_folder, name), 'rb') as f:
+                digest.update(f.read())
+        self._salt = digest.hexdigest()[:12]
+
+    def template_version(self, template_id, load_version):
+        """Current version of a template, re-read via load_version after the TTL"""
+        now = time.monotonic()
+        with self._lock:
+            known = self._versions.get(template_id)
+        if known and known[1] > now:
+            return known[0]
+        version = load_version(template_id)
+        with self._lock:
+            self._versions[template_id] = (version, now + self.version_ttl)
+        return version
+
+    def get(self, bill_id, user_id, variant, load_version):
+        """Return a CachedPreview for this bill and viewer, or None"""
+        key = (bill_id, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            entry = self._read_disk(key)
+        if (entry is None or entry.user_id != user_id
+                or entry.template_version != self.template_version(entry.template_id, load_version)):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self._store(key, entry)
+        return entry
+
+    def put(self, bill_id, user_id, variant, template_id, template_version, html):
+        """Cache freshly rendered HTML and return the CachedPreview"""
+        etag = hashlib.sha256(f'{self._salt}:{html}'.encode()).hexdigest()[:32]
+        entry = CachedPreview(user_id, template_id, template_version, etag, html)
+        key = (bill_id, variant)
+        with self._lock:
+            known = self._versions.get(template_id)
+            if known and known[0] is not None and (template_version is None or known[0] > template_version):
+                # Rendered from a template row that was replaced mid-request
+                return entry
+            self._versions[template_id] = (template_version, time.monotonic() + self.version_ttl)
+            self._store(key, entry)
+        self._write_disk(key, entry)
+        return entry
+
+    def invalidate_template(self, template_id, version):
+        """Record a template's new version and drop previews rendered with older ones"""
+        with self._lock:
+            self._versions[template_id] = (version, time.monotonic() + self.version_ttl)
+            for key in [key for key, entry in self._entries.items() if entry.template_id == template_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        bill_id, variant = key
+        return os.path.join(self.directory, f'{bill_id}-{variant}-{self._salt}.json')
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._disk_path(key), encoding='utf-8') as f:
+                return CachedPreview(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _write_disk(self, key, entry):
+        if not self.directory:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.preview-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry._asdict(), f)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
+preview_cache = PreviewCache()
+
+
+def init_app(app):
+    app.config.setdefault('PREVIEW_CACHE_SIZE', 256)
+    app.config.setdefault('PREVIEW_CACHE_DIR', os.environ.get('PREVIEW_CACHE_DIR') or None)
+    app.config.setdefault('TEMPLATE_VERSION_TTL', 10)
+    preview_cache.configure(app.config, os.path.join(app.root_path, app.template_folder))
+
+
+def load_template_version(template_id):
+    """Read templates.version (the fallback for cache lookups after the TTL)"""
+    row = get_db().execute('SELECT version FROM templates WHERE id = ?', (template_id,)).fetchone()
+    return row['version'] if row else None
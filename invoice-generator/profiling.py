@@ -0,0 +1,238 @@
+"""
+On-demand request profiling
+A request runs under cProfile when an admin asks for it (an X-Profile
+header or a _profile query flag) or when it is picked by sampling one in
+PROFILE_SAMPLE_RATE requests. Each profile is written to PROFILE_FOLDER as
+a .pstats file with a .json summary (route, duration, status), and
+optionally as collapsed stacks for flamegraph tools, recorded by sampling
+the request thread's stack every PROFILE_STACK_INTERVAL seconds. Only the
+newest PROFILE_KEEP profiles are kept.
+
+Ask for stacks with "X-Profile: stacks" or "_profile=stacks". The profile
+ends in after_request, so the body of a streamed response is not included.
+"""
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from flask import g, request, current_app
+from werkzeug.utils import secure_filename
+
+DEFAULT_KEEP = 50
+DEFAULT_STACK_INTERVAL = 0.005
+
+# pstats orderings offered on the profile page
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+
+# Profiling these would only profile the profiler
+SKIP_ENDPOINTS = {'static', 'metrics_endpoint', 'admin_profiles', 'admin_profile_detail', 'download_profile'}
+
+_sample_counter = itertools.count(1)
+_write_lock = threading.Lock()
+
+
+class StackSampler(threading.Thread):
+    """Samples one thread's Python stack at a fixed interval into collapsed stacks"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profile-stacks', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if self._stop_event.is_set():
+                # The request already finished; this is the profiler shutting down
+                return
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self):
+        """Brendan Gregg's folded format: root;...;leaf count"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def _requested_mode():
+    """'stacks', 'profile' or None from the header or query flag"""
+    value = request.headers.get('X-Profile') or request.args.get('_profile')
+    if not value or value.lower() in ('0', 'false', 'no', 'off'):
+        return None
+    return 'stacks' if value.lower() == 'stacks' else 'profile'
+
+
+def _is_admin():
+    from auth import authenticate_token, get_current_user
+    if 'Authorization' in request.headers:
+        user, _error = authenticate_token()
+    else:
+        user = get_current_user()
+    return bool(user and user['is_admin'])
+
+
+def _should_profile():
+    """(trigger, with_stacks) for this request, or None"""
+    if request.endpoint in SKIP_ENDPOINTS:
+        return None
+    mode = _requested_mode()
+    if mode and _is_admin():
+        return 'requested', mode == 'stacks'
+    rate = current_app.config['PROFILE_SAMPLE_RATE']
+    if rate and next(_sample_counter) % rate == 0:
+        return 'sampled', current_app.config['PROFILE_SAMPLE_STACKS']
+    return None
+
+
+def _start_profile():
+    if sys.getprofile() is not None:
+        # Already profiled, e.g. by a debugger or an outer profiler
+        return
+    decision = _should_profile()
+    if decision is None:
+        return
+    trigger, with_stacks = decision
+    sampler = None
+    if with_stacks:
+        sampler = StackSampler(threading.get_ident(), current_app.config['PROFILE_STACK_INTERVAL'])
+        sampler.start()
+    profiler = cProfile.Profile()
+    g.profile = {'profiler': profiler, 'sampler': sampler, 'trigger': trigger,
+                 'started': time.perf_counter()}
+    profiler.enable()
+
+
+def _stop_profile():
+    state = g.pop('profile', None)
+    if state is None:
+        return None
+    state['profiler'].disable()
+    state['duration'] = time.perf_counter() - state['started']
+    if state['sampler']:
+        state['sampler'].stop()
+    return state
+
+
+def _finish_profile(response):
+    state = _stop_profile()
+    if state is None:
+        return response
+    try:
+        profile_id = save_profile(current_app.config['PROFILE_FOLDER'], current_app.config['PROFILE_KEEP'],
+                                  state, response.status_code)
+    except OSError:
+        current_app.logger.exception('Could not write request profile')
+        return response
+    response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+def _abandon_profile(exception=None):
+    # after_request does not run if the response could not be built
+    _stop_profile()
+
+
+def save_profile(folder, keep, state, status):
+    """Write a finished profile and trim the folder to keep profiles; returns its id"""
+    created = datetime.now()
+    route = request.endpoint or 'unmatched'
+    profile_id = f"{created:%Y%m%d-%H%M%S-%f}-{secure_filename(route)}-{secrets.token_hex(2)}"
+    base = os.path.join(folder, profile_id)
+    os.makedirs(folder, exist_ok=True)
+    state['profiler'].dump_stats(base + '.pstats')
+    if state['sampler']:
+        with open(base + '.collapsed', 'w') as f:
+            f.write(state['sampler'].collapsed())
+    summary = {
+        'id': profile_id,
+        'created_at': created.isoformat(timespec='seconds'),
+        'route': route,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'status': status,
+        'duration_ms': round(state['duration'] * 1000, 2),
+        'trigger': state['trigger'],
+        'user_id': g.current_user_id if 'current_user_id' in g else None,
+        'stacks': bool(state['sampler']),
+    }
+    # The summary is written last: a profile is listed only once it is complete
+    with open(base + '.json', 'w') as f:
+        json.dump(summary, f)
+    with _write_lock:
+        for old in list_profiles(folder)[keep:]:
+            delete_profile(folder, old['id'])
+    return profile_id
+
+
+def list_profiles(folder):
+    """Profile summaries, newest first"""
+    if not os.path.isdir(folder):
+        return []
+    profiles = []
+    for name in os.listdir(folder):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(folder, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return sorted(profiles, key=lambda p: p['id'], reverse=True)
+
+
+def get_profile(folder, profile_id):
+    """One profile's summary, or None"""
+    if secure_filename(profile_id) != profile_id:
+        return None
+    try:
+        with open(os.path.join(folder, profile_id + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def delete_profile(folder, profile_id):
+    for suffix in ('.json', '.pstats', '.collapsed'):
+        try:
+            os.unlink(os.path.join(folder, profile_id + suffix))
+        except FileNotFoundError:
+            pass
+
+
+def top_functions(folder, profile_id, sort=SORT_KEYS[0], limit=40):
+    """pstats' text report of the most expensive functions in a profile"""
+    out = io.StringIO()
+    stats = pstats.Stats(os.path.join(folder, profile_id + '.pstats'), stream=out)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def init_app(app):
+    app.config.setdefault('PROFILE_FOLDER', os.path.join(app.root_path, 'profiles'))
+    app.config.setdefault('PROFILE_KEEP', DEFAULT_KEEP)
+    # Profile one in this many requests (0: only when an admin asks)
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0)
+    app.config.setdefault('PROFILE_SAMPLE_STACKS', False)
+    app.config.setdefault('PROFILE_STACK_INTERVAL', DEFAULT_STACK_INTERVAL)
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    app.teardown_request(_abandon_profile)
@@ -0,0 +1,133 @@
+"""
+Reporting queries for the invoice generator
+Item-level questions are answered with SQL aggregates over bill_items
+rather than by loading and parsing items_json for every bill, and sales
+totals come from the incrementally maintained sales_rollups table.
+"""
+from datetime import datetime
+from migrations import ROLLUP_MONTH, rebuild_sales_rollups
+
+
+def _date_clause(date_from, date_to):
+    clause = ''
+    params = []
+    if date_from:
+        clause += ' AND b.bill_date >= ?'
+        params.append(date_from)
+    if date_to:
+        clause += ' AND b.bill_date <= ?'
+        params.append(date_to)
+    return clause, params
+
+
+def top_items(db, user_id, date_from=None, date_to=None, limit=20):
+    """Best-selling items by revenue, optionally within a bill_date range"""
+    clause, params = _date_clause(date_from, date_to)
+    join = ' JOIN bills b ON b.id = bi.bill_id' if clause else ''
+    rows = db.execute(f'''
+        SELECT bi.name, SUM(bi.quantity) AS quantity, SUM(bi.amount) AS revenue,
+            COUNT(DISTINCT bi.bill_id) AS bills
+        FROM bill_items bi{join}
+        WHERE bi.user_id = ?{clause}
+        GROUP BY bi.name
+        ORDER BY revenue DESC
+        LIMIT ?
+    ''', (user_id, *params, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def item_sales(db, user_id, name, date_from=None, date_to=None):
+    """Quantity and revenue for one item (case-insensitive name match)"""
+    clause, params = _date_clause(date_from, date_to)
+    row = db.execute(f'''
+        SELECT COALESCE(SUM(bi.quantity), 0) AS quantity, COALESCE(SUM(bi.amount), 0) AS revenue,
+            COUNT(DISTINCT bi.bill_id) AS bills
+        FROM bill_items bi
+        JOIN bills b ON b.id = bi.bill_id
+        WHERE bi.user_id = ? AND bi.name = ?{clause}
+    ''', (user_id, name, *params)).fetchone()
+    return {'name': name, **dict(row)}
+
+
+# ============================================
+# Sales and GST rollups
+# ============================================
+
+def parse_month(value):
+    """Validate a YYYY-MM month, returning None if it is malformed"""
+    try:
+        return datetime.strptime((value or '').strip(), '%Y-%m').strftime('%Y-%m')
+    except ValueError:
+        return None
+
+
+def _month_clause(month_from, month_to):
+    clause = ''
+    params = []
+    if month_from:
+        clause += ' AND month >= ?'
+        params.append(month_from)
+    if month_to:
+        clause += ' AND month <= ?'
+        params.append(month_to)
+    return clause, params
+
+
+def monthly_sales(db, user_id, month_from=None, month_to=None):
+    """
+    Monthly revenue, taxable value and GST from sales_rollups, newest first
+    Each month carries a per-GST-rate breakdown. Cost depends on the number
+    of months and rates, not on the number of bills.
+    """
+    clause, params = _month_clause(month_from, month_to)
+    rows = db.execute(f'''
+        SELECT month, gst_percentage, bill_count, taxable_value, gst_amount, total
+        FROM sales_rollups
+        WHERE user_id = ?{clause}
+        ORDER BY month DESC, gst_percentage
+    ''', (user_id, *params)).fetchall()
+
+    months = []
+    for row in rows:
+        if not months or months[-1]['month'] != row['month']:
+            months.append({'month': row['month'], 'bill_count': 0, 'taxable_value': 0.0,
+                           'gst_amount': 0.0, 'total': 0.0, 'rates': []})
+        month = months[-1]
+        for key in ('bill_count', 'taxable_value', 'gst_amount', 'total'):
+            month[key] += row[key]
+        month['rates'].append(dict(row))
+    return months
+
+
+def rollup_discrepancies(db):
+    """Compare sales_rollups with a fresh aggregate over bills; returns mismatched keys"""
+    rows = db.execute(f'''
+        WITH actual AS (
+            SELECT user_id, {ROLLUP_MONTH} AS month, COALESCE(gst_percentage, 0) AS gst_percentage,
+                COUNT(*) AS bill_count, COALESCE(SUM(total), 0) AS total
+            FROM bills
+            GROUP BY 1, 2, 3
+        )
+        SELECT a.user_id, a.month, a.gst_percentage, a.bill_count AS expected_bills,
+            r.bill_count AS rollup_bills, a.total AS expected_total, r.total AS rollup_total
+        FROM actual a
+        LEFT JOIN sales_rollups r USING (user_id, month, gst_percentage)
+        WHERE r.bill_count IS NOT a.bill_count OR abs(r.total - a.total) > 0.005
+        UNION ALL
+        SELECT r.user_id, r.month, r.gst_percentage, 0, r.bill_count, 0, r.total
+        FROM sales_rollups r
+        LEFT JOIN actual a USING (user_id, month, gst_percentage)
+        WHERE a.user_id IS NULL AND r.bill_count != 0
+    ''').fetchall()
+    return [dict(row) for row in rows]
+
+
+def rebuild_rollups(db):
+    """Recompute sales_rollups from bills in one transaction"""
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        rebuild_sales_rollups(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
@@ -0,0 +1,214 @@
+"""
+TrueType font files
+Reads a .ttf just enough to map characters to glyphs (cmap), measure them
+(hmtx) and write a subset holding only some glyphs' outlines (glyf and
+loca), which is what embedding a font in a PDF needs. Glyph ids are kept
+in subsets, so they can be used directly as CIDs. OpenType fonts with CFF
+outlines and font collections are not supported.
+
+benchmarks/check_truetype.py checks the reader against installed fonts.
+"""
+import functools
+import os
+import re
+import struct
+
+
+def _checksum(data):
+    data = bytes(data) + b'\0' * (-len(data) % 4)
+    return sum(struct.unpack(f'>{len(data) // 4}L', data)) & 0xFFFFFFFF
+
+
+def _parse_cmap(table):
+    """Code point -> glyph id, from the font's Unicode cmap subtable"""
+    subtables = {}
+    for i in range(struct.unpack('>H', table[2:4])[0]):
+        platform, encoding, offset = struct.unpack('>HHL', table[4 + 8 * i:12 + 8 * i])
+        if platform == 0 or (platform, encoding) in ((3, 1), (3, 10)):
+            subtables.setdefault(struct.unpack('>H', table[offset:offset + 2])[0], offset)
+
+    cmap = {}
+    if 12 in subtables:
+        offset = subtables[12]
+        groups = struct.unpack('>L', table[offset + 12:offset + 16])[0]
+        for start, end, glyph in struct.iter_unpack('>LLL', table[offset + 16:offset + 16 + 12 * groups]):
+            for code in range(start, end + 1):
+                cmap[code] = glyph + code - start
+    elif 4 in subtables:
+        offset = subtables[4]
+        segments = struct.unpack('>H', table[offset + 6:offset + 8])[0] // 2
+        ends = struct.unpack(f'>{segments}H', table[offset + 14:offset + 14 + 2 * segments])
+        base = offset + 16 + 2 * segments
+        starts = struct.unpack(f'>{segments}H', table[base:base + 2 * segments])
+        deltas = struct.unpack(f'>{segments}h', table[base + 2 * segments:base + 4 * segments])
+        ranges = base + 4 * segments
+        for i in range(segments):
+            range_offset = struct.unpack('>H', table[ranges + 2 * i:ranges + 2 * i + 2])[0]
+            for code in range(starts[i], min(ends[i], 0xFFFE) + 1):
+                if range_offset:
+                    position = ranges + 2 * i + range_offset + 2 * (code - starts[i])
+                    glyph = struct.unpack('>H', table[position:position + 2])[0]
+                    glyph = (glyph + deltas[i]) & 0xFFFF if glyph else 0
+                else:
+                    glyph = (code + deltas[i]) & 0xFFFF
+                if glyph:
+                    cmap[code] = glyph
+    else:
+        raise ValueError('font has no Unicode cmap')
+    return cmap
+
+
+def _postscript_name(table):
+    if not table:
+        return None
+    count, strings = struct.unpack('>HH', table[2:6])
+    for i in range(count):
+        platform, _encoding, _language, name_id, length, offset = struct.unpack(
+            '>6H', table[6 + 12 * i:18 + 12 * i])
+        if name_id == 6 and platform in (1, 3):
+            raw = table[strings + offset:strings + offset + length]
+            name = raw.decode('utf-16-be' if platform == 3 else 'latin-1', errors='ignore')
+            return re.sub(r'[^A-Za-z0-9-]', '', name) or None
+    return None
+
+
+class TrueTypeFont:
+    """
+    A TrueType font file, read just enough to map characters to glyphs
+    (cmap), measure them (hmtx) and write a subset of their outlines
+    (glyf and loca). Glyph ids are used as CIDs, so subsets keep them.
+    """
+
+    def __init__(self, data, name='Font'):
+        if data[:4] not in (b'\x00\x01\x00\x00', b'true'):
+            raise ValueError('not a TrueType font (OpenType CFF fonts and collections are not supported)')
+        self.tables = {}
+        for i in range(struct.unpack('>H', data[4:6])[0]):
+            tag, _checksum, offset, length = struct.unpack('>4sLLL', data[12 + 16 * i:28 + 16 * i])
+            self.tables[tag.decode('latin-1')] = data[offset:offset + length]
+        missing = {'head', 'hhea', 'hmtx', 'maxp', 'loca', 'glyf'} - set(self.tables)
+        if missing:
+            raise ValueError(f"font has no {', '.join(sorted(missing))} table")
+
+        head = self.tables['head']
+        self.units_per_em = struct.unpack('>H', head[18:20])[0]
+        self.bbox = struct.unpack('>4h', head[36:44])
+        long_loca = struct.unpack('>h', head[50:52])[0] == 1
+        self.ascent, self.descent = struct.unpack('>hh', self.tables['hhea'][4:8])
+        metrics = struct.unpack('>H', self.tables['hhea'][34:36])[0]
+        self.num_glyphs = struct.unpack('>H', self.tables['maxp'][4:6])[0]
+
+        hmtx = self.tables['hmtx']
+        self.metrics = list(struct.iter_unpack('>Hh', hmtx[:4 * metrics]))
+        last_advance = self.metrics[-1][0]
+        extra = self.num_glyphs - metrics
+        self.metrics += [(last_advance, lsb) for lsb in
+                         struct.unpack(f'>{extra}h', hmtx[4 * metrics:4 * metrics + 2 * extra])]
+
+        loca = self.tables['loca']
+        if long_loca:
+            self.loca = struct.unpack(f'>{self.num_glyphs + 1}L', loca[:4 * (self.num_glyphs + 1)])
+        else:
+            self.loca = [2 * offset for offset in
+                         struct.unpack(f'>{self.num_glyphs + 1}H', loca[:2 * (self.num_glyphs + 1)])]
+
+        # Subsets written by subset() have no cmap; PDFs map to glyphs themselves
+        self.cmap = _parse_cmap(self.tables['cmap']) if 'cmap' in self.tables else {}
+        os2 = self.tables.get('OS/2', b'')
+        if len(os2) >= 90 and struct.unpack('>H', os2[:2])[0] >= 2:
+            self.cap_height = struct.unpack('>h', os2[88:90])[0]
+        else:
+            self.cap_height = self.ascent
+        self.name = _postscript_name(self.tables.get('name')) or name
+
+    def scale(self, value):
+        """Font units to 1/1000 em"""
+        return value * 1000 / self.units_per_em
+
+    def width(self, glyph):
+        return self.scale(self.metrics[glyph][0])
+
+    def _glyph(self, glyph):
+        return self.tables['glyf'][self.loca[glyph]:self.loca[glyph + 1]]
+
+    def _components(self, glyph):
+        """Glyph ids a composite glyph is built from"""
+        data = self._glyph(glyph)
+        if len(data) < 10 or struct.unpack('>h', data[:2])[0] >= 0:
+            return []
+        components = []
+        position = 10
+        while True:
+            flags, component = struct.unpack('>HH', data[position:position + 4])
+            components.append(component)
+            position += 8 if flags & 0x1 else 6
+            position += 8 if flags & 0x80 else 4 if flags & 0x40 else 2 if flags & 0x8 else 0
+            if not flags & 0x20:
+                return components
+
+    def subset(self, glyphs):
+        """Font file with only the given glyphs' outlines (plus .notdef and composite parts)"""
+        keep = set()
+        pending = [0, *glyphs]
+        while pending:
+            glyph = pending.pop()
+            if glyph not in keep and glyph < self.num_glyphs:
+                keep.add(glyph)
+                pending.extend(self._components(glyph))
+
+        count = max(keep) + 1
+        glyf = bytearray()
+        loca = []
+        hmtx = bytearray()
+        for glyph in range(count):
+            loca.append(len(glyf))
+            if glyph in keep:
+                outline = self._glyph(glyph)
+                glyf += outline + b'\0' * (-len(outline) % 4)
+                hmtx += struct.pack('>Hh', *self.metrics[glyph])
+            else:
+                hmtx += b'\0\0\0\0'
+        loca.append(len(glyf))
+
+        head = bytearray(self.tables['head'])
+        head[8:12] = b'\0\0\0\0'
+        head[50:52] = struct.pack('>h', 1)
+        hhea = bytearray(self.tables['hhea'])
+        hhea[34:36] = struct.pack('>H', count)
+        maxp = bytearray(self.tables['maxp'])
+        maxp[4:6] = struct.pack('>H', count)
+        tables = {tag: self.tables[tag] for tag in ('cvt ', 'fpgm', 'prep') if tag in self.tables}
+        tables.update({'head': head, 'hhea': hhea, 'maxp': maxp, 'hmtx': hmtx,
+                       'loca': struct.pack(f'>{count + 1}L', *loca), 'glyf': glyf})
+        return _sfnt(tables)
+
+
+def _sfnt(tables):
+    """Assemble a TrueType file from its tables, with checksums set"""
+    tags = sorted(tables)
+    power = 1 << (len(tags).bit_length() - 1)
+    header = struct.pack('>LHHHH', 0x00010000, len(tags), 16 * power, power.bit_length() - 1,
+                         16 * (len(tags) - power))
+    directory = bytearray()
+    body = bytearray()
+    offset = len(header) + 16 * len(tags)
+    for tag in tags:
+        data = bytes(tables[tag])
+        if tag == 'head':
+            head = offset + len(body)
+        directory += struct.pack('>4sLLL', tag.encode('latin-1'), _checksum(data), offset + len(body), len(data))
+        body += data + b'\0' * (-len(data) % 4)
+    font = bytearray(header + directory + body)
+    font[head + 8:head + 12] = struct.pack('>L', (0xB1B0AFBA - _checksum(font)) & 0xFFFFFFFF)
+    return bytes(font)
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(path):
+    """Parse a TrueType file once per process; raises ValueError if it is not one"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        return TrueTypeFont(data, os.path.splitext(os.path.basename(path))[0])
+    except (struct.error, IndexError) as e:
+        raise ValueError(f'{path}: damaged font file ({e})') from None
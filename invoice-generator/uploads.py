@@ -0,0 +1,320 @@
+"""
+Content-addressed upload store
+Uploaded logos, signatures and stamps are normalized with Pillow (resized to
+the size they are printed at, metadata stripped, recompressed) and saved under
+a name derived from the SHA-256 of the result, so identical images are stored
+once no matter how often they are uploaded.
+
+The template form does not wait for this: the request keeps the file as
+received (store_incoming) and a background job swaps in the normalized copy
+(finish_incoming).
+"""
+import base64
+import binascii
+import hashlib
+import io
+import mimetypes
+import os
+import secrets
+import tempfile
+import time
+from flask import current_app, request, send_from_directory
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import safe_join
+
+# Largest box each kind is drawn in on the invoice (CSS px, see preview.html)
+PRINT_SIZES = {
+    'logo': (100, 100),
+    'signature': (140, 60),
+    'stamp': (140, 90),
+}
+
+# Pixels per CSS px, so images stay sharp when printed at ~300 dpi
+DEFAULT_SCALE = 3
+
+JPEG_QUALITY = 85
+
+HASH_LENGTH = 32
+
+# Template columns holding upload filenames, and the kind of image each holds
+TEMPLATE_FILE_COLUMNS = {
+    'logo_path': 'logo',
+    'signature_path': 'signature',
+    'stamp_upload_path': 'stamp',
+    'stamp_path': 'stamp',
+}
+
+# Uploads waiting for finish_incoming() are stored as incoming-<random>.<ext>
+INCOMING_PREFIX = 'incoming-'
+INCOMING_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'MPO': 'jpg'}
+
+# Content-addressed files never change, so browsers may keep them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def normalize_image(source, kind, scale=DEFAULT_SCALE):
+    """
+    Decode, orient, downscale and re-encode an image
+    Returns (data, extension). Raises ValueError if source is not an image.
+    """
+    # Pillow is imported on first use to keep worker start-up fast
+    from PIL import Image, ImageOps, UnidentifiedImageError
+    width, height = PRINT_SIZES[kind]
+    box = (width * scale, height * scale)
+    try:
+        img = Image.open(source)
+        # Let the JPEG decoder skip straight to a reduced scale for big photos
+        img.draft('RGB', box)
+        img = ImageOps.exif_transpose(img)
+        img.load()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f'Not a valid image: {e}')
+
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+    img.thumbnail(box, Image.LANCZOS)
+    # Drop EXIF, ICC profiles, text chunks and anything else carried over
+    img.info = {}
+
+    out = io.BytesIO()
+    if has_alpha:
+        img.save(out, 'PNG', optimize=True)
+        return out.getvalue(), 'png'
+    if img.getcolors(256) is not None:
+        # Flat artwork (typical logos) compresses best as a palette PNG
+        img.convert('P', palette=Image.ADAPTIVE, colors=256).save(out, 'PNG', optimize=True)
+        return out.getvalue(), 'png'
+    img.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue(), 'jpg'
+
+
+def store_bytes(upload_folder, data, extension):
+    """Write data under its content hash unless already stored; returns the filename"""
+    filename = f'{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}.{extension}'
+    path = os.path.join(upload_folder, filename)
+    if os.path.exists(path):
+        # Refresh the mtime so a concurrent GC pass treats it as new
+        os.utime(path)
+        return filename
+    _write_file(upload_folder, path, data)
+    return filename
+
+
+def _write_file(upload_folder, path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=upload_folder, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp creates 0600; uploads are public assets
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def store_upload(upload_folder, source, kind, scale=DEFAULT_SCALE):
+    """Normalize an uploaded image and store it; returns the stored filename"""
+    data, extension = normalize_image(source, kind, scale)
+    return store_bytes(upload_folder, data, extension)
+
+
+def decode_data_url(data_url):
+    """Bytes of a base64 image data URL (as produced by canvas.toDataURL)"""
+    header, _, payload = (data_url or '').partition(',')
+    if not header.startswith('data:image/') or not header.endswith(';base64') or not payload:
+        raise ValueError('Not a base64 image data URL')
+    try:
+        return base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError('Invalid base64 image data')
+
+
+def store_data_url(upload_folder, data_url, kind, scale=DEFAULT_SCALE):
+    """Decode a base64 image data URL and store it"""
+    return store_upload(upload_folder, io.BytesIO(decode_data_url(data_url)), kind, scale)
+
+
+# ============================================
+# Uploads normalized in the background
+# ============================================
+
+def store_incoming(upload_folder, data):
+    """
+    Keep an upload as received until finish_incoming() normalizes it
+    Only the image header is parsed here. Returns a unique filename for the
+    template to reference meanwhile. Raises ValueError if data is not a PNG
+    or JPEG image.
+    """
+    from PIL import Image, UnidentifiedImageError
+    try:
+        image_format = Image.open(io.BytesIO(data)).format
+    except (UnidentifiedImageError, OSError) as e:
+        raise ValueError(f'Not an image: {e}')
+    extension = INCOMING_EXTENSIONS.get(image_format)
+    if extension is None:
+        raise ValueError(f'Unsupported image format {image_format}')
+    filename = f'{INCOMING_PREFIX}{secrets.token_hex(16)}.{extension}'
+    _write_file(upload_folder, os.path.join(upload_folder, filename), data)
+    return filename
+
+
+def finish_incoming(db, upload_folder, template_id, column, incoming, previous, scale=DEFAULT_SCALE):
+    """
+    Normalize an incoming upload and put the stored file in its template
+    The column only changes if it still names the incoming file, so a newer
+    upload is never overwritten. An image that cannot be decoded is replaced
+    by previous. Returns (new template version or None if unchanged, error).
+    """
+    path = os.path.join(upload_folder, incoming)
+    if not os.path.exists(path):
+        # Finished by an earlier attempt
+        return None, None
+    error = None
+    try:
+        with open(path, 'rb') as f:
+            stored = store_upload(upload_folder, f, TEMPLATE_FILE_COLUMNS[column], scale)
+    except ValueError as e:
+        stored, error = previous, str(e)
+    row = db.execute(f'UPDATE templates SET {column} = ?, version = version + 1 '
+                     f'WHERE id = ? AND {column} = ? RETURNING version',
+                     (stored, template_id, incoming)).fetchone()
+    db.commit()
+    os.unlink(path)
+    return (row['version'] if row else None), error
+
+
+def extract_stamp_data(db, upload_folder, log=None):
+    """
+    Move generated stamps out of templates.stamp_data into stored files
+    Each data URL is decoded and stored like an upload, stamp_path is set and
+    stamp_data cleared. Returns the number of templates converted.
+    """
+    rows = db.execute("SELECT id, stamp_data FROM templates WHERE stamp_data IS NOT NULL AND stamp_data != ''").fetchall()
+    converted = 0
+    for row in rows:
+        try:
+            filename = store_data_url(upload_folder, row['stamp_data'], 'stamp')
+        except ValueError as e:
+            filename = None
+            if log:
+                log(f'Template {row["id"]}: dropping unreadable stamp_data ({e})')
+        db.execute('UPDATE templates SET stamp_path = ?, stamp_data = NULL WHERE id = ?', (filename, row['id']))
+        converted += 1
+    return converted
+
+
+def is_content_addressed(filename):
+    stem, _, extension = filename.partition('.')
+    return (len(stem) == HASH_LENGTH and extension in ('png', 'jpg')
+            and all(c in '0123456789abcdef' for c in stem))
+
+
+def referenced_files(db):
+    """Every upload filename referenced by a template"""
+    names = set()
+    for column in TEMPLATE_FILE_COLUMNS:
+        for row in db.execute(f'SELECT DISTINCT {column} FROM templates WHERE {column} IS NOT NULL'):
+            names.add(row[0])
+    return names
+
+
+def normalize_existing(db, upload_folder, scale=DEFAULT_SCALE, log=None):
+    """
+    Re-store legacy uploads referenced by templates in the normalized form
+    Returns the number of template references rewritten. Old files are left
+    for collect_garbage().
+    """
+    rewritten = 0
+    for column, kind in TEMPLATE_FILE_COLUMNS.items():
+        rows = db.execute(f'SELECT DISTINCT {column} FROM templates WHERE {column} IS NOT NULL').fetchall()
+        for (filename,) in rows:
+            if is_content_addressed(filename):
+                continue
+            path = os.path.join(upload_folder, filename)
+            try:
+                stored = store_upload(upload_folder, path, kind, scale)
+            except (ValueError, FileNotFoundError) as e:
+                if log:
+                    log(f'Skipping {filename}: {e}')
+                continue
+            cur = db.execute(f'UPDATE templates SET {column} = ? WHERE {column} = ?', (stored, filename))
+            db.commit()
+            rewritten += cur.rowcount
+            if log:
+                log(f'{filename} -> {stored}')
+    return rewritten
+
+
+def collect_garbage(db, upload_folder, min_age=3600, dry_run=False):
+    """
+    Delete upload files no template references
+    Files younger than min_age seconds are kept so an upload whose template
+    row has not been committed yet is never removed. Returns (removed, bytes).
+    """
+    referenced = referenced_files(db)
+    cutoff = time.time() - min_age
+    removed = []
+    freed = 0
+    for entry in os.scandir(upload_folder):
+        if not entry.is_file() or entry.name in referenced:
+            continue
+        stat = entry.stat()
+        if stat.st_mtime > cutoff:
+            continue
+        if not dry_run:
+            os.unlink(entry.path)
+        removed.append(entry.name)
+        freed += stat.st_size
+    return sorted(removed), freed
+
+
+def serve_upload(filename):
+    """
+    Response for an uploaded file with caching headers
+    Content-addressed names are fingerprints: they get a strong ETag equal to
+    the hash and Cache-Control: immutable. Legacy names are revalidated on
+    every use. UPLOADS_OFFLOAD set to 'x-sendfile' or 'x-accel-redirect'
+    hands the file body to the front-end server.
+    """
+    config = current_app.config
+    folder = config['UPLOAD_FOLDER']
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+
+    immutable = is_content_addressed(filename)
+    etag = filename.partition('.')[0] if immutable else True
+    offload = config.get('UPLOADS_OFFLOAD')
+
+    if offload in ('x-sendfile', 'x-accel-redirect'):
+        # The front-end server streams the body; conditional requests are
+        # still answered here so a revalidation costs no file transfer at all
+        response = current_app.response_class(status=200)
+        if offload == 'x-sendfile':
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        else:
+            response.headers['X-Accel-Redirect'] = config['UPLOADS_ACCEL_PREFIX'].rstrip('/') + '/' + filename
+        response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if immutable:
+            response.set_etag(etag)
+        else:
+            stat = os.stat(path)
+            response.set_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+        response.make_conditional(request)
+        if response.status_code == 304:
+            response.headers.pop('X-Sendfile', None)
+            response.headers.pop('X-Accel-Redirect', None)
+    else:
+        # send_file answers If-None-Match with 304 and Range with 206
+        response = send_from_directory(folder, filename, etag=etag, conditional=True,
+                                       max_age=IMMUTABLE_MAX_AGE if immutable else None)
+
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response